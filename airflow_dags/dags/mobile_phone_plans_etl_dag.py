@@ -1,12 +1,19 @@
 """This DAG is used to run the ETL (Extract, Transform, Load)
-pipeline for mobile phone plans"""
+pipeline for mobile phone plans.
 
-from datetime import datetime
+Each run targets its logical date, or the dates of its `scraping_dates` param. The
+extract and transform steps are mapped over the prospect profiles, and the
+transform and load steps over the scraping dates, so that the profiles of a day
+and the days of a backfill run in parallel, up to the slots of the `POOL` pool."""
+
+import logging
+from datetime import timedelta
+from typing import Dict, List
 
 import pendulum
 from airflow.providers.docker.operators.docker import DockerOperator
 from airflow.providers.standard.operators.bash import BashOperator
-from airflow.sdk import DAG
+from airflow.sdk import DAG, Param, Variable, get_current_context, task
 from docker.types import Mount
 
 ENV_FILE = "mobile_phone_plans_etl_dag.env"
@@ -15,6 +22,22 @@ CONFIG_FILE = "config/extract_action_sequence.yml"
 HOST_SA_KEY_PATH = "/tmp/service_account_key.json"
 CONTAINER_SA_KEY_PATH = "/tmp/service_account_key.json"
 
+IMAGE_REPOSITORY = "tagny/quechoisir-mobile-phone-plans-etl"
+"""Repository of the per-step images built from `Dockerfile-bookworm`, tagged with
+the name of their step"""
+POOL = "quechoisir_mobile_phone_plans_etl"
+"""Pool capping the number of ETL containers running at the same time, to create
+with e.g. `airflow pools set quechoisir_mobile_phone_plans_etl 2 "ETL containers"`"""
+PROFILES_VARIABLE = "quechoisir_mobile_phone_plans_profiles"
+"""Airflow variable with the JSON mapping of the prospect profiles to their
+extraction config file in the image"""
+DEFAULT_PROFILES = {"default": CONFIG_FILE}
+MAX_EXTRACTION_DELAY = timedelta(days=1)
+"""Max delay of a run after its logical date to extract the offers, which can only
+be scraped live: older runs, e.g. of a backfill, only transform and load"""
+MAX_ACTIVE_RUNS = 4
+"""Max number of runs in parallel, e.g. during a catch-up backfill"""
+
 sa_key_mount = Mount(
     source=HOST_SA_KEY_PATH,
     target=CONTAINER_SA_KEY_PATH,
@@ -24,15 +47,88 @@ sa_key_mount = Mount(
 
 DAG_NAME = "quechoisir_mobile_phone_plans_etl"
 
+logger = logging.getLogger(__name__)
+
+
+def get_profiles() -> Dict[str, str]:
+    """Returns the extraction config file of each prospect profile, read when the
+    tasks run rather than when the DAG is parsed"""
+    return Variable.get(
+        PROFILES_VARIABLE, default=DEFAULT_PROFILES, deserialize_json=True
+    )
+
+
+def etl_command(*arguments: str) -> List[str]:
+    """Returns the arguments of the ETL CLI entry point of the images"""
+    return [*arguments, "-k", CONTAINER_SA_KEY_PATH]
+
+
+@task
+def get_scraping_dates() -> List[str]:
+    """Returns the scraping dates of the run in YYYY/MM/DD format: the
+    `scraping_dates` param if given, the logical date of the run otherwise"""
+    context = get_current_context()
+    if context["params"]["scraping_dates"]:
+        return context["params"]["scraping_dates"]
+    # manual runs may have no logical date
+    logical_date = context.get("logical_date") or context["dag_run"].run_after
+    return [logical_date.strftime("%Y/%m/%d")]
+
+
+@task
+def build_extract_commands(scraping_dates: List[str]) -> List[List[str]]:
+    """Returns the extraction command of each profile for the scraping dates recent
+    enough to be scraped live, none for older dates"""
+    now = pendulum.now("UTC")
+    commands = []
+    for scraping_date in scraping_dates:
+        delay = now - pendulum.from_format(scraping_date, "YYYY/MM/DD", tz="UTC")
+        if delay > MAX_EXTRACTION_DELAY:
+            logger.info("Skipping the extraction of the past date %s", scraping_date)
+            continue
+        commands.extend(
+            etl_command("extract", "-c", config_file, "-d", scraping_date)
+            for config_file in get_profiles().values()
+        )
+    return commands
+
+
+@task
+def build_transform_commands(scraping_dates: List[str]) -> List[List[str]]:
+    """Returns the transform command of each profile and scraping date"""
+    return [
+        etl_command("transform", "-d", scraping_date, "-p", profile)
+        for scraping_date in scraping_dates
+        for profile in get_profiles()
+    ]
+
+
+@task
+def build_load_commands(scraping_dates: List[str]) -> List[List[str]]:
+    """Returns the load command of each scraping date"""
+    return [
+        etl_command("load", "-d", scraping_date) for scraping_date in scraping_dates
+    ]
+
+
 # DAG configuration
 with DAG(
     dag_id=DAG_NAME,
     start_date=pendulum.datetime(2023, 1, 1, tz="UTC"),
     schedule=None,
     catchup=False,
+    max_active_runs=MAX_ACTIVE_RUNS,
+    params={
+        "scraping_dates": Param(
+            [],
+            type="array",
+            description="Scraping dates in YYYY/MM/DD format to process instead of"
+            " the logical date, e.g. to re-run the transform and load steps of past"
+            " days in one run",
+        )
+    },
     tags=["tagny", "quechoisir", "mobile_phone_plans"],
 ) as dag:
-    today_date = datetime.now().strftime("%Y/%m/%d")
     # Define the start task
     start_task = BashOperator(
         task_id="0_start_pipeline",
@@ -45,56 +141,36 @@ with DAG(
 
     end_task = BashOperator(task_id="4_end_pipeline", bash_command="echo 'Ending ETL!'")
 
-    extract_task_id = f"1_extract_{DAG_NAME}"
-    transform_task_id = f"2_transform_{DAG_NAME}"
-    load_task_id = f"3_load_{DAG_NAME}"
-
-    extract_task = DockerOperator(
-        task_id=extract_task_id,
-        dag=dag,
-        image="tagny/quechoisir-mobile-phone-plans-etl:latest",
-        container_name=f"airflow-task-{extract_task_id}",
-        auto_remove="never",
+    docker_kwargs = dict(
+        pool=POOL,
+        # mapped containers get generated names, removed once they succeeded
+        auto_remove="success",
         env_file=ENV_FILE,
         # --- Mounts Configuration ---
         mounts=[sa_key_mount],
-        command=[
-            "sh",
-            "-c",
-            f"uv run -m etl extract -c {CONFIG_FILE} -k {CONTAINER_SA_KEY_PATH}",
-        ],
     )
 
-    transform_task = DockerOperator(
-        task_id=transform_task_id,
-        dag=dag,
-        image="tagny/quechoisir-mobile-phone-plans-etl:latest",
-        container_name=f"airflow-task-{transform_task_id}",
-        auto_remove="never",
-        env_file=ENV_FILE,
-        # --- Mounts Configuration ---
-        mounts=[sa_key_mount],
-        command=[
-            "sh",
-            "-c",
-            f"uv run -m etl transform -d {today_date} -k {CONTAINER_SA_KEY_PATH}",
-        ],
-    )
+    scraping_dates = get_scraping_dates()
+    start_task >> scraping_dates
 
-    load_task = DockerOperator(
-        task_id=load_task_id,
-        dag=dag,
-        image="tagny/quechoisir-mobile-phone-plans-etl:latest",
-        container_name=f"airflow-task-{load_task_id}",
-        auto_remove="never",
-        env_file=ENV_FILE,
-        # --- Mounts Configuration ---
-        mounts=[sa_key_mount],
-        command=[
-            "sh",
-            "-c",
-            f"uv run -m etl load -d {today_date} -k {CONTAINER_SA_KEY_PATH}",
-        ],
-    )
+    # no extraction task instance for past dates: the mapped task is then skipped
+    extract_task = DockerOperator.partial(
+        task_id=f"1_extract_{DAG_NAME}",
+        image=f"{IMAGE_REPOSITORY}:extract",
+        **docker_kwargs,
+    ).expand(command=build_extract_commands(scraping_dates))
+
+    transform_task = DockerOperator.partial(
+        task_id=f"2_transform_{DAG_NAME}",
+        image=f"{IMAGE_REPOSITORY}:transform",
+        trigger_rule="none_failed",
+        **docker_kwargs,
+    ).expand(command=build_transform_commands(scraping_dates))
+
+    load_task = DockerOperator.partial(
+        task_id=f"3_load_{DAG_NAME}",
+        image=f"{IMAGE_REPOSITORY}:load",
+        **docker_kwargs,
+    ).expand(command=build_load_commands(scraping_dates))
 
-    start_task >> extract_task >> transform_task >> load_task >> end_task
+    extract_task >> transform_task >> load_task >> end_task
@@ -0,0 +1,158 @@
+"""Shared fixtures of the offline benchmark suite.
+
+The recorded results page in `fixtures/results.html` is used as is for the small
+size, and its offer cards are cloned to build synthetic pages of larger sizes.
+"""
+
+import os
+import re
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, List
+
+import pytest
+from bs4 import BeautifulSoup
+from etl.data.raw_data_loading import LocalHtmlLoader
+from etl.data.transformed_data_loading import LocalJsonLoader
+from etl.data.utils import custom_json_encoder
+from etl.instrumentation import metrics
+from etl.transform.data_model import MobilePhonePlan
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+RECORDED_RESULTS_PATH = os.path.join(FIXTURES_DIR, "results.html")
+PRODUCTS_DIV_CLASS = "qc-comparateur_products qc-gap-9"
+OFFER_CARD_CLASS = "qc-offer-card qc-shadow-2 qc-round-2 qc-grid"
+SCRAPING_DATE = datetime(2025, 12, 7)
+PAGE_SIZES = [None, 1_000, 10_000]
+"""Number of offer cards per results page, None for the recorded page"""
+
+
+def read_recorded_results() -> str:
+    """Returns the HTML content of the recorded results page"""
+    with open(RECORDED_RESULTS_PATH, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+@lru_cache(maxsize=None)
+def build_results_page(offer_count: int | None) -> str:
+    """Builds a results page with `offer_count` offer cards cloned from the
+    recorded page, or returns the recorded page itself if `offer_count` is None
+
+    Args:
+        offer_count (int | None): number of offer cards of the page
+
+    Returns:
+        str: HTML content of the results page
+    """
+    recorded_html = read_recorded_results()
+    if offer_count is None:
+        return recorded_html
+    soup = BeautifulSoup(recorded_html, "html.parser")
+    products_div = soup.find("div", class_=PRODUCTS_DIV_CLASS)
+    cards = [
+        str(article.find_parent("div"))
+        for article in products_div.find_all("article", class_=OFFER_CARD_CLASS)
+    ]
+    synthetic_cards = []
+    for index in range(offer_count):
+        card = cards[index % len(cards)]
+        # keep detail ids unique like on the real page
+        card = re.sub(r'id="offer-\d+-details"', f'id="offer-{index}-details"', card)
+        synthetic_cards.append(card)
+    products_div.clear()
+    products_div.append(
+        BeautifulSoup("\n".join(synthetic_cards), "html.parser"),
+    )
+    return str(soup)
+
+
+def count_offers(offer_count: int | None) -> int:
+    """Returns the number of offer cards of a results page"""
+    return build_results_page(offer_count).count(f'class="{OFFER_CARD_CLASS}"')
+
+
+def page_id(offer_count: int | None) -> str:
+    """Returns a readable id of a page size for benchmark names"""
+    return "recorded" if offer_count is None else f"{offer_count}-offers"
+
+
+def parse_plans(html_content: str) -> List[MobilePhonePlan]:
+    """Parses all the plans of a results page"""
+    soup = BeautifulSoup(html_content, "html.parser")
+    plans = []
+    for article in soup.find_all("article", class_=OFFER_CARD_CLASS):
+        plan = MobilePhonePlan.from_plan_element(article.find_parent("div"))
+        plan.scraping_date = SCRAPING_DATE
+        plans.append(plan)
+    return plans
+
+
+@lru_cache(maxsize=None)
+def build_plan_dicts(offer_count: int | None) -> List[Dict[str, Any]]:
+    """Returns the plans of a results page as decoded from a JSON-line file"""
+    return [
+        custom_json_encoder(plan)
+        for plan in parse_plans(build_results_page(offer_count))
+    ]
+
+
+@lru_cache(maxsize=None)
+def build_offer_fields(offer_count: int | None) -> List[Dict[str, Any]]:
+    """Returns the fields of the offer cards of a results page as collected in the
+    browser by `OFFER_FIELDS_SCRIPT`, using the same CSS selectors"""
+
+    def text(element):
+        return None if element is None else element.text
+
+    soup = BeautifulSoup(build_results_page(offer_count), "html.parser")
+    offer_fields = []
+    for card in soup.select("div.qc-comparateur_products article.qc-offer-card"):
+        plan = card.parent
+        content = plan.select_one("div.qc-offer-card_content")
+        offer_fields.append(
+            {
+                "name": text(card.select_one("h2.qc-heading-xs")),
+                "details": text(plan.select_one("div[id*='details']")),
+                "operator_name": plan.get("data-operateur"),
+                "price": text(plan.select_one("b.qc-offer-card_price")),
+                "internet_level": plan.get("data-internet"),
+                "benefits": [text(element) for element in content.select("li")],
+            }
+        )
+    return offer_fields
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    """Avoids accumulating per-plan metrics across benchmark rounds"""
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+@pytest.fixture(params=PAGE_SIZES, ids=page_id)
+def offer_count(request) -> int | None:
+    """Number of offer cards of the benchmarked results page"""
+    return request.param
+
+
+@pytest.fixture
+def raw_data_loader(tmp_path, offer_count) -> LocalHtmlLoader:
+    """Local HTML loader serving the results page of the benchmarked size"""
+    loader = LocalHtmlLoader(
+        raw_base_dir=str(tmp_path / "raw"), scraping_date=SCRAPING_DATE
+    )
+    file_path = loader.get_results_file_path()
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(build_results_page(offer_count))
+    return loader
+
+
+@pytest.fixture
+def transformed_data_loader(tmp_path) -> LocalJsonLoader:
+    """Local JSON loader writing to a temporary directory"""
+    return LocalJsonLoader(
+        transformed_base_dir=str(tmp_path / "transformed"),
+        scraping_date=SCRAPING_DATE,
+    )
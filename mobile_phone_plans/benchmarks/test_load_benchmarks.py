@@ -0,0 +1,64 @@
+"""Benchmarks of the ORM and Core insertion paths of the load step, on SQLite"""
+
+import pytest
+from conftest import build_plan_dicts
+from etl.load.aggregation import aggregate_daily_summaries
+from etl.load.data_model import Base
+from etl.load.loading_to_sqlite import SQLiteDataLoader
+from sqlalchemy.orm import Session
+
+
+@pytest.fixture
+def sqlite_loader(tmp_path, transformed_data_loader) -> SQLiteDataLoader:
+    """SQLite loader with its tables created"""
+    loader = SQLiteDataLoader(
+        transformed_data_loader=transformed_data_loader,
+        database_path=str(tmp_path / "plans.sqlite"),
+    )
+    Base.metadata.create_all(loader.create_engine())
+    return loader
+
+
+@pytest.mark.benchmark(group="insert")
+def test_orm_insert(benchmark, offer_count, sqlite_loader):
+    engine = sqlite_loader.create_engine()
+    plans = build_plan_dicts(offer_count)
+
+    def orm_insert():
+        with Session(engine) as session:
+            session.add_all(sqlite_loader.flatten_plans_to_table_rows(plans))
+            session.commit()
+
+    benchmark.pedantic(orm_insert, rounds=3, iterations=1)
+
+
+@pytest.mark.benchmark(group="insert")
+@pytest.mark.parametrize("insert_batch_size", [100, 500])
+@pytest.mark.parametrize(
+    "use_multi_values_insert", [False, True], ids=["executemany", "multi-values"]
+)
+def test_core_insert(
+    benchmark, offer_count, sqlite_loader, insert_batch_size, use_multi_values_insert
+):
+    engine = sqlite_loader.create_engine()
+    sqlite_loader.insert_batch_size = insert_batch_size
+    sqlite_loader.use_multi_values_insert = use_multi_values_insert
+    plans = build_plan_dicts(offer_count)
+
+    def core_insert():
+        with engine.begin() as connection:
+            sqlite_loader.insert_table_rows(
+                connection, sqlite_loader.flatten_plans_to_table_dicts(plans)
+            )
+
+    benchmark.pedantic(core_insert, rounds=3, iterations=1)
+
+
+@pytest.mark.benchmark(group="aggregate")
+def test_aggregate_daily_summaries(benchmark, offer_count, sqlite_loader):
+    table_rows = sqlite_loader.flatten_plans_to_table_dicts(
+        build_plan_dicts(offer_count)
+    )
+    summary_rows, data_volume_rows = benchmark(aggregate_daily_summaries, table_rows)
+    assert sum(row["offer_count"] for row in summary_rows) == len(table_rows)
+    assert sum(row["offer_count"] for row in data_volume_rows) == len(table_rows)
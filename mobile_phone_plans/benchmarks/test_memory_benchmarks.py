@@ -0,0 +1,33 @@
+"""Benchmarks of the memory used by the plans"""
+
+import tracemalloc
+
+from conftest import build_offer_fields
+from etl.transform.data_model import MobilePhonePlan
+
+PLAN_COUNT = 100_000
+
+
+def test_plans_memory(benchmark):
+    offer_fields = build_offer_fields(None)
+    plan_offer_fields = [
+        dict(offer_fields[index % len(offer_fields)]) for index in range(PLAN_COUNT)
+    ]
+
+    def build_plans():
+        tracemalloc.start()
+        try:
+            plans = [
+                MobilePhonePlan.from_offer_fields(fields)
+                for fields in plan_offer_fields
+            ]
+            return plans, tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    plans, plans_memory = benchmark.pedantic(build_plans, rounds=1, iterations=1)
+    benchmark.extra_info["bytes_per_plan"] = plans_memory // len(plans)
+    benchmark.extra_info["megabytes_per_100k_plans"] = round(
+        plans_memory * 100_000 / len(plans) / 2**20, 1
+    )
+    assert len(plans) == PLAN_COUNT
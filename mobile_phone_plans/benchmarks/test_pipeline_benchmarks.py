@@ -0,0 +1,34 @@
+"""Benchmarks of the transform and load steps chained offline, with the local
+filesystem as storage and SQLite as a stand-in for BigQuery"""
+
+from conftest import SCRAPING_DATE, count_offers
+from etl.load.data_model import MobilePhonePlanDatabaseTable
+from etl.load.loading_to_sqlite import SQLiteDataLoader
+from etl.transform.daily_plans_transformation import DailyPlansTransformer
+from sqlalchemy import func, select
+
+
+def test_transform_and_load_pipeline(
+    benchmark, tmp_path, offer_count, raw_data_loader, transformed_data_loader
+):
+    transformer = DailyPlansTransformer(
+        scraping_date=SCRAPING_DATE,
+        raw_data_loader=raw_data_loader,
+        transformed_data_loader=transformed_data_loader,
+    )
+    database_loader = SQLiteDataLoader(
+        transformed_data_loader=transformed_data_loader,
+        database_path=str(tmp_path / "plans.sqlite"),
+    )
+
+    def run_pipeline():
+        transformer.transform()
+        database_loader.insert_plans()
+
+    benchmark.pedantic(run_pipeline, rounds=3, iterations=1)
+    with database_loader.create_engine().connect() as connection:
+        row_count = connection.execute(
+            select(func.count()).select_from(MobilePhonePlanDatabaseTable)
+        ).scalar()
+    # rows of the same scraping date are replaced at each round
+    assert row_count == count_offers(offer_count)
@@ -0,0 +1,48 @@
+"""Benchmarks of the serialization and load step hot paths"""
+
+from conftest import build_plan_dicts, build_results_page, parse_plans
+from etl.data.utils import custom_json_encoder
+from etl.load.loading_to_bigquery import BigQueryDataLoader
+
+
+def test_custom_json_encoder(benchmark, offer_count):
+    plans = parse_plans(build_results_page(offer_count))
+    encoded_plans = benchmark(lambda: [custom_json_encoder(plan) for plan in plans])
+    assert len(encoded_plans) == len(plans)
+
+
+def test_local_json_loader_save_plans(benchmark, offer_count, transformed_data_loader):
+    plans = parse_plans(build_results_page(offer_count))
+    benchmark.pedantic(
+        transformed_data_loader.save_plans, args=(plans,), rounds=5, iterations=1
+    )
+
+
+def test_local_json_loader_load_plans(benchmark, offer_count, transformed_data_loader):
+    transformed_data_loader.save_plans(parse_plans(build_results_page(offer_count)))
+    plans = benchmark(transformed_data_loader.load_plans)
+    assert plans
+
+
+def test_flatten_plans_to_table_rows(benchmark, offer_count, transformed_data_loader):
+    bq_loader = BigQueryDataLoader(
+        transformed_data_loader=transformed_data_loader,
+        project_id="benchmark-project",
+        dataset="benchmark_dataset",
+        service_account_key_json_path=None,
+    )
+    plans = build_plan_dicts(offer_count)
+    rows = benchmark(bq_loader.flatten_plans_to_table_rows, plans)
+    assert len(rows) == len(plans)
+
+
+def test_flatten_plans_to_table_dicts(benchmark, offer_count, transformed_data_loader):
+    bq_loader = BigQueryDataLoader(
+        transformed_data_loader=transformed_data_loader,
+        project_id="benchmark-project",
+        dataset="benchmark_dataset",
+        service_account_key_json_path=None,
+    )
+    plans = build_plan_dicts(offer_count)
+    rows = benchmark(bq_loader.flatten_plans_to_table_dicts, plans)
+    assert len(rows) == len(plans)
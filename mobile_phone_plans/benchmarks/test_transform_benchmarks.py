@@ -0,0 +1,96 @@
+"""Benchmarks of the transform step hot paths"""
+
+import json
+
+import pytest
+from bs4 import BeautifulSoup
+from conftest import (
+    OFFER_CARD_CLASS,
+    SCRAPING_DATE,
+    build_offer_fields,
+    build_results_page,
+    count_offers,
+)
+from etl.transform.daily_plans_transformation import DailyPlansTransformer
+from etl.transform.data_model import MobilePhonePlan
+from etl.transform.parse_cache import ParseCache
+
+
+@pytest.mark.parametrize("streaming", [False, True], ids=["soup", "streaming"])
+def test_daily_plans_transform(
+    benchmark, offer_count, raw_data_loader, transformed_data_loader, streaming
+):
+    transformer = DailyPlansTransformer(
+        scraping_date=SCRAPING_DATE,
+        raw_data_loader=raw_data_loader,
+        transformed_data_loader=transformed_data_loader,
+        streaming=streaming,
+    )
+    benchmark.pedantic(transformer.transform, rounds=3, iterations=1)
+    plans = transformed_data_loader.load_plans()
+    assert len(plans) == count_offers(offer_count)
+
+
+@pytest.mark.parametrize("streaming", [False, True], ids=["soup", "streaming"])
+def test_daily_plans_transform_with_warm_parse_cache(
+    benchmark,
+    offer_count,
+    raw_data_loader,
+    transformed_data_loader,
+    streaming,
+    tmp_path,
+):
+    parse_cache = ParseCache(str(tmp_path / "parse_cache.sqlite"))
+    transformer = DailyPlansTransformer(
+        scraping_date=SCRAPING_DATE,
+        raw_data_loader=raw_data_loader,
+        transformed_data_loader=transformed_data_loader,
+        streaming=streaming,
+        parse_cache=parse_cache,
+    )
+    # the first transform fills the cache
+    transformer.transform()
+    cold_misses = parse_cache.misses
+    benchmark.pedantic(transformer.transform, rounds=3, iterations=1)
+    parse_cache.close()
+    plans = transformed_data_loader.load_plans()
+    assert len(plans) == count_offers(offer_count)
+    assert parse_cache.misses == cold_misses
+
+
+def test_daily_plans_transform_from_offer_fields(
+    benchmark, offer_count, raw_data_loader, transformed_data_loader
+):
+    raw_data_loader.save_offer_fields(json.dumps(build_offer_fields(offer_count)))
+    transformer = DailyPlansTransformer(
+        scraping_date=SCRAPING_DATE,
+        raw_data_loader=raw_data_loader,
+        transformed_data_loader=transformed_data_loader,
+    )
+    benchmark.pedantic(transformer.transform, rounds=3, iterations=1)
+    plans = transformed_data_loader.load_plans()
+    assert len(plans) == count_offers(offer_count)
+
+
+def test_from_plan_element(benchmark):
+    soup = BeautifulSoup(build_results_page(None), "html.parser")
+    plan_elements = [
+        article.find_parent("div")
+        for article in soup.find_all("article", class_=OFFER_CARD_CLASS)
+    ]
+
+    def from_plan_elements():
+        return [MobilePhonePlan.from_plan_element(elt) for elt in plan_elements]
+
+    plans = benchmark(from_plan_elements)
+    assert len(plans) == len(plan_elements)
+
+
+def test_from_offer_fields(benchmark):
+    offer_fields = build_offer_fields(None)
+
+    def from_offer_fields():
+        return [MobilePhonePlan.from_offer_fields(fields) for fields in offer_fields]
+
+    plans = benchmark(from_offer_fields)
+    assert len(plans) == len(offer_fields)
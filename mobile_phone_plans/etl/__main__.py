@@ -2,23 +2,49 @@
 
 import logging
 import os
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
+from typing import Type
 
 import click
-import yaml
 from dotenv import load_dotenv
+from etl.comparators import ComparatorPlugin, get_comparator, list_comparators
+from etl.data.manifest import NoCompletedRunError
 from etl.data.raw_data_loading import (
+    BaseHtmlLoader,
     GoogleCloudStorageHtmlLoader,
     LocalHtmlLoader,
 )
 from etl.data.transformed_data_loading import (
+    BaseJsonLoader,
     GoogleCloudStorageJsonLoader,
     LocalJsonLoader,
 )
-from etl.extract.downloading import Action, DynamicSearchBrowser
+from etl.data.utils import STORAGE_EMULATOR_HOST_ENV_VAR
+from etl.instrumentation import metrics
+from etl.load.data_model import Base, MobilePhonePlanDatabaseTable
+from etl.load.database_loading import dispose_engines
 from etl.load.loading_to_bigquery import BigQueryDataLoader
-from etl.logging_setup import logger, setup_logger
+from etl.load.loading_to_sqlite import SQLiteDataLoader
+from etl.logging_setup import (
+    logger,
+    setup_logger,
+    shutdown_logger,
+    take_dropped_records,
+)
+from etl.query.plans_history import PlansHistoryCache, iter_days
 from etl.transform.daily_plans_transformation import DailyPlansTransformer
+from etl.transform.parse_cache import ParseCache
+from etl.worker import (
+    STEP_EXTRACT,
+    STEP_LOAD,
+    STEP_TRANSFORM,
+    STEPS,
+    EtlWorker,
+    Job,
+    JobQueue,
+)
+from google.cloud import storage
 
 load_dotenv()
 
@@ -28,9 +54,21 @@ TRANSFORMED_BASE_DIR = os.getenv("TRANSFORMED_BASE_DIR")
 DATASET = os.getenv("DATASET")
 BASE_URL = os.getenv("BASE_URL")
 PROJECT_ID = os.getenv("PROJECT_ID")
+SQLITE_DATABASE_PATH = os.getenv("SQLITE_DATABASE_PATH")
+PARSE_CACHE_PATH = os.getenv("PARSE_CACHE_PATH")
+PLANS_HISTORY_CACHE_PATH = os.getenv(
+    "PLANS_HISTORY_CACHE_PATH", ".data/mobile-phone-plans/plans_history.sqlite"
+)
+DEFAULT_QUERY_DAYS = 30
+"""Default number of days of the period queried by `etl query`"""
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", ".data/mobile-phone-plans/jobs.sqlite")
 ETL_STEP_EXTRACT = "1-EXTRACT"
 ETL_STEP_TRANSFORM = "2-TRANSFORM"
 ETL_STEP_LOAD = "3-LOAD"
+ETL_STEP_RUN = "0-RUN"
+ETL_STEP_QUERY = "4-QUERY"
+ETL_STEP_WORKER = "5-WORKER"
+ETL_STEP_MIGRATE = "6-MIGRATE"
 
 
 def get_suitable_raw_data_loader(
@@ -38,14 +76,18 @@ def get_suitable_raw_data_loader(
     raw_base_dir: str,
     service_account_json_path: str,
     scraping_date: datetime,
+    storage_client: storage.Client | None = None,
 ) -> LocalHtmlLoader | GoogleCloudStorageHtmlLoader:
     """Instantiates a suitable HTML loader based on the provided"""
-    if bucket and service_account_json_path:
+    if bucket and (
+        service_account_json_path or os.getenv(STORAGE_EMULATOR_HOST_ENV_VAR)
+    ):
         return GoogleCloudStorageHtmlLoader(
             bucket_name=bucket,
             raw_base_dir=raw_base_dir,
             service_account_key_json_path=service_account_json_path,
             scraping_date=scraping_date,
+            storage_client=storage_client,
         )
     return LocalHtmlLoader(
         raw_base_dir=raw_base_dir,
@@ -58,6 +100,7 @@ def get_suitable_transformed_data_loader(
     transformed_base_dir: str,
     service_account_json_path: str,
     scraping_date: datetime,
+    storage_client: storage.Client | None = None,
 ) -> LocalJsonLoader | GoogleCloudStorageJsonLoader:
     """Initializes a suitable JSON loader based on the"""
     logger.info(
@@ -65,12 +108,15 @@ def get_suitable_transformed_data_loader(
         bucket,
         service_account_json_path,
     )
-    if bucket and service_account_json_path:
+    if bucket and (
+        service_account_json_path or os.getenv(STORAGE_EMULATOR_HOST_ENV_VAR)
+    ):
         return GoogleCloudStorageJsonLoader(
             bucket_name=bucket,
             transformed_base_dir=transformed_base_dir,
             service_account_key_json_path=service_account_json_path,
             scraping_date=scraping_date,
+            storage_client=storage_client,
         )
     return LocalJsonLoader(
         transformed_base_dir=transformed_base_dir,
@@ -78,6 +124,61 @@ def get_suitable_transformed_data_loader(
     )
 
 
+def get_suitable_database_loader(
+    transformed_data_loader: BaseJsonLoader,
+    project_id: str,
+    dataset: str,
+    service_account_json_path: str,
+    sqlite_database_path: str,
+    table_model: Type[Base] = MobilePhonePlanDatabaseTable,
+) -> BigQueryDataLoader | SQLiteDataLoader:
+    """Instantiates a suitable database loader: a local SQLite database if its path
+    is provided, BigQuery otherwise. The daily summary tables are only refreshed
+    for the mobile phone plans table."""
+    aggregate_daily_summaries = table_model is MobilePhonePlanDatabaseTable
+    if sqlite_database_path:
+        return SQLiteDataLoader(
+            transformed_data_loader=transformed_data_loader,
+            database_path=sqlite_database_path,
+            table_model=table_model,
+            aggregate_daily_summaries=aggregate_daily_summaries,
+        )
+    return BigQueryDataLoader(
+        transformed_data_loader=transformed_data_loader,
+        project_id=project_id,
+        dataset=dataset,
+        service_account_key_json_path=service_account_json_path,
+        table_model=table_model,
+        aggregate_daily_summaries=aggregate_daily_summaries,
+    )
+
+
+def save_run_metrics(
+    data_loader: BaseHtmlLoader | BaseJsonLoader,
+    etl_step: str,
+) -> None:
+    """Logs the metrics collected during an ETL step and saves them as a JSON file
+    next to the artifacts of the step.
+
+    Args:
+        data_loader: loader of the artifacts of the ETL step
+        etl_step (str): the ETL step the metrics were collected for
+    """
+    dropped_records = take_dropped_records()
+    if dropped_records:
+        metrics.increment("log.dropped_records", dropped_records)
+        logger.warning(
+            "%d log record(s) dropped because the log queue was full",
+            dropped_records,
+        )
+    metrics.log_summary(etl_step)
+    try:
+        data_loader.save_metrics(metrics.to_json(), etl_step)
+        data_loader.flush()
+    except Exception as ex:
+        logger.exception("Error when saving metrics of step %s: %s", etl_step, ex)
+
+
 @click.group()
 def app():
     pass
@@ -97,9 +198,24 @@ def app():
     help="Path to the service account key JSON file",
     required=False,
 )
+@click.option(
+    "--resume/--no-resume",
+    default=True,
+    show_default=True,
+    help="Resume from the checkpoint of a previous extraction of the same day,"
+    " skipping it if it was completed",
+)
+@click.option(
+    "-d",
+    "--scraping-date",
+    help="The date in YYYY/MM/DD format under which the raw HTML files are saved,"
+    " today by default, e.g. the logical date of a scheduled run started late.",
+)
 def extract(
     config_path: str,
     service_account_key_path: str,
+    resume: bool,
+    scraping_date: str | None,
 ):
     """ETL extract command to scrape mobile phone plans for a given prospect
       profile scenario.
@@ -107,6 +223,10 @@ def extract(
         config_path (str): path to the YAML configuration file defining action
           sequences per prospect profile
         service_account_key_path (str): Path to the service account key JSON file
+        resume (bool): whether to resume from the checkpoint of a previous
+          extraction of the same day
+        scraping_date (str | None): the date in YYYY/MM/DD format under which the
+          raw HTML files are saved, today if None
     """
     setup_logger(
         level=logging.INFO,
@@ -114,27 +234,40 @@ def extract(
         service_account_key_json_path=service_account_key_path,
     )
     logger.info("ETL pipeline - step extract")
-    if not os.path.exists(config_path):
-        logger.error("Config file not found at %s", config_path)
-        raise FileNotFoundError(f"Config file not found at {config_path}")
-    with open(config_path, mode="r", encoding="utf-8") as config_file:
-        config = yaml.load(config_file, Loader=yaml.SafeLoader)
-    dict_actions = config["action_sequence"]
-    obj_actions = [Action(**action_config) for action_config in dict_actions]
-    logger.debug("Action sequence to execute: %s", obj_actions)
-    scraping_date = datetime.now()
+    # imported here so that the other steps run without Selenium installed
+    from etl.extract.crawl_scheduling import CrawlScheduler
+    from etl.extract.downloading import DynamicSearchBrowser, load_extraction_config
+
+    extraction_config = load_extraction_config(config_path)
+    logger.debug("Action sequence to execute: %s", extraction_config.actions)
+    scraping_date = (
+        datetime.strptime(scraping_date, "%Y/%m/%d")
+        if scraping_date
+        else datetime.now()
+    )
     data_loader = get_suitable_raw_data_loader(
         BUCKET_NAME,
         RAW_BASE_DIR,
         service_account_key_path,
         scraping_date,
-    )
-    browser = DynamicSearchBrowser(
-        obj_actions,
-        base_url=BASE_URL,
-        data_loader=data_loader,
-    )
-    browser.run()
+    ).start_run(extraction_config.profile, resume=resume)
+    crawl_scheduler = CrawlScheduler()
+    try:
+        with crawl_scheduler.crawl(BASE_URL) as throttle:
+            DynamicSearchBrowser(
+                extraction_config.actions,
+                base_url=BASE_URL,
+                data_loader=data_loader,
+                resume=resume,
+                max_consecutive_failures=extraction_config.max_consecutive_failures,
+                results_validation=extraction_config.results_validation,
+                offer_harvesting=extraction_config.offer_harvesting,
+                extract_offer_fields=extraction_config.extract_offer_fields,
+                throttle=throttle,
+            ).run()
+    finally:
+        crawl_scheduler.log_report()
+        save_run_metrics(data_loader, ETL_STEP_EXTRACT)
     logger.info("End of ETL pipeline step - extract")
 
 
@@ -150,9 +283,31 @@ def extract(
     "--service-account-key-path",
     help="Path to the service account key JSON file",
 )
+@click.option(
+    "--streaming/--no-streaming",
+    default=False,
+    help="Parse the results page incrementally to bound the memory used.",
+)
+@click.option(
+    "--parse-cache-path",
+    default=PARSE_CACHE_PATH,
+    help="Path to the SQLite file caching the parsed offer cards across days,"
+    " no cache if not provided.",
+)
+@click.option(
+    "-p",
+    "--profile",
+    "profiles",
+    multiple=True,
+    help="Prospect profile to transform (repeatable), all the profiles of the"
+    " daily manifest by default",
+)
 def transform(
     scraping_date: str,
     service_account_key_path: str,
+    streaming: bool,
+    parse_cache_path: str | None,
+    profiles: tuple[str, ...],
 ):
     """Transform step of the ETL pipeline scraping mobile phone plans
 
@@ -160,6 +315,11 @@ def transform(
         scraping_date (str): The date in YYYY/MM/DD format when the raw HTML
          files where scraped to identify their folder.
         service_account_key_path (str): Path to the service account key JSON file
+        streaming (bool): whether to parse the results page incrementally, saving
+          each plan as soon as it is parsed
+        parse_cache_path (str | None): path to the SQLite file caching the parsed
+          offer cards, no cache if None
+        profiles (tuple[str, ...]): prospect profiles to transform, all if empty
     """
     setup_logger(
         level=logging.INFO,
@@ -187,12 +347,36 @@ def transform(
         scraping_date,
     )
 
-    transformer = DailyPlansTransformer(
-        scraping_date=scraping_date,
-        raw_data_loader=raw_data_loader,
-        transformed_data_loader=transformed_data_loader,
-    )
-    transformer.transform()
+    parse_cache = ParseCache(parse_cache_path) if parse_cache_path else None
+    transformed_run_count = 0
+    try:
+        # the latest completed extraction of each profile, from the daily manifest
+        for run_raw_data_loader in raw_data_loader.iter_run_loaders():
+            if profiles and run_raw_data_loader.profile not in profiles:
+                continue
+            transformed_run_count += 1
+            logger.info(
+                "Transform run %s of the profile %s",
+                run_raw_data_loader.run_id,
+                run_raw_data_loader.profile,
+            )
+            DailyPlansTransformer(
+                scraping_date=scraping_date,
+                raw_data_loader=run_raw_data_loader,
+                transformed_data_loader=transformed_data_loader.for_run(
+                    run_raw_data_loader.profile, run_raw_data_loader.run_id
+                ),
+                streaming=streaming,
+                parse_cache=parse_cache,
+            ).transform()
+        if transformed_run_count == 0:
+            raise NoCompletedRunError(
+                f"No completed extraction run to transform on {scraping_date:%Y/%m/%d}"
+            )
+    finally:
+        if parse_cache is not None:
+            parse_cache.close()
+        save_run_metrics(transformed_data_loader, ETL_STEP_TRANSFORM)
     logger.info("End of ETL pipeline step - transform")
 
 
@@ -202,29 +386,51 @@ def transform(
     "--scraping-date",
     help="The date when the raw HTML files where scraped to identify their folder.",
 )
+@click.option(
+    "--from",
+    "from_date",
+    help="First scraping date in YYYY/MM/DD format of a range of dates to load in"
+    " one batch, e.g. for a backfill, instead of --scraping-date.",
+)
+@click.option(
+    "--to",
+    "to_date",
+    help="Last scraping date in YYYY/MM/DD format of the range, included, today by"
+    " default.",
+)
 @click.option(
     "-k",
     "--service-account-key-path",
     help="Path to the service account key JSON file",
 )
 def load(
-    scraping_date: str,
+    scraping_date: str | None,
+    from_date: str | None,
+    to_date: str | None,
     service_account_key_path: str,
 ):
     """Load step of the ETL pipeline scraping mobile phone plans
 
     Args:
-        predefined_profile_id (str): the id of the predefined prospect profile
-         to use (defined in fr_energy_offers_scraper.data.prospect_predefined_profiles).
-        scraping_date (str): The date when the raw HTML files where scraped
+        scraping_date (str | None): The date when the raw HTML files where scraped
          to identify their folder.
+        from_date (str | None): first scraping date of a range to load in one
+         batch, instead of `scraping_date`
+        to_date (str | None): last scraping date of the range, today if None
         service_account_key_path (str): Path to the service account key JSON file
     """
+    if bool(scraping_date) == bool(from_date):
+        raise click.UsageError("Provide either --scraping-date or --from")
+    if to_date and not from_date:
+        raise click.UsageError("--to requires --from")
     setup_logger(
         level=logging.INFO,
         etl_step=ETL_STEP_LOAD,
         service_account_key_json_path=service_account_key_path,
     )
+    if from_date:
+        load_range(from_date, to_date, service_account_key_path)
+        return
     logger.info(
         "ETL pipeline - step load - on scraping_date = %s",
         scraping_date,
@@ -238,27 +444,574 @@ def load(
         scraping_date,
     )
 
-    bq_loader = BigQueryDataLoader(
-        transformed_data_loader=transformed_data_loader,
-        project_id=PROJECT_ID,
-        dataset=DATASET,
-        service_account_key_json_path=service_account_key_path,
+    database_loader = get_suitable_database_loader(
+        transformed_data_loader,
+        PROJECT_ID,
+        DATASET,
+        service_account_key_path,
+        SQLITE_DATABASE_PATH,
     )
 
-    bq_loader.insert_plans()
+    try:
+        database_loader.insert_plans()
+    finally:
+        save_run_metrics(transformed_data_loader, ETL_STEP_LOAD)
     logger.info("End of ETL pipeline step - load")
 
 
-if __name__ == "__main__":
+def load_range(
+    from_date: str, to_date: str | None, service_account_key_path: str
+) -> None:
+    """Loads the plans of a range of scraping dates in one batch, with a single
+    load job and MERGE on BigQuery
+
+    Args:
+        from_date (str): first scraping date in YYYY/MM/DD format
+        to_date (str | None): last scraping date in YYYY/MM/DD format, included,
+          today if None
+        service_account_key_path (str): Path to the service account key JSON file
+    """
+    start_date = datetime.strptime(from_date, "%Y/%m/%d").date()
+    end_date = (
+        datetime.strptime(to_date, "%Y/%m/%d") if to_date else datetime.now()
+    ).date()
+    if end_date < start_date:
+        raise click.UsageError("--to must not be before --from")
+    logger.info(
+        "ETL pipeline - step load - on scraping dates from %s to %s",
+        start_date,
+        end_date,
+    )
+    transformed_data_loaders = []
+    for day in iter_days(start_date, end_date):
+        transformed_data_loaders.append(
+            get_suitable_transformed_data_loader(
+                BUCKET_NAME,
+                TRANSFORMED_BASE_DIR,
+                service_account_key_path,
+                datetime.combine(day, datetime.min.time()),
+                storage_client=getattr(
+                    next(iter(transformed_data_loaders), None), "storage_client", None
+                ),
+            )
+        )
+    database_loader = get_suitable_database_loader(
+        transformed_data_loaders[0],
+        PROJECT_ID,
+        DATASET,
+        service_account_key_path,
+        SQLITE_DATABASE_PATH,
+    )
+    try:
+        database_loader.insert_plans_range(transformed_data_loaders)
+    finally:
+        # the metrics of the range are saved with the artifacts of its last date
+        save_run_metrics(transformed_data_loaders[-1], ETL_STEP_LOAD)
+    logger.info("End of ETL pipeline step - load")
+
+
+@app.command()
+@click.option(
+    "-n",
+    "--comparator",
+    "comparator_names",
+    multiple=True,
+    help="Name of a comparator to run (repeatable), all registered ones by default",
+)
+@click.option(
+    "-w",
+    "--max-workers",
+    default=2,
+    show_default=True,
+    help="Max number of comparators processed concurrently",
+)
+@click.option(
+    "-b",
+    "--max-browsers",
+    default=1,
+    show_default=True,
+    help="Max number of browsers running at the same time",
+)
+@click.option(
+    "-k",
+    "--service-account-key-path",
+    help="Path to the service account key JSON file",
+)
+def run(
+    comparator_names: tuple[str, ...],
+    max_workers: int,
+    max_browsers: int,
+    service_account_key_path: str,
+):
+    """Runs the extract, transform and load steps of several comparators in one
+    job, sharing the browsers and storage clients between them.
+
+    Args:
+        comparator_names (tuple[str, ...]): names of the comparators to run
+        max_workers (int): max number of comparators processed concurrently
+        max_browsers (int): max number of browsers running at the same time
+        service_account_key_path (str): Path to the service account key JSON file
+    """
+    setup_logger(
+        level=logging.INFO,
+        etl_step=ETL_STEP_RUN,
+        service_account_key_json_path=service_account_key_path,
+    )
+    # imported here so that the other steps run without Selenium installed
+    from etl.extract.driver_pool import ChromeDriverPool
+    from etl.scheduling import ComparatorScheduler
+
+    plugins = [get_comparator(name) for name in comparator_names or list_comparators()]
+    logger.info(
+        "ETL pipeline - run comparators %s", [plugin.name for plugin in plugins]
+    )
+    scraping_date = datetime.now()
+    # the comparators run concurrently, the first loader creating the client
+    shared_lock = threading.Lock()
+    shared_storage_clients = []
+
+    def build_raw_data_loader(plugin: ComparatorPlugin, scraping_date: datetime):
+        with shared_lock:
+            loader = get_suitable_raw_data_loader(
+                BUCKET_NAME,
+                plugin.raw_base_dir,
+                service_account_key_path,
+                scraping_date,
+                storage_client=next(iter(shared_storage_clients), None),
+            )
+            if not shared_storage_clients and hasattr(loader, "storage_client"):
+                shared_storage_clients.append(loader.storage_client)
+        return loader
+
+    def build_transformed_data_loader(
+        plugin: ComparatorPlugin, scraping_date: datetime
+    ):
+        with shared_lock:
+            loader = get_suitable_transformed_data_loader(
+                BUCKET_NAME,
+                plugin.transformed_base_dir,
+                service_account_key_path,
+                scraping_date,
+                storage_client=next(iter(shared_storage_clients), None),
+            )
+            if not shared_storage_clients and hasattr(loader, "storage_client"):
+                shared_storage_clients.append(loader.storage_client)
+        return loader
+
+    def build_database_loader(
+        plugin: ComparatorPlugin, transformed_data_loader: BaseJsonLoader
+    ):
+        return get_suitable_database_loader(
+            transformed_data_loader,
+            PROJECT_ID,
+            DATASET,
+            service_account_key_path,
+            SQLITE_DATABASE_PATH,
+            table_model=plugin.table_model,
+        )
+
+    driver_pool = ChromeDriverPool(max_size=max_browsers)
+    scheduler = ComparatorScheduler(
+        plugins=plugins,
+        driver_pool=driver_pool,
+        build_raw_data_loader=build_raw_data_loader,
+        build_transformed_data_loader=build_transformed_data_loader,
+        build_database_loader=build_database_loader,
+        max_workers=max_workers,
+    )
+    try:
+        errors = scheduler.run(scraping_date)
+    finally:
+        driver_pool.close()
+        metrics.log_summary(ETL_STEP_RUN)
+    failed_names = [name for name, error in errors.items() if error is not None]
+    if failed_names:
+        raise click.ClickException(f"Comparators failed: {failed_names}")
+    logger.info("End of ETL pipeline run")
+
+
+@app.command()
+@click.argument(
+    "report",
+    type=click.Choice(["price-history", "operators", "sql"]),
+    default="price-history",
+)
+@click.option(
+    "--from",
+    "from_date",
+    help="First scraping date of the period in YYYY/MM/DD format,"
+    f" {DEFAULT_QUERY_DAYS} days before the last one by default.",
+)
+@click.option(
+    "--to",
+    "to_date",
+    help="Last scraping date of the period in YYYY/MM/DD format, today by default.",
+)
+@click.option("-o", "--operator", "operator_name", help="Operator to filter on")
+@click.option("-i", "--internet-level", help="Internet level to filter on, e.g. 5G")
+@click.option("-q", "--sql", help="SQLite query on the `plans` table, for `sql`")
+@click.option(
+    "--cache-path",
+    default=PLANS_HISTORY_CACHE_PATH,
+    show_default=True,
+    help="Path to the SQLite file caching the plans history.",
+)
+@click.option(
+    "--sync/--no-sync",
+    default=True,
+    show_default=True,
+    help="Copy the days of the period not cached yet from the transformed data"
+    " storage before querying.",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Copy again the days of the period already cached.",
+)
+@click.option(
+    "-k",
+    "--service-account-key-path",
+    help="Path to the service account key JSON file",
+)
+def query(
+    report: str,
+    from_date: str | None,
+    to_date: str | None,
+    operator_name: str | None,
+    internet_level: str | None,
+    sql: str | None,
+    cache_path: str,
+    sync: bool,
+    refresh: bool,
+    service_account_key_path: str,
+):
+    """Queries the history of the transformed plans from a local cache, synced with
+    the transformed data storage for the days not cached yet.
+
+    Reports: `price-history` (offer count and prices per day and operator),
+    `operators` (comparison of the operators on the last day of the period) and
+    `sql` (custom query given with --sql).
+
+    Args:
+        report (str): the report to print
+        from_date (str | None): first scraping date of the period
+        to_date (str | None): last scraping date of the period
+        operator_name (str | None): operator to filter on
+        internet_level (str | None): internet level to filter on
+        sql (str | None): custom SQLite query of the `sql` report
+        cache_path (str): path to the SQLite file caching the plans history
+        sync (bool): whether to copy the days not cached yet before querying
+        refresh (bool): whether to copy again the days already cached
+        service_account_key_path (str): Path to the service account key JSON file
+    """
+    setup_logger(
+        level=logging.WARNING,
+        etl_step=ETL_STEP_QUERY,
+        service_account_key_json_path=service_account_key_path,
+    )
+    if report == "sql" and not sql:
+        raise click.UsageError("The sql report requires a query given with --sql")
+    end_date = (
+        datetime.strptime(to_date, "%Y/%m/%d") if to_date else datetime.now()
+    ).date()
+    start_date = (
+        datetime.strptime(from_date, "%Y/%m/%d").date()
+        if from_date
+        else end_date - timedelta(days=DEFAULT_QUERY_DAYS)
+    )
+    plans_history_cache = PlansHistoryCache(
+        database_path=cache_path,
+        build_transformed_data_loader=lambda scraping_date: (
+            get_suitable_transformed_data_loader(
+                BUCKET_NAME,
+                TRANSFORMED_BASE_DIR,
+                service_account_key_path,
+                scraping_date,
+            )
+        ),
+    )
+    try:
+        if sync:
+            plans_history_cache.sync(start_date, end_date, refresh=refresh)
+        if report == "price-history":
+            rows = plans_history_cache.get_price_history(
+                operator_name, internet_level, start_date, end_date
+            )
+        elif report == "operators":
+            rows = plans_history_cache.compare_operators(end_date)
+        else:
+            rows = plans_history_cache.query(sql)
+    finally:
+        plans_history_cache.close()
+    if rows:
+        click.echo("\t".join(rows[0]))
+    for row in rows:
+        click.echo(
+            "\t".join("" if value is None else str(value) for value in row.values())
+        )
+
+
+@app.command()
+@click.argument("step", type=click.Choice(STEPS))
+@click.option(
+    "-d",
+    "--scraping-date",
+    help="The date in YYYY/MM/DD format of the job, today by default.",
+)
+@click.option(
+    "-c",
+    "--config-path",
+    help="Path to the YAML configuration file defining the action sequence of a"
+    " prospect profile, required by the extract step",
+)
+@click.option("-p", "--profile", help="Prospect profile to transform, all by default")
+@click.option(
+    "--chain",
+    is_flag=True,
+    help="Enqueue the next steps once the job succeeded",
+)
+@click.option(
+    "--queue-path",
+    default=JOB_QUEUE_PATH,
+    show_default=True,
+    help="Path to the SQLite file of the job queue.",
+)
+def enqueue(
+    step: str,
+    scraping_date: str | None,
+    config_path: str | None,
+    profile: str | None,
+    chain: bool,
+    queue_path: str,
+):
+    """Adds an ETL step job to the queue of `etl worker`
+
+    Args:
+        step (str): the ETL step of the job
+        scraping_date (str | None): the date in YYYY/MM/DD format of the job,
+          today if None
+        config_path (str | None): path to the extraction config file
+        profile (str | None): prospect profile to transform, all if None
+        chain (bool): whether to enqueue the next steps once the job succeeded
+        queue_path (str): path to the SQLite file of the job queue
+    """
+    try:
+        job = Job(
+            step=step,
+            scraping_date=scraping_date or datetime.now().strftime("%Y/%m/%d"),
+            profile=profile,
+            config_path=config_path,
+            chain=chain,
+        )
+    except ValueError as ex:
+        raise click.UsageError(str(ex)) from ex
+    os.makedirs(os.path.dirname(queue_path) or ".", exist_ok=True)
+    job_queue = JobQueue(queue_path)
+    try:
+        job_id = job_queue.enqueue(job)
+    finally:
+        job_queue.close()
+    click.echo(job_id)
+
+
+@app.command()
+@click.option(
+    "-w",
+    "--max-workers",
+    default=1,
+    show_default=True,
+    help="Max number of jobs running at the same time",
+)
+@click.option(
+    "-b",
+    "--max-browsers",
+    default=1,
+    show_default=True,
+    help="Max number of browsers running at the same time, 0 not to run extract"
+    " jobs (and not to require Selenium)",
+)
+@click.option(
+    "--queue-path",
+    default=JOB_QUEUE_PATH,
+    show_default=True,
+    help="Path to the SQLite file of the job queue.",
+)
+@click.option(
+    "--exit-when-empty",
+    is_flag=True,
+    help="Stop once the queue is empty instead of waiting for new jobs",
+)
+@click.option(
+    "--parse-cache-path",
+    default=PARSE_CACHE_PATH,
+    help="Path to the SQLite file caching the parsed offer cards across days,"
+    " no cache if not provided.",
+)
+@click.option(
+    "-k",
+    "--service-account-key-path",
+    help="Path to the service account key JSON file",
+)
+def worker(
+    max_workers: int,
+    max_browsers: int,
+    queue_path: str,
+    exit_when_empty: bool,
+    parse_cache_path: str | None,
+    service_account_key_path: str,
+):
+    """Runs the jobs of the queue filled by `etl enqueue` in a long-lived process,
+    keeping the browsers, the storage client and the database engine warm across
+    jobs. SIGTERM and SIGINT drain the worker: the running jobs are completed and
+    no new job is started.
+
+    Args:
+        max_workers (int): max number of jobs running at the same time
+        max_browsers (int): max number of browsers running at the same time
+        queue_path (str): path to the SQLite file of the job queue
+        exit_when_empty (bool): whether to stop once the queue is empty
+        parse_cache_path (str | None): path to the SQLite file caching the parsed
+          offer cards, no cache if None
+        service_account_key_path (str): Path to the service account key JSON file
+    """
+    setup_logger(
+        level=logging.INFO,
+        etl_step=ETL_STEP_WORKER,
+        service_account_key_json_path=service_account_key_path,
+    )
+    shared_lock = threading.Lock()
+    shared_storage_clients = []
+
+    def build_raw_data_loader(scraping_date: datetime):
+        with shared_lock:
+            loader = get_suitable_raw_data_loader(
+                BUCKET_NAME,
+                RAW_BASE_DIR,
+                service_account_key_path,
+                scraping_date,
+                storage_client=next(iter(shared_storage_clients), None),
+            )
+            if not shared_storage_clients and hasattr(loader, "storage_client"):
+                shared_storage_clients.append(loader.storage_client)
+        return loader
+
+    def build_transformed_data_loader(scraping_date: datetime):
+        with shared_lock:
+            loader = get_suitable_transformed_data_loader(
+                BUCKET_NAME,
+                TRANSFORMED_BASE_DIR,
+                service_account_key_path,
+                scraping_date,
+                storage_client=next(iter(shared_storage_clients), None),
+            )
+            if not shared_storage_clients and hasattr(loader, "storage_client"):
+                shared_storage_clients.append(loader.storage_client)
+        return loader
+
+    def build_database_loader(transformed_data_loader: BaseJsonLoader):
+        # the loaders share the engine of the process, see `get_engine`
+        return get_suitable_database_loader(
+            transformed_data_loader,
+            PROJECT_ID,
+            DATASET,
+            service_account_key_path,
+            SQLITE_DATABASE_PATH,
+        )
+
+    etl_steps = {
+        STEP_EXTRACT: ETL_STEP_EXTRACT,
+        STEP_TRANSFORM: ETL_STEP_TRANSFORM,
+        STEP_LOAD: ETL_STEP_LOAD,
+    }
+
+    def save_job_metrics(job: Job, data_loader: BaseHtmlLoader | BaseJsonLoader):
+        # called while the job runs, `metrics` being its own registry
+        save_run_metrics(data_loader, etl_steps[job.step])
+
+    driver_pool = None
+    if max_browsers > 0:
+        # imported here so that the other steps run without Selenium installed
+        from etl.extract.driver_pool import ChromeDriverPool
+
+        driver_pool = ChromeDriverPool(max_size=max_browsers)
+    os.makedirs(os.path.dirname(queue_path) or ".", exist_ok=True)
+    job_queue = JobQueue(queue_path)
+    etl_worker = EtlWorker(
+        job_queue=job_queue,
+        build_raw_data_loader=build_raw_data_loader,
+        build_transformed_data_loader=build_transformed_data_loader,
+        build_database_loader=build_database_loader,
+        driver_pool=driver_pool,
+        base_url=BASE_URL,
+        parse_cache_path=parse_cache_path,
+        max_workers=max_workers,
+        exit_when_empty=exit_when_empty,
+        save_job_metrics=save_job_metrics,
+    )
+    etl_worker.install_signal_handlers()
+    try:
+        etl_worker.run()
+    finally:
+        if driver_pool is not None:
+            driver_pool.close()
+        dispose_engines()
+        job_queue.close()
+        metrics.log_summary(ETL_STEP_WORKER)
+
+
+@app.command()
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Only print the statements of the migration",
+)
+@click.option(
+    "-k",
+    "--service-account-key-path",
+    help="Path to the service account key JSON file",
+)
+def migrate(dry_run: bool, service_account_key_path: str):
+    """Migrates the schema of the tables of the load step: creates the missing
+    tables and adds the new nullable columns of the existing ones, which the loads
+    do not add implicitly, and on BigQuery partitions the existing tables created
+    before their partitioning
+
+    Args:
+        dry_run (bool): whether to only print the statements of the migration
+        service_account_key_path (str): Path to the service account key JSON file
+    """
+    setup_logger(
+        level=logging.INFO,
+        etl_step=ETL_STEP_MIGRATE,
+        service_account_key_json_path=service_account_key_path,
+    )
+    # no plans are loaded, only the target database and tables are needed
+    database_loader = get_suitable_database_loader(
+        None,
+        PROJECT_ID,
+        DATASET,
+        service_account_key_path,
+        SQLITE_DATABASE_PATH,
+    )
+    statements = database_loader.migrate(dry_run=dry_run)
+    for statement in statements:
+        click.echo(f"{statement};")
+    if not statements:
+        logger.info("The schema of %s is up to date", database_loader.database_name)
+
+
+def main():
+    """Entry point of the `mobile-phone-plans-etl` script and of `python -m etl`"""
     try:
         app()
     except Exception as ex:
         logger.exception("Error while running the ETL pipeline step: %s", ex)
         raise ex
     finally:
-        # Close the client to close all associated handlers and flush logs
-        from etl.logging_setup import cloud_logging_client
+        # Flush queued logs and close the Cloud Logging client, with a hard timeout
+        logger.info("Flushing logs and closing Cloud Logging client...")
+        shutdown_logger()
+
 
-        if cloud_logging_client:
-            logger.info("Closing Cloud Logging client...")
-            cloud_logging_client.close()
+if __name__ == "__main__":
+    main()
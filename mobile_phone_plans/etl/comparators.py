@@ -0,0 +1,122 @@
+"""This module defines the registry of comparator plugins. Each plugin supplies what
+is specific to a quechoisir comparator (action config, transformer and table
+schema) so that several comparators can run in one job with shared resources.
+
+Third-party packages can register their plugins with an entry point of the group
+`quechoisir_comparators` pointing to a `ComparatorPlugin` instance."""
+
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from importlib.metadata import entry_points
+from typing import Dict, List, Protocol, Type
+
+from dotenv import load_dotenv
+from etl.data.raw_data_loading import BaseHtmlLoader
+from etl.data.transformed_data_loading import BaseJsonLoader
+from etl.load.data_model import Base, MobilePhonePlanDatabaseTable
+from etl.logging_setup import logger
+from etl.transform.daily_plans_transformation import DailyPlansTransformer
+
+load_dotenv()
+
+PLUGINS_ENTRY_POINT_GROUP = "quechoisir_comparators"
+
+
+class Transformer(Protocol):
+    """Interface of the transformers of the comparator plugins"""
+
+    def __init__(
+        self,
+        scraping_date: datetime,
+        raw_data_loader: BaseHtmlLoader,
+        transformed_data_loader: BaseJsonLoader,
+    ) -> None: ...
+
+    def transform(self) -> None: ...
+
+
+@dataclass(frozen=True)
+class ComparatorPlugin:
+    """What is specific to a comparator in the ETL pipeline"""
+
+    name: str
+    """Unique name of the comparator, e.g. "mobile_phone_plans\""""
+    base_url: str
+    """URL of the search form of the comparator"""
+    action_config_path: str
+    """Path to the YAML configuration file defining the action sequence"""
+    transformer_cls: Type[Transformer]
+    """Transformer of the raw HTML files into JSON-line files"""
+    table_model: Type[Base]
+    """ORM model of the table where the transformed data is loaded"""
+    raw_base_dir: str
+    """Base directory of the raw HTML files"""
+    transformed_base_dir: str
+    """Base directory of the transformed JSON files"""
+
+
+_registry: Dict[str, ComparatorPlugin] = {}
+_entry_points_loaded = False
+
+
+def register_comparator(plugin: ComparatorPlugin) -> None:
+    """Registers a comparator plugin
+
+    Args:
+        plugin (ComparatorPlugin): the plugin to register
+
+    Raises:
+        ValueError: if another plugin is already registered with the same name
+    """
+    if plugin.name in _registry and _registry[plugin.name] != plugin:
+        raise ValueError(f"Comparator {plugin.name} is already registered")
+    _registry[plugin.name] = plugin
+    logger.debug("Registered comparator %s", plugin.name)
+
+
+def _load_entry_points() -> None:
+    """Registers the plugins declared by installed packages, once"""
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    for entry_point in entry_points(group=PLUGINS_ENTRY_POINT_GROUP):
+        try:
+            register_comparator(entry_point.load())
+        except Exception as ex:
+            logger.exception("Error when loading comparator %s: %s", entry_point, ex)
+
+
+def list_comparators() -> List[str]:
+    """Returns the names of the registered comparators"""
+    _load_entry_points()
+    return sorted(_registry)
+
+
+def get_comparator(name: str) -> ComparatorPlugin:
+    """Returns the registered comparator plugin named `name`
+
+    Raises:
+        KeyError: if no comparator is registered with this name
+    """
+    _load_entry_points()
+    try:
+        return _registry[name]
+    except KeyError:
+        raise KeyError(
+            f"Unknown comparator {name}, registered ones: {list_comparators()}"
+        ) from None
+
+
+register_comparator(
+    ComparatorPlugin(
+        name="mobile_phone_plans",
+        base_url=os.getenv("BASE_URL"),
+        action_config_path="config/extract_action_sequence.yml",
+        transformer_cls=DailyPlansTransformer,
+        table_model=MobilePhonePlanDatabaseTable,
+        raw_base_dir=os.getenv("RAW_BASE_DIR"),
+        transformed_base_dir=os.getenv("TRANSFORMED_BASE_DIR"),
+    )
+)
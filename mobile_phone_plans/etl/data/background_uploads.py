@@ -0,0 +1,83 @@
+"""This module runs storage uploads in background threads so that they overlap
+with the browser work and the parsing, instead of blocking them."""
+
+import contextvars
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Tuple
+
+from etl.logging_setup import logger
+
+DEFAULT_UPLOAD_WORKERS = 4
+
+
+class BackgroundUploader:
+    """Runs uploads in a thread pool. Uploads to the same destination are applied
+    in submission order, and a pending upload is dropped when a newer one to the
+    same destination is submitted, e.g. when the results page is saved after
+    each action."""
+
+    def __init__(self, max_workers: int = DEFAULT_UPLOAD_WORKERS) -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="upload"
+        )
+        self._lock = threading.Lock()
+        # latest upload future per destination, with the one it waits for
+        self._latest_futures: Dict[str, Tuple[Future, Future | None]] = {}
+
+    def submit(self, destination: str, upload: Callable[[], None]) -> Future:
+        """Schedules an upload
+
+        Args:
+            destination (str): unique identifier of the uploaded object, e.g. its
+              blob path
+            upload (Callable[[], None]): function doing the upload
+
+        Returns:
+            Future: the future of the upload
+        """
+        with self._lock:
+            latest = self._latest_futures.get(destination)
+            previous_future = None
+            if latest is not None:
+                latest_future, latest_previous_future = latest
+                if latest_future.cancel():
+                    logger.debug("Superseded pending upload to %s", destination)
+                    # the superseded upload may have been waiting for another one
+                    previous_future = latest_previous_future
+                else:
+                    previous_future = latest_future
+
+            def ordered_upload():
+                # wait for the running upload to the same destination to finish
+                # so that the newest content is written last
+                if previous_future is not None:
+                    wait([previous_future])
+                upload()
+
+            # run in the context of the caller, e.g. to record the upload metrics
+            # in the registry of its job
+            future = self._executor.submit(
+                contextvars.copy_context().run, ordered_upload
+            )
+            self._latest_futures[destination] = (future, previous_future)
+            return future
+
+    def flush(self) -> None:
+        """Waits for all the pending uploads
+
+        Raises:
+            Exception: the error of the first failed upload, if any
+        """
+        with self._lock:
+            futures = [future for future, _ in self._latest_futures.values()]
+            self._latest_futures.clear()
+        errors = [
+            future.exception()
+            for future in futures
+            if not future.cancelled() and future.exception() is not None
+        ]
+        if errors:
+            for error in errors[1:]:
+                logger.error("Background upload failed: %s", error)
+            raise errors[0]
@@ -0,0 +1,317 @@
+"""This module defines the per-day manifest of the runs of an ETL step, stored at
+`<base_dir>/YYYY/MM/DD/manifest.json` next to the run folders
+`<base_dir>/YYYY/MM/DD/<profile>/<run_id>/`. It records the files of each run, with
+their sizes and hashes, its offer count and timings, so that the next step finds
+its inputs with one read instead of listing the storage."""
+
+import abc
+import fcntl
+import hashlib
+import json
+import os
+import time
+from dataclasses import asdict, dataclass, field, replace
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from etl.logging_setup import logger
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from google.cloud import storage
+
+MANIFEST_FILE_NAME = "manifest.json"
+RUN_ID_FORMAT = "%Y%m%dT%H%M%S"
+MANIFEST_UPDATE_ATTEMPTS = 10
+"""Max number of attempts of a manifest update conflicting with concurrent ones"""
+
+
+class NoCompletedRunError(Exception):
+    """The daily manifest lists runs, but none of them completed"""
+
+
+def new_run_id() -> str:
+    """Returns a new run id, sortable by start time"""
+    return datetime.now().strftime(RUN_ID_FORMAT)
+
+
+@dataclass
+class ManifestFile:
+    """A file of a run"""
+
+    path: str
+    """Path of the file relative to the day folder"""
+    size: int
+    """Size of the file in bytes"""
+    sha256: str
+    """SHA-256 hash of the file content"""
+
+
+@dataclass
+class ManifestRun:
+    """A run of an ETL step for a prospect profile"""
+
+    profile: str
+    """Name of the prospect profile"""
+    run_id: str
+    """Id of the run, sortable by start time"""
+    files: Dict[str, ManifestFile] = field(default_factory=dict)
+    """Files of the run, by file name"""
+    offer_count: int | None = None
+    """Number of offers of the run, None if unknown"""
+    timings: Dict[str, float] = field(default_factory=dict)
+    """Durations in seconds of the steps of the run"""
+    completed: bool = False
+    """Whether the run completed"""
+    updated_at: str = field(default_factory=lambda: datetime.now().isoformat())
+    """When the run was last recorded"""
+
+    @property
+    def key(self) -> str:
+        return f"{self.profile}/{self.run_id}"
+
+
+@dataclass
+class DailyManifest:
+    """Runs of an ETL step for a scraping date"""
+
+    runs: Dict[str, ManifestRun] = field(default_factory=dict)
+    """Runs by `<profile>/<run_id>`"""
+
+    def record_run(self, run: ManifestRun) -> None:
+        """Adds or replaces a run"""
+        self.runs[run.key] = run
+
+    def get_latest_run(self, profile: str) -> ManifestRun | None:
+        """Returns the latest run of a profile, None if there is none"""
+        profile_runs = [run for run in self.runs.values() if run.profile == profile]
+        return max(profile_runs, key=lambda run: run.run_id, default=None)
+
+    def get_latest_completed_runs(self) -> List[ManifestRun]:
+        """Returns the latest completed run of each profile"""
+        latest_runs: Dict[str, ManifestRun] = {}
+        for run in self.runs.values():
+            latest_run = latest_runs.get(run.profile)
+            if run.completed and (latest_run is None or run.run_id > latest_run.run_id):
+                latest_runs[run.profile] = run
+        return [latest_runs[profile] for profile in sorted(latest_runs)]
+
+    def get_incomplete_profiles(self) -> List[str]:
+        """Returns the profiles with runs, none of which completed"""
+        completed_profiles = {
+            run.profile for run in self.runs.values() if run.completed
+        }
+        return sorted({run.profile for run in self.runs.values()} - completed_profiles)
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), indent=2)
+
+    @classmethod
+    def from_json(cls, manifest_json: str) -> "DailyManifest":
+        runs = {}
+        for key, run in json.loads(manifest_json)["runs"].items():
+            files = {
+                name: ManifestFile(**manifest_file)
+                for name, manifest_file in run.pop("files").items()
+            }
+            runs[key] = ManifestRun(files=files, **run)
+        return cls(runs=runs)
+
+
+class ManifestStore(abc.ABC):
+    """Reads and atomically updates a daily manifest"""
+
+    @abc.abstractmethod
+    def load(self) -> DailyManifest | None:
+        """Loads the manifest, None if there is none"""
+
+    @abc.abstractmethod
+    def update(self, update: Callable[[DailyManifest], None]) -> DailyManifest:
+        """Applies an update to the manifest without losing concurrent updates,
+        e.g. from runs of other profiles
+
+        Args:
+            update (Callable[[DailyManifest], None]): modifies the manifest in place
+
+        Returns:
+            DailyManifest: the updated manifest
+        """
+
+
+class LocalManifestStore(ManifestStore):
+    """Manifest stored on the local filesystem, updated under a file lock"""
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+
+    def load(self) -> DailyManifest | None:
+        if not os.path.exists(self.file_path):
+            return None
+        with open(self.file_path, "r", encoding="utf-8") as f:
+            return DailyManifest.from_json(f.read())
+
+    def update(self, update: Callable[[DailyManifest], None]) -> DailyManifest:
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        with open(f"{self.file_path}.lock", "w", encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            manifest = self.load() or DailyManifest()
+            update(manifest)
+            tmp_file_path = f"{self.file_path}.tmp"
+            with open(tmp_file_path, "w", encoding="utf-8") as f:
+                f.write(manifest.to_json())
+            os.replace(tmp_file_path, self.file_path)
+        return manifest
+
+
+class GoogleCloudStorageManifestStore(ManifestStore):
+    """Manifest stored on Google Cloud Storage, updated with generation
+    preconditions and retried when a concurrent update happened in between"""
+
+    def __init__(
+        self, storage_client: storage.Client, bucket_name: str, blob_path: str
+    ) -> None:
+        self.blob = storage_client.bucket(bucket_name).blob(blob_path)
+
+    def _load_with_generation(self) -> Tuple[DailyManifest | None, int]:
+        """Returns the manifest and its generation, 0 if there is none"""
+        try:
+            manifest_json = self.blob.download_as_text(encoding="utf-8")
+        except NotFound:
+            return None, 0
+        return DailyManifest.from_json(manifest_json), self.blob.generation
+
+    def load(self) -> DailyManifest | None:
+        return self._load_with_generation()[0]
+
+    def update(self, update: Callable[[DailyManifest], None]) -> DailyManifest:
+        for attempt in range(1, MANIFEST_UPDATE_ATTEMPTS + 1):
+            manifest, generation = self._load_with_generation()
+            manifest = manifest or DailyManifest()
+            update(manifest)
+            try:
+                self.blob.upload_from_string(
+                    manifest.to_json(),
+                    content_type="application/json",
+                    if_generation_match=generation,
+                )
+                return manifest
+            except PreconditionFailed:
+                logger.debug("Concurrent update of the manifest, attempt %d", attempt)
+                time.sleep(0.1 * attempt)
+        raise RuntimeError(
+            f"Failed to update the manifest after {MANIFEST_UPDATE_ATTEMPTS} attempts"
+        )
+
+
+@dataclass
+class RunPartitionedLoader(abc.ABC):
+    """Partitions the files of a loader by prospect profile and run, in
+    `<base_dir>/YYYY/MM/DD/<profile>/<run_id>/`, and records the runs in the daily
+    manifest. Without a profile, the files are stored in the day folder."""
+
+    profile: str | None = field(default=None, kw_only=True)
+    """Name of the prospect profile of the run, None for the day folder layout"""
+    run_id: str | None = field(default=None, kw_only=True)
+    """Id of the run, required with a profile"""
+    saved_files: Dict[str, ManifestFile] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    """Files saved by the run, recorded in the manifest by `record_run`"""
+
+    @abc.abstractmethod
+    def get_scraping_date_dir(self) -> str:
+        """Returns the sub-directory path for the scraping date"""
+
+    @abc.abstractmethod
+    def get_manifest_store(self) -> ManifestStore:
+        """Returns the store of the daily manifest"""
+
+    def get_run_dir(self) -> str:
+        """Returns the directory where the files of the run are stored"""
+        if self.profile is None:
+            return self.get_scraping_date_dir()
+        if self.run_id is None:
+            raise ValueError(f"No run id for the profile {self.profile}")
+        return os.path.join(self.get_scraping_date_dir(), self.profile, self.run_id)
+
+    def get_manifest_file_path(self) -> str:
+        """Returns the file path where the daily manifest is stored"""
+        return os.path.join(self.get_scraping_date_dir(), MANIFEST_FILE_NAME)
+
+    def load_manifest(self) -> DailyManifest | None:
+        """Loads the daily manifest, None if there is none"""
+        return self.get_manifest_store().load()
+
+    def for_run(self, profile: str | None, run_id: str | None):
+        """Returns a copy of the loader for a run of a profile"""
+        return replace(self, profile=profile, run_id=run_id)
+
+    def start_run(self, profile: str | None, resume: bool = True):
+        """Returns a copy of the loader for a run of a profile, continuing its
+        latest run of the day if `resume`, starting a new run otherwise"""
+        if profile is None:
+            return self.for_run(None, None)
+        latest_run = None
+        if resume:
+            manifest = self.load_manifest()
+            latest_run = manifest and manifest.get_latest_run(profile)
+        run_id = new_run_id() if latest_run is None else latest_run.run_id
+        logger.info("Run %s of the profile %s", run_id, profile)
+        return self.for_run(profile, run_id)
+
+    def iter_run_loaders(self) -> Iterator["RunPartitionedLoader"]:
+        """Yields a copy of the loader for the latest completed run of each profile
+        of the daily manifest, or the loader of the day folder if there is no
+        manifest"""
+        manifest = self.load_manifest()
+        if manifest is None:
+            yield self.for_run(None, None)
+            return
+        for profile in manifest.get_incomplete_profiles():
+            logger.warning(
+                "No completed run of the profile %s in %s, skipping it",
+                profile,
+                self.get_manifest_file_path(),
+            )
+        for run in manifest.get_latest_completed_runs():
+            yield self.for_run(run.profile, run.run_id)
+
+    def track_saved_file(self, file_path: str, size: int, sha256: str) -> None:
+        """Tracks a file saved by the run, to record it in the manifest"""
+        relative_path = os.path.relpath(file_path, self.get_scraping_date_dir())
+        file_name = os.path.relpath(file_path, self.get_run_dir())
+        self.saved_files[file_name] = ManifestFile(
+            path=relative_path, size=size, sha256=sha256
+        )
+
+    def track_saved_content(self, file_path: str, content: str) -> None:
+        """Tracks a file saved by the run from its content"""
+        content_bytes = content.encode("utf-8")
+        self.track_saved_file(
+            file_path, len(content_bytes), hashlib.sha256(content_bytes).hexdigest()
+        )
+
+    def record_run(
+        self,
+        offer_count: int | None = None,
+        timings: Dict[str, float] | None = None,
+        completed: bool = False,
+    ) -> None:
+        """Records the run and its saved files in the daily manifest, does nothing
+        without a profile
+
+        Args:
+            offer_count (int | None): number of offers of the run, None if unknown
+            timings (Dict[str, float] | None): durations in seconds of the steps of
+              the run
+            completed (bool): whether the run completed
+        """
+        if self.profile is None:
+            return
+        run = ManifestRun(
+            profile=self.profile,
+            run_id=self.run_id,
+            files=dict(self.saved_files),
+            offer_count=offer_count,
+            timings=timings or {},
+            completed=completed,
+        )
+        self.get_manifest_store().update(lambda manifest: manifest.record_run(run))
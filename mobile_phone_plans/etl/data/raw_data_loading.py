@@ -3,19 +3,32 @@ scraped HTML files to and from Local and cloud storage folders."""
 
 import abc
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Iterator, List
 
 from dotenv import load_dotenv
+from etl.data.background_uploads import BackgroundUploader
+from etl.data.manifest import (
+    GoogleCloudStorageManifestStore,
+    LocalManifestStore,
+    ManifestStore,
+    RunPartitionedLoader,
+)
+from etl.data.utils import create_storage_client
+from etl.instrumentation import metrics
 from etl.logging_setup import logger
 from google.api_core.exceptions import NotFound
 from google.cloud import storage
 
 load_dotenv()
 
+RESULTS_CHUNK_SIZE = 1024 * 1024
+"""Number of characters per chunk when streaming the results page"""
+
 
 @dataclass
-class BaseHtmlLoader(abc.ABC):
+class BaseHtmlLoader(RunPartitionedLoader):
     """Abstract base class for HTML files loaders"""
 
     raw_base_dir: str
@@ -48,7 +61,7 @@ class BaseHtmlLoader(abc.ABC):
             str: the base directory path for detail pages
         """
         return os.path.join(
-            self.get_scraping_date_dir(),
+            self.get_run_dir(),
             "detail",
         )
 
@@ -58,9 +71,147 @@ class BaseHtmlLoader(abc.ABC):
         Returns:
             str: the file path where the results HTML file is stored
         """
-        date_sub_dir = self.get_scraping_date_dir()
+        date_sub_dir = self.get_run_dir()
         return os.path.join(date_sub_dir, "results.html")
 
+    def get_metrics_file_path(self, etl_step: str) -> str:
+        """Returns the file path where the metrics of an ETL step are stored
+
+        Args:
+            etl_step (str): the ETL step the metrics were collected for
+
+        Returns:
+            str: the file path where the metrics JSON file is stored
+        """
+        return os.path.join(self.get_run_dir(), f"metrics_{etl_step}.json")
+
+    def get_checkpoint_file_path(self) -> str:
+        """Returns the file path where the extraction checkpoint is stored
+
+        Returns:
+            str: the file path where the extraction checkpoint JSON file is stored
+        """
+        return os.path.join(self.get_run_dir(), "extract_checkpoint.json")
+
+    def get_offer_fragments_dir(self) -> str:
+        """Returns the directory where the harvested offer cards are stored"""
+        return os.path.join(self.get_run_dir(), "offers")
+
+    def get_offer_fragments_file_path(self, part_index: int) -> str:
+        """Returns the file path of a part of the harvested offer cards
+
+        Args:
+            part_index (int): index of the part, in harvesting order
+
+        Returns:
+            str: the file path where the HTML fragments of the part are stored
+        """
+        return os.path.join(
+            self.get_offer_fragments_dir(), f"part-{part_index:05d}.html"
+        )
+
+    @abc.abstractmethod
+    def save_offer_fragments(self, part_index: int, fragments: List[str]) -> None:
+        """Saves a part of the harvested offer cards
+
+        Args:
+            part_index (int): index of the part, in harvesting order
+            fragments (List[str]): outer HTML of the offer cards of the part
+        """
+
+    @abc.abstractmethod
+    def load_offer_fragments(self) -> List[str]:
+        """Loads the parts of the harvested offer cards
+
+        Returns:
+            List[str]: HTML content of each part, in harvesting order, empty if the
+              offers were not harvested
+        """
+
+    @abc.abstractmethod
+    def delete_offer_fragments(self) -> None:
+        """Deletes the parts of the harvested offer cards of a previous run"""
+
+    def untrack_offer_fragments(self) -> None:
+        """Stops tracking the deleted parts of the harvested offer cards"""
+        fragments_dir = os.path.relpath(
+            self.get_offer_fragments_dir(), self.get_run_dir()
+        )
+        for file_name in list(self.saved_files):
+            if file_name.startswith(fragments_dir + os.sep):
+                del self.saved_files[file_name]
+
+    def get_offer_fields_file_path(self) -> str:
+        """Returns the file path where the offer fields collected in the browser
+        are stored"""
+        return os.path.join(self.get_run_dir(), "offers.json")
+
+    @abc.abstractmethod
+    def save_offer_fields(self, offer_fields_json: str) -> None:
+        """Saves the offer fields collected in the browser
+
+        Args:
+            offer_fields_json (str): JSON array of the fields of each offer card
+        """
+
+    @abc.abstractmethod
+    def load_offer_fields(self) -> str | None:
+        """Loads the offer fields collected in the browser
+
+        Returns:
+            str | None: JSON array of the fields of each offer card, None if they
+              were not collected
+        """
+
+    def get_results_metadata_file_path(self) -> str:
+        """Returns the file path where the metadata of the results page is stored
+
+        Returns:
+            str: the file path where the results metadata JSON file is stored
+        """
+        return os.path.join(self.get_run_dir(), "results_metadata.json")
+
+    @abc.abstractmethod
+    def save_results_metadata(self, metadata_json: str) -> None:
+        """Saves the metadata of the results page, e.g. its offer count
+
+        Args:
+            metadata_json (str): JSON content of the metadata
+        """
+
+    @abc.abstractmethod
+    def load_results_metadata(self) -> str | None:
+        """Loads the metadata of the results page
+
+        Returns:
+            str | None: JSON content of the metadata, None if there is none
+        """
+
+    @abc.abstractmethod
+    def save_checkpoint(self, checkpoint_json: str) -> None:
+        """Saves the checkpoint of the extraction
+
+        Args:
+            checkpoint_json (str): JSON content of the checkpoint
+        """
+
+    @abc.abstractmethod
+    def load_checkpoint(self) -> str | None:
+        """Loads the checkpoint of the extraction
+
+        Returns:
+            str | None: JSON content of the checkpoint, None if there is none
+        """
+
+    @abc.abstractmethod
+    def save_metrics(self, metrics_json: str, etl_step: str) -> None:
+        """Saves the metrics collected during an ETL step
+
+        Args:
+            metrics_json (str): JSON content of the metrics
+            etl_step (str): the ETL step the metrics were collected for
+        """
+
     @abc.abstractmethod
     def save_results(self, results_html_content: str) -> None:
         """Saves the HTML content of the results page
@@ -69,6 +220,9 @@ class BaseHtmlLoader(abc.ABC):
             results_html_content (str): HTML content of the results page
         """
 
+    def flush(self) -> None:
+        """Waits for the pending background saves, if any"""
+
     @abc.abstractmethod
     def load_results(self) -> str:
         """Loads and returns the HTML content of the results page
@@ -77,11 +231,27 @@ class BaseHtmlLoader(abc.ABC):
             str: HTML content of the results page
         """
 
+    @abc.abstractmethod
+    def iter_results_chunks(
+        self, chunk_size: int = RESULTS_CHUNK_SIZE
+    ) -> Iterator[str]:
+        """Streams the HTML content of the results page without loading it whole
+
+        Args:
+            chunk_size (int): number of characters per chunk
+
+        Yields:
+            str: the next chunk of the HTML content of the results page
+        """
+
 
 @dataclass
 class LocalHtmlLoader(BaseHtmlLoader):
     """HTML files loader saving/loading files to/from local filesystem"""
 
+    def get_manifest_store(self) -> ManifestStore:
+        return LocalManifestStore(self.get_manifest_file_path())
+
     def save_results(self, results_html_content: str) -> None:
         date_dir = self.get_scraping_date_dir()
         os.makedirs(date_dir, exist_ok=True)
@@ -89,13 +259,99 @@ class LocalHtmlLoader(BaseHtmlLoader):
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
         with open(file_path, "w", encoding="utf-8") as f:
             f.write(results_html_content)
+        self.track_saved_content(file_path, results_html_content)
         logger.info("Saved data at %s", file_path)
 
+    def save_metrics(self, metrics_json: str, etl_step: str) -> None:
+        file_path = self.get_metrics_file_path(etl_step)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(metrics_json)
+        logger.info("Saved metrics at %s", file_path)
+
     def load_results(self) -> str:
         file_path = self.get_results_file_path()
         with open(file_path, "r", encoding="utf-8") as f:
             return f.read()
 
+    def iter_results_chunks(
+        self, chunk_size: int = RESULTS_CHUNK_SIZE
+    ) -> Iterator[str]:
+        with open(self.get_results_file_path(), "r", encoding="utf-8") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+    def save_checkpoint(self, checkpoint_json: str) -> None:
+        file_path = self.get_checkpoint_file_path()
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(checkpoint_json)
+
+    def load_checkpoint(self) -> str | None:
+        file_path = self.get_checkpoint_file_path()
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def save_offer_fragments(self, part_index: int, fragments: List[str]) -> None:
+        file_path = self.get_offer_fragments_file_path(part_index)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        content = "\n".join(fragments)
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        self.track_saved_content(file_path, content)
+        logger.debug("Saved %d offer cards at %s", len(fragments), file_path)
+
+    def load_offer_fragments(self) -> List[str]:
+        fragments_dir = self.get_offer_fragments_dir()
+        if not os.path.isdir(fragments_dir):
+            return []
+        parts = []
+        for file_name in sorted(os.listdir(fragments_dir)):
+            with open(
+                os.path.join(fragments_dir, file_name), "r", encoding="utf-8"
+            ) as f:
+                parts.append(f.read())
+        return parts
+
+    def delete_offer_fragments(self) -> None:
+        fragments_dir = self.get_offer_fragments_dir()
+        if not os.path.isdir(fragments_dir):
+            return
+        for file_name in os.listdir(fragments_dir):
+            os.remove(os.path.join(fragments_dir, file_name))
+        self.untrack_offer_fragments()
+
+    def save_offer_fields(self, offer_fields_json: str) -> None:
+        file_path = self.get_offer_fields_file_path()
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(offer_fields_json)
+        self.track_saved_content(file_path, offer_fields_json)
+        logger.info("Saved offer fields at %s", file_path)
+
+    def load_offer_fields(self) -> str | None:
+        file_path = self.get_offer_fields_file_path()
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def save_results_metadata(self, metadata_json: str) -> None:
+        file_path = self.get_results_metadata_file_path()
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(metadata_json)
+        self.track_saved_content(file_path, metadata_json)
+
+    def load_results_metadata(self) -> str | None:
+        file_path = self.get_results_metadata_file_path()
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "r", encoding="utf-8") as f:
+            return f.read()
+
 
 @dataclass
 class GoogleCloudStorageHtmlLoader(BaseHtmlLoader):
@@ -107,15 +363,15 @@ class GoogleCloudStorageHtmlLoader(BaseHtmlLoader):
     """GCS storage client"""
     service_account_key_json_path: str = None
     """local path to the key of the service account"""
+    uploader: BackgroundUploader = field(default_factory=BackgroundUploader)
+    """Runs the uploads in background, call `flush` to wait for them"""
 
     def __post_init__(self):
-        if self.service_account_key_json_path:
-            self.storage_client = storage.Client.from_service_account_json(
+        # a storage client may be shared between loaders
+        if self.storage_client is None:
+            self.storage_client = create_storage_client(
                 self.service_account_key_json_path
             )
-        else:
-            # fallback to application default credentials
-            self.storage_client = storage.Client()
         logger.debug("Initialized GCS storage client for bucket: %s", self.bucket_name)
         self.__check_bucket_exists()
 
@@ -127,17 +383,94 @@ class GoogleCloudStorageHtmlLoader(BaseHtmlLoader):
         except NotFound:
             raise ValueError(f"GCS bucket {self.bucket_name} does not exist") from None
 
+    def get_manifest_store(self) -> ManifestStore:
+        return GoogleCloudStorageManifestStore(
+            self.storage_client, self.bucket_name, self.get_manifest_file_path()
+        )
+
+    def _upload_in_background(self, blob_path: str, content: str, content_type: str):
+        """Uploads a string to a blob in background"""
+        blob = self.storage_client.bucket(self.bucket_name).blob(blob_path)
+
+        def upload():
+            with metrics.span("extract.gcs_upload"):
+                blob.upload_from_string(content, content_type=content_type)
+            metrics.increment("bytes_uploaded", len(content.encode("utf-8")))
+            logger.info("uploaded data at gs://%s/%s", self.bucket_name, blob_path)
+
+        self.uploader.submit(blob_path, upload)
+
     def save_results(self, results_html_content: str) -> None:
-        # Ensure the bucket exists
-        self.__check_bucket_exists()
+        self.track_saved_content(self.get_results_file_path(), results_html_content)
+        self._upload_in_background(
+            self.get_results_file_path(), results_html_content, "text/html"
+        )
 
-        bucket = self.storage_client.bucket(self.bucket_name)
+    def save_metrics(self, metrics_json: str, etl_step: str) -> None:
+        self._upload_in_background(
+            self.get_metrics_file_path(etl_step), metrics_json, "application/json"
+        )
 
-        blob_path = self.get_results_file_path()
+    def save_checkpoint(self, checkpoint_json: str) -> None:
+        self._upload_in_background(
+            self.get_checkpoint_file_path(), checkpoint_json, "application/json"
+        )
 
-        blob = bucket.blob(blob_path)
-        blob.upload_from_string(results_html_content, content_type="text/html")
-        logger.info("uploaded data at gs://%s/%s", self.bucket_name, blob_path)
+    def load_checkpoint(self) -> str | None:
+        return self._download_if_exists(self.get_checkpoint_file_path())
+
+    def save_offer_fragments(self, part_index: int, fragments: List[str]) -> None:
+        file_path = self.get_offer_fragments_file_path(part_index)
+        content = "\n".join(fragments)
+        self.track_saved_content(file_path, content)
+        self._upload_in_background(file_path, content, "text/html")
+
+    def load_offer_fragments(self) -> List[str]:
+        blobs = self.storage_client.list_blobs(
+            self.bucket_name, prefix=self.get_offer_fragments_dir() + "/"
+        )
+        return [
+            blob.download_as_text(encoding="utf-8")
+            for blob in sorted(blobs, key=lambda blob: blob.name)
+        ]
+
+    def delete_offer_fragments(self) -> None:
+        # pending uploads of a previous harvest must not recreate deleted parts
+        self.flush()
+        for blob in self.storage_client.list_blobs(
+            self.bucket_name, prefix=self.get_offer_fragments_dir() + "/"
+        ):
+            blob.delete()
+        self.untrack_offer_fragments()
+
+    def save_offer_fields(self, offer_fields_json: str) -> None:
+        self.track_saved_content(self.get_offer_fields_file_path(), offer_fields_json)
+        self._upload_in_background(
+            self.get_offer_fields_file_path(), offer_fields_json, "application/json"
+        )
+
+    def load_offer_fields(self) -> str | None:
+        return self._download_if_exists(self.get_offer_fields_file_path())
+
+    def save_results_metadata(self, metadata_json: str) -> None:
+        self.track_saved_content(self.get_results_metadata_file_path(), metadata_json)
+        self._upload_in_background(
+            self.get_results_metadata_file_path(), metadata_json, "application/json"
+        )
+
+    def load_results_metadata(self) -> str | None:
+        return self._download_if_exists(self.get_results_metadata_file_path())
+
+    def _download_if_exists(self, blob_path: str) -> str | None:
+        """Downloads a blob as text, returns None if it does not exist"""
+        blob = self.storage_client.bucket(self.bucket_name).blob(blob_path)
+        try:
+            return blob.download_as_text(encoding="utf-8")
+        except NotFound:
+            return None
+
+    def flush(self) -> None:
+        self.uploader.flush()
 
     def load_results(self) -> str:
         """Loads and returns the HTML content of the results page
@@ -148,9 +481,6 @@ class GoogleCloudStorageHtmlLoader(BaseHtmlLoader):
         Returns:
             str: HTML content of the results page
         """
-        # Ensure the bucket exists
-        self.__check_bucket_exists()
-
         bucket = self.storage_client.bucket(self.bucket_name)
 
         blob_path = self.get_results_file_path()
@@ -164,3 +494,14 @@ class GoogleCloudStorageHtmlLoader(BaseHtmlLoader):
                 "GCS object gs://%s/%s not found: %s", self.bucket_name, blob_path, ex
             )
             raise ex
+
+    def iter_results_chunks(
+        self, chunk_size: int = RESULTS_CHUNK_SIZE
+    ) -> Iterator[str]:
+        blob_path = self.get_results_file_path()
+        blob = self.storage_client.bucket(self.bucket_name).blob(blob_path)
+        logger.info("streaming data from gs://%s/%s", self.bucket_name, blob_path)
+        # reads ranges of the blob of about chunk_size bytes
+        with blob.open("r", encoding="utf-8", chunk_size=chunk_size) as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
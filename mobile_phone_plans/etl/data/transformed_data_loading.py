@@ -4,14 +4,25 @@ transformed JSON data files to and from Local and cloud storage folders."""
 import abc
 import json
 import os
-from dataclasses import dataclass
+import tempfile
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterable, List
 
 from dotenv import load_dotenv
+from etl.data.background_uploads import BackgroundUploader
+from etl.data.manifest import (
+    GoogleCloudStorageManifestStore,
+    LocalManifestStore,
+    ManifestStore,
+    RunPartitionedLoader,
+)
 from etl.data.utils import (
+    create_storage_client,
     custom_json_encoder,
+    get_file_size_and_sha256,
 )
+from etl.instrumentation import metrics
 from etl.logging_setup import logger
 from google.api_core.exceptions import NotFound
 from google.cloud import storage
@@ -20,7 +31,7 @@ load_dotenv()
 
 
 @dataclass
-class BaseJsonLoader(abc.ABC):
+class BaseJsonLoader(RunPartitionedLoader):
     """Abstract base class for transformed JSON data"""
 
     transformed_base_dir: str
@@ -41,35 +52,86 @@ class BaseJsonLoader(abc.ABC):
         Returns:
             str: the file path where the plans JSON-line file is stored
         """
-        date_sub_dir = self.get_scraping_date_dir()
+        date_sub_dir = self.get_run_dir()
         return os.path.join(date_sub_dir, "plans.jsonl")
 
+    def get_metrics_file_path(self, etl_step: str) -> str:
+        """Returns the file path where the metrics of an ETL step are stored
+
+        Args:
+            etl_step (str): the ETL step the metrics were collected for
+
+        Returns:
+            str: the file path where the metrics JSON file is stored
+        """
+        return os.path.join(self.get_run_dir(), f"metrics_{etl_step}.json")
+
     @abc.abstractmethod
-    def save_plans(self, data: List[Dict[str, Any]]) -> None:
+    def save_metrics(self, metrics_json: str, etl_step: str) -> None:
         pass
 
+    @abc.abstractmethod
+    def save_plans(self, data: Iterable[Any]) -> None:
+        """Saves the plans as a JSON-line file, consuming them one at a time so
+        that they can be streamed
+
+        Args:
+            data (Iterable[Any]): the plans to save
+        """
+
+    def flush(self) -> None:
+        """Waits for the pending background saves, if any"""
+
     @abc.abstractmethod
     def load_plans(self) -> List[Dict[str, Any]]:
         pass
 
+    def load_daily_plans(self) -> List[Dict[str, Any]]:
+        """Loads the plans of the latest completed run of each profile of the
+        daily manifest, or the plans of the day folder if there is no manifest
+
+        Returns:
+            List[Dict[str, Any]]: the plans of the scraping date
+        """
+        plans = []
+        for run_loader in self.iter_run_loaders():
+            plans.extend(run_loader.load_plans())
+        return plans
+
 
 @dataclass
 class LocalJsonLoader(BaseJsonLoader):
     """Transformed JSON files loader saving/loading files to/from local filesystem"""
 
-    def save_plans(self, data: List[Dict[str, Any]]) -> None:
+    def get_manifest_store(self) -> ManifestStore:
+        return LocalManifestStore(self.get_manifest_file_path())
+
+    def save_plans(self, data: Iterable[Any]) -> None:
         plan_counter = 0
         output_jsonl_path = self.get_plans_jsonline_file_path()
         os.makedirs(os.path.dirname(output_jsonl_path), exist_ok=True)
-        with open(output_jsonl_path, "w", encoding="utf-8") as writer:
+        with (
+            metrics.span("transform.json_encode"),
+            open(output_jsonl_path, "w", encoding="utf-8") as writer,
+        ):
             for plan in data:
                 json.dump(custom_json_encoder(plan), writer, ensure_ascii=False)
                 writer.write("\n")
                 plan_counter += 1
+        self.track_saved_file(
+            output_jsonl_path, *get_file_size_and_sha256(output_jsonl_path)
+        )
         logger.info(
             "%d Plans data extracted and saved to %s", plan_counter, output_jsonl_path
         )
 
+    def save_metrics(self, metrics_json: str, etl_step: str) -> None:
+        file_path = self.get_metrics_file_path(etl_step)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(metrics_json)
+        logger.info("Saved metrics at %s", file_path)
+
     def load_plans(self) -> List[Dict[str, Any]]:
         jsonl_path = self.get_plans_jsonline_file_path()
         plans = []
@@ -92,15 +154,15 @@ class GoogleCloudStorageJsonLoader(BaseJsonLoader):
     """GCS storage client"""
     service_account_key_json_path: str = None
     """local path to the key of the service account"""
+    uploader: BackgroundUploader = field(default_factory=BackgroundUploader)
+    """Runs the uploads in background, call `flush` to wait for them"""
 
     def __post_init__(self):
-        if self.service_account_key_json_path:
-            self.storage_client = storage.Client.from_service_account_json(
+        # a storage client may be shared between loaders
+        if self.storage_client is None:
+            self.storage_client = create_storage_client(
                 self.service_account_key_json_path
             )
-        else:
-            # fallback to application default credentials
-            self.storage_client = storage.Client()
         logger.debug("Initialized GCS storage client for bucket: %s", self.bucket_name)
         self.__check_bucket_exists()
 
@@ -112,34 +174,78 @@ class GoogleCloudStorageJsonLoader(BaseJsonLoader):
         except NotFound:
             raise ValueError(f"GCS bucket {self.bucket_name} does not exist") from None
 
+    def get_manifest_store(self) -> ManifestStore:
+        return GoogleCloudStorageManifestStore(
+            self.storage_client, self.bucket_name, self.get_manifest_file_path()
+        )
+
     def _get_bucket(self):
         return self.storage_client.bucket(self.bucket_name)
 
-    def save_plans(self, data: List[Dict[str, Any]]) -> None:
+    def save_plans(self, data: Iterable[Any]) -> None:
         plan_counter = 0
-        # Build jsonl content in memory and upload to GCS
-        lines = []
-        for plan in data:
-            lines.append(json.dumps(custom_json_encoder(plan), ensure_ascii=False))
-            plan_counter += 1
-        content = "\n".join(lines) + ("\n" if lines else "")
+        # spool the jsonl content to a temporary file rather than memory and upload
+        # it to GCS
+        with (
+            metrics.span("transform.json_encode"),
+            tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", suffix=".jsonl", delete=False
+            ) as writer,
+        ):
+            for plan in data:
+                json.dump(custom_json_encoder(plan), writer, ensure_ascii=False)
+                writer.write("\n")
+                plan_counter += 1
         blob_name = self.get_plans_jsonline_file_path()
+        self.track_saved_file(blob_name, *get_file_size_and_sha256(writer.name))
         blob = self._get_bucket().blob(blob_name)
-        blob.upload_from_string(content, content_type="application/json; charset=utf-8")
-        logger.info(
-            "%d Plans data extracted and saved to gs://%s/%s",
-            plan_counter,
-            self.bucket_name,
-            blob_name,
+
+        def upload():
+            try:
+                with metrics.span("transform.gcs_upload"):
+                    blob.upload_from_filename(
+                        writer.name, content_type="application/json; charset=utf-8"
+                    )
+                metrics.increment("bytes_uploaded", os.path.getsize(writer.name))
+            finally:
+                os.remove(writer.name)
+            logger.info(
+                "%d Plans data extracted and saved to gs://%s/%s",
+                plan_counter,
+                self.bucket_name,
+                blob_name,
+            )
+
+        future = self.uploader.submit(blob_name, upload)
+        # a superseded upload never runs, its temporary file is removed here
+        future.add_done_callback(
+            lambda future: future.cancelled() and os.remove(writer.name)
         )
 
+    def save_metrics(self, metrics_json: str, etl_step: str) -> None:
+        blob_name = self.get_metrics_file_path(etl_step)
+        blob = self._get_bucket().blob(blob_name)
+
+        def upload():
+            blob.upload_from_string(metrics_json, content_type="application/json")
+            logger.info("uploaded metrics at gs://%s/%s", self.bucket_name, blob_name)
+
+        self.uploader.submit(blob_name, upload)
+
+    def flush(self) -> None:
+        self.uploader.flush()
+
     def load_plans(self) -> List[Dict[str, Any]]:
         jsonl_path = self.get_plans_jsonline_file_path()
         blob_name = jsonl_path
         blob = self._get_bucket().blob(blob_name)
-        if not blob.exists():
-            raise FileNotFoundError(f"gs://{self.bucket_name}/{blob_name} not found")
-        content = blob.download_as_text(encoding="utf-8")
+        # a single GET, without a preliminary existence check
+        try:
+            content = blob.download_as_text(encoding="utf-8")
+        except NotFound:
+            raise FileNotFoundError(
+                f"gs://{self.bucket_name}/{blob_name} not found"
+            ) from None
         plans = []
         for line in content.splitlines():
             line = line.strip()
@@ -147,3 +253,24 @@ class GoogleCloudStorageJsonLoader(BaseJsonLoader):
                 continue
             plans.append(json.loads(line))
         return plans
+
+    def get_daily_plans_uris(self) -> List[str]:
+        """Returns the gs:// URIs of the plans files read by `load_daily_plans`,
+        e.g. for a BigQuery load job. The completed runs of the daily manifest
+        are trusted to have saved their plans file, without a request per run, a
+        missing one failing the load job; only the plans file of the day folder,
+        without manifest, is left out when missing
+
+        Returns:
+            List[str]: the URIs of the plans files of the scraping date
+        """
+        uris = []
+        for run_loader in self.iter_run_loaders():
+            blob_name = run_loader.get_plans_jsonline_file_path()
+            if (
+                run_loader.profile is None
+                and not self._get_bucket().blob(blob_name).exists()
+            ):
+                continue
+            uris.append(f"gs://{self.bucket_name}/{blob_name}")
+        return uris
@@ -1,12 +1,19 @@
 """Utility functions for data serialization and handling."""
 
+import hashlib
 import json
 import os
 from collections.abc import Iterable
 from dataclasses import asdict, is_dataclass
 from datetime import datetime
 from enum import Enum
-from typing import Any
+from typing import Any, Tuple
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+
+STORAGE_EMULATOR_HOST_ENV_VAR = "STORAGE_EMULATOR_HOST"
+"""Environment variable read by the GCS client to target a storage emulator"""
 
 
 def is_builtin_class_instance(obj):
@@ -27,6 +34,12 @@ def custom_json_encoder(obj: Any) -> Any:
     if isinstance(obj, dict):
         # Recursively encode values in the dictionary
         return {key: custom_json_encoder(value) for key, value in obj.items()}
+    if hasattr(obj, "to_row"):
+        # Read the flat values of row-like dataclasses without copying them first
+        return {
+            key: custom_json_encoder(value)
+            for key, value in zip(obj.ROW_FIELDS, obj.to_row())
+        }
     if is_dataclass(obj):
         # Convert dataclass instances to a dictionary
         return {key: custom_json_encoder(value) for key, value in asdict(obj).items()}
@@ -50,3 +63,33 @@ def serialize_to_json_file(any_object: object, filename: str):
         json.dump(
             any_object, f, indent=4, ensure_ascii=False, default=custom_json_encoder
         )
+
+
+def get_file_size_and_sha256(file_path: str) -> Tuple[int, str]:
+    """
+    Returns the size in bytes and the SHA-256 hash of a file, read by chunks.
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha256.update(chunk)
+    return os.path.getsize(file_path), sha256.hexdigest()
+
+
+def create_storage_client(
+    service_account_key_json_path: str | None = None,
+) -> storage.Client:
+    """
+    Returns a GCS client targeting the storage emulator (e.g. fake-gcs-server) for
+    offline runs if `STORAGE_EMULATOR_HOST` is set, authenticated with the service
+    account key if any, or with the application default credentials otherwise.
+    """
+    if os.getenv(STORAGE_EMULATOR_HOST_ENV_VAR):
+        # no credentials with the emulator
+        return storage.Client(
+            project=os.getenv("PROJECT_ID") or "local",
+            credentials=AnonymousCredentials(),
+        )
+    if service_account_key_json_path:
+        return storage.Client.from_service_account_json(service_account_key_json_path)
+    return storage.Client()
@@ -0,0 +1,305 @@
+"""This module schedules the extractions politely: the requests sent to each domain
+by the browsers are rate limited by a token bucket, the number of extractions
+crawling a domain at the same time is capped, and the rate of a domain slows down
+when it answers with HTTP 429 or 5xx statuses or a captcha, then recovers
+gradually. The pages per minute achieved on each domain are reported."""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator
+from urllib.parse import urlparse
+
+from etl.instrumentation import metrics
+from etl.logging_setup import logger
+
+DEFAULT_REQUESTS_PER_MINUTE = float(os.getenv("CRAWL_REQUESTS_PER_MINUTE", "60"))
+"""Default max number of requests per minute sent to a domain"""
+DEFAULT_BURST = int(os.getenv("CRAWL_BURST", "10"))
+"""Default max number of requests sent to a domain at once after an idle period"""
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("CRAWL_MAX_CONCURRENCY", "2"))
+"""Default max number of extractions crawling a domain at the same time"""
+THROTTLING_STATUSES = {429}
+"""HTTP statuses asking to slow down, besides the 5xx ones"""
+
+
+@dataclass
+class CrawlPolicy:
+    """Rate and concurrency limits of the requests sent to a domain"""
+
+    requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE
+    """Max number of requests per minute, i.e. the refill rate of the bucket"""
+    burst: int = DEFAULT_BURST
+    """Capacity of the bucket: max number of requests sent at once after an idle
+    period"""
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+    """Max number of extractions crawling the domain at the same time"""
+    slowdown_factor: float = 0.5
+    """Factor applied to the rate on each HTTP 429/5xx status or captcha"""
+    min_requests_per_minute: float = 2.0
+    """Rate below which the slow-downs do not go"""
+    cooldown: float = 30.0
+    """Seconds without any request after a slow-down"""
+    recovery_requests: int = 20
+    """Number of consecutive requests without errors after which the rate grows
+    back by a tenth of `requests_per_minute`"""
+
+    def __post_init__(self):
+        if self.requests_per_minute <= 0 or self.burst < 1:
+            raise ValueError(
+                "The rate and burst of a crawl policy must be positive, got"
+                f" {self.requests_per_minute} requests per minute and a burst of"
+                f" {self.burst}"
+            )
+        if self.max_concurrency < 1:
+            raise ValueError(
+                f"Crawl concurrency must be positive, got {self.max_concurrency}"
+            )
+
+
+class TokenBucket:
+    """Thread-safe token bucket whose rate can be changed while in use"""
+
+    def __init__(self, rate_per_second: float, capacity: int) -> None:
+        """
+        Args:
+            rate_per_second (float): number of tokens added per second
+            capacity (int): max number of tokens, the bucket being full at first
+        """
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = max(0.0, now - max(self._updated_at, self._paused_until))
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate_per_second)
+        self._updated_at = max(now, self._updated_at)
+
+    def acquire(self) -> float:
+        """Takes a token, waiting for one if the bucket is empty
+
+        Returns:
+            float: the seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = max(
+                    self._paused_until - now,
+                    (1 - self._tokens) / self.rate_per_second,
+                )
+            time.sleep(wait)
+            waited += wait
+
+    def set_rate(self, rate_per_second: float) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate_per_second = rate_per_second
+
+    def pause(self, seconds: float) -> None:
+        """Empties the bucket and gives no token for `seconds`"""
+        with self._lock:
+            self._tokens = 0.0
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+@dataclass
+class DomainThrottle:
+    """Rate limiter and concurrency cap of the requests sent to a domain"""
+
+    domain: str
+    """Domain of the throttled requests, e.g. www.quechoisir.org"""
+    policy: CrawlPolicy = field(default_factory=CrawlPolicy)
+    """Limits of the requests sent to the domain"""
+    requests_per_minute: float = field(init=False)
+    """Current max number of requests per minute, lowered by the slow-downs"""
+    page_count: int = field(default=0, init=False)
+    """Number of requests sent"""
+    slowdown_count: int = field(default=0, init=False)
+    """Number of slow-downs"""
+    wait_seconds: float = field(default=0.0, init=False)
+    """Seconds waited for the rate limit"""
+    started_at: float | None = field(default=None, init=False)
+    """Time of the first request"""
+    last_request_at: float | None = field(default=None, init=False)
+    """Time of the latest request"""
+    _clean_request_count: int = field(default=0, init=False, repr=False)
+    _bucket: TokenBucket = field(init=False, repr=False)
+    _slots: threading.BoundedSemaphore = field(init=False, repr=False)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    def __post_init__(self):
+        self.requests_per_minute = self.policy.requests_per_minute
+        self._bucket = TokenBucket(self.requests_per_minute / 60, self.policy.burst)
+        self._slots = threading.BoundedSemaphore(self.policy.max_concurrency)
+
+    @contextmanager
+    def slot(self) -> Iterator["DomainThrottle"]:
+        """Holds one of the `max_concurrency` crawl slots of the domain, waiting
+        for one to be released if all of them are taken"""
+        start = time.perf_counter()
+        with self._slots:
+            metrics.observe("crawl.slot_wait_seconds", time.perf_counter() - start)
+            yield self
+
+    def wait_for_request(self) -> None:
+        """Waits until the rate limit of the domain allows a new request"""
+        waited = self._bucket.acquire()
+        now = time.monotonic()
+        with self._lock:
+            self.page_count += 1
+            self.wait_seconds += waited
+            self.started_at = self.started_at or now
+            self.last_request_at = now
+        metrics.increment("crawl.pages")
+        if waited:
+            metrics.observe("crawl.rate_limit_wait_seconds", waited)
+
+    def record_responses(self, statuses: Iterable[int], captcha: bool = False) -> None:
+        """Slows down the requests to the domain if the responses to the latest
+        request include an HTTP 429 or 5xx status or a captcha, grows their rate
+        back after `recovery_requests` requests without errors otherwise
+
+        Args:
+            statuses (Iterable[int]): HTTP statuses of the responses of the domain
+            captcha (bool): whether the page shows a captcha
+        """
+        error_statuses = sorted(
+            {
+                status
+                for status in statuses
+                if status in THROTTLING_STATUSES or 500 <= status < 600
+            }
+        )
+        reasons = []
+        if captcha:
+            metrics.increment("crawl.captchas")
+            reasons.append("captcha detected")
+        if error_statuses:
+            reasons.append(f"HTTP statuses {error_statuses}")
+        if reasons:
+            self.slow_down(" and ".join(reasons))
+            return
+        with self._lock:
+            self._clean_request_count += 1
+            if (
+                self._clean_request_count < self.policy.recovery_requests
+                or self.requests_per_minute >= self.policy.requests_per_minute
+            ):
+                return
+            self._clean_request_count = 0
+            self.requests_per_minute = min(
+                self.policy.requests_per_minute,
+                self.requests_per_minute + self.policy.requests_per_minute / 10,
+            )
+            self._bucket.set_rate(self.requests_per_minute / 60)
+        logger.info(
+            "Crawl rate of %s back to %.1f requests per minute",
+            self.domain,
+            self.requests_per_minute,
+        )
+
+    def slow_down(self, reason: str) -> None:
+        """Lowers the rate of the requests to the domain and pauses them"""
+        with self._lock:
+            self._clean_request_count = 0
+            self.slowdown_count += 1
+            self.requests_per_minute = max(
+                self.policy.min_requests_per_minute,
+                self.requests_per_minute * self.policy.slowdown_factor,
+            )
+            self._bucket.set_rate(self.requests_per_minute / 60)
+        self._bucket.pause(self.policy.cooldown)
+        metrics.increment("crawl.slowdowns")
+        logger.warning(
+            "Slowing down the crawl of %s to %.1f requests per minute after a pause"
+            " of %gs: %s",
+            self.domain,
+            self.requests_per_minute,
+            self.policy.cooldown,
+            reason,
+        )
+
+    @property
+    def pages_per_minute(self) -> float | None:
+        """Achieved number of requests per minute, None before two requests"""
+        if self.page_count < 2 or self.last_request_at == self.started_at:
+            return None
+        return (self.page_count - 1) * 60 / (self.last_request_at - self.started_at)
+
+
+@dataclass
+class CrawlScheduler:
+    """Throttles the extractions per domain, sharing the limits of a domain between
+    all the extractions crawling it"""
+
+    policy: CrawlPolicy = field(default_factory=CrawlPolicy)
+    """Limits applied to each domain"""
+    domain_policies: Dict[str, CrawlPolicy] = field(default_factory=dict)
+    """Limits of specific domains, instead of `policy`"""
+    _throttles: Dict[str, DomainThrottle] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    def get_throttle(self, domain: str) -> DomainThrottle:
+        """Returns the throttle of a domain, created on first use"""
+        with self._lock:
+            if domain not in self._throttles:
+                self._throttles[domain] = DomainThrottle(
+                    domain, self.domain_policies.get(domain, self.policy)
+                )
+            return self._throttles[domain]
+
+    @contextmanager
+    def crawl(self, base_url: str) -> Iterator[DomainThrottle]:
+        """Holds a crawl slot of the domain of a URL for an extraction, to take
+        before borrowing a browser so that waiting extractions hold none
+
+        Args:
+            base_url (str): URL crawled by the extraction
+
+        Yields:
+            DomainThrottle: the throttle of the domain, to pass to the browser
+        """
+        with self.get_throttle(urlparse(base_url).netloc).slot() as throttle:
+            yield throttle
+
+    def log_report(self) -> None:
+        """Logs the requests and achieved pages per minute of each domain"""
+        for throttle in self._throttles.values():
+            pages_per_minute = throttle.pages_per_minute
+            if pages_per_minute is not None:
+                metrics.observe("crawl.pages_per_minute", pages_per_minute)
+            logger.info(
+                "Crawled %s: %d pages at %s pages per minute (limit %.1f), %d"
+                " slow-down(s), %.1fs waited for the rate limit",
+                throttle.domain,
+                throttle.page_count,
+                "n/a" if pages_per_minute is None else f"{pages_per_minute:.1f}",
+                throttle.requests_per_minute,
+                throttle.slowdown_count,
+                throttle.wait_seconds,
+                extra={
+                    "json_fields": {
+                        "domain": throttle.domain,
+                        "pages": throttle.page_count,
+                        "pages_per_minute": pages_per_minute,
+                        "slowdowns": throttle.slowdown_count,
+                    }
+                },
+            )
@@ -1,18 +1,163 @@
 """This module scrap offers from the comparator energie-info.fr by running different
 scenarios i.e. prospect profiles"""
 
+import json
+import os
+import random
 import time
-from dataclasses import dataclass
-from typing import List, Literal
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Dict, List, Literal
 from urllib.parse import urlparse
 
+import yaml
 from etl.data.raw_data_loading import BaseHtmlLoader
+from etl.extract.crawl_scheduling import DomainThrottle
 from etl.extract.selenium_setup import init_chrome_driver
-from etl.logging_setup import logger
+from etl.instrumentation import metrics
+from etl.logging_setup import LazyLogArg, logger
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.select import Select
 from selenium.webdriver.support.ui import WebDriverWait
 
+OFFER_COUNT_SCRIPT = """
+const products = document.querySelector("div.qc-comparateur_products");
+return products === null
+    ? -1
+    : products.querySelectorAll("article.qc-offer-card").length;
+"""
+"""Counts the offer cards of the results page in the browser, -1 if the products
+container is missing"""
+
+
+NEW_OFFER_CARDS_SCRIPT = """
+const cards = document.querySelectorAll(
+    "div.qc-comparateur_products article.qc-offer-card:not([data-etl-harvested])"
+);
+return Array.from(cards, (card) => {
+    const html = card.parentElement.outerHTML;
+    card.setAttribute("data-etl-harvested", "");
+    return html;
+});
+"""
+"""Returns the outer HTML of the offer cards appended since the previous call,
+marking them as harvested"""
+
+
+OFFER_FIELDS_SCRIPT = """
+const text = (element) => (element === null ? null : element.textContent);
+const cards = document.querySelectorAll(
+    "div.qc-comparateur_products article.qc-offer-card"
+);
+return Array.from(cards, (card) => {
+    const plan = card.parentElement;
+    const content = plan.querySelector("div.qc-offer-card_content");
+    return {
+        name: text(card.querySelector("h2.qc-heading-xs")),
+        details: text(plan.querySelector("div[id*='details']")),
+        operator_name: plan.getAttribute("data-operateur"),
+        price: text(plan.querySelector("b.qc-offer-card_price")),
+        internet_level: plan.getAttribute("data-internet"),
+        benefits: content === null ? null : Array.from(
+            content.querySelectorAll("li"), text
+        ),
+    };
+});
+"""
+"""Collects the raw text fields of the offer cards of the results page, see
+`MobilePhonePlan.from_offer_fields`"""
+
+
+RESOURCE_TIMING_BUFFER_SIZE = 1000
+"""Max number of resource timing entries kept by the page between two checks of
+the responses, the browser dropping the next ones (250 by default)"""
+RESPONSES_SCRIPT = """
+const [domain, includeNavigation, bufferSize] = arguments;
+const resources = performance.getEntriesByType("resource");
+// the entries read are cleared, so that the buffer never fills up
+performance.clearResourceTimings();
+performance.setResourceTimingBufferSize(bufferSize);
+const statuses = resources
+    .filter((entry) => new URL(entry.name).host === domain)
+    .map((entry) => entry.responseStatus || 0);
+const navigation = performance.getEntriesByType("navigation")[0];
+if (includeNavigation && navigation !== undefined) {
+    statuses.push(navigation.responseStatus || 0);
+}
+const captcha = document.querySelector(
+    "iframe[src*='captcha'], iframe[src*='challenge'], #captcha, .g-recaptcha,"
+    + " .h-captcha, #challenge-form"
+) !== null || /captcha|robot|just a moment/i.test(document.title);
+return {statuses: statuses, captcha: captcha};
+"""
+"""Returns the HTTP statuses of the responses of the crawled domain since the
+previous call (from the Resource Timing API, 0 when unknown), and whether the page
+shows a captcha"""
+
+
+class ExtractionAbortedError(RuntimeError):
+    """Raised when an extraction is aborted by its circuit breaker"""
+
+
+class IncompleteResultsError(ExtractionAbortedError):
+    """Raised when the results page fails its validation at the end of the
+    extraction"""
+
+
+@dataclass
+class ResultsValidation:
+    """Checks the results page is complete before ending the extraction"""
+
+    min_offer_count: int = 1
+    """Expected minimum number of offer cards of a complete results page"""
+    wait_timeout: float = 10.0
+    """Seconds to wait for the expected offer cards to be rendered"""
+
+
+@dataclass
+class RetryPolicy:
+    """How to retry a failed action, with an exponential backoff and full jitter"""
+
+    max_attempts: int = 1
+    """Max number of attempts of the action, 1 meaning no retry"""
+    initial_backoff: float = 1.0
+    """Max seconds to wait before the first retry"""
+    max_backoff: float = 30.0
+    """Max seconds to wait before any retry"""
+    backoff_multiplier: float = 2.0
+    """Growth factor of the max wait between two consecutive retries"""
+    wait_timeout: float = 10.0
+    """Seconds to wait for the element of the action to be present"""
+
+    def get_backoff(self, retry_number: int) -> float:
+        """Returns a random wait before the retry number `retry_number` (from 1)"""
+        max_wait = min(
+            self.max_backoff,
+            self.initial_backoff * self.backoff_multiplier ** (retry_number - 1),
+        )
+        return random.uniform(0, max_wait)
+
+
+@dataclass
+class OfferHarvesting:
+    """Harvests the offer cards lazily loaded by scrolling the results page or
+    clicking its "load more" button, capturing only the new cards at each round"""
+
+    load_more_locator_name: str | None = None
+    """Locator type of the "load more" button, the page is scrolled to its bottom
+    if None or if the button is not displayed"""
+    load_more_locator_value: str | None = None
+    """Locator value of the "load more" button"""
+    round_delay: float = 1.0
+    """Seconds to wait for new cards after scrolling or clicking"""
+    max_rounds: int = 50
+    """Max number of rounds of scrolling or clicking"""
+    stable_rounds: int = 2
+    """Number of consecutive rounds without new cards after which the harvesting
+    stops"""
+
 
 @dataclass
 class Action:
@@ -36,6 +181,123 @@ class Action:
         "css selector",
     ]
     locator_value: str
+    retry_policy: RetryPolicy = field(default_factory=RetryPolicy)
+    """How to retry the action when it fails"""
+
+    def __post_init__(self):
+        if isinstance(self.retry_policy, dict):
+            self.retry_policy = RetryPolicy(**self.retry_policy)
+
+
+@dataclass
+class ExtractionConfig:
+    """Configuration of an extraction"""
+
+    actions: List[Action]
+    """Sequence of actions filling the search form"""
+    max_consecutive_failures: int | None = None
+    """Number of consecutive failed actions after which the extraction is
+    aborted, None to never abort"""
+    profile: str | None = None
+    """Name of the prospect profile of the action sequence, its files being stored
+    in `YYYY/MM/DD/<profile>/<run_id>/`, None to store them in `YYYY/MM/DD/`"""
+    results_validation: ResultsValidation = field(default_factory=ResultsValidation)
+    """Validation of the results page at the end of the extraction"""
+    offer_harvesting: OfferHarvesting | None = None
+    """Harvesting of the lazily loaded offer cards, disabled if None"""
+    extract_offer_fields: bool = False
+    """Whether to collect the fields of the offer cards in the browser and save
+    them as JSON, which the transform step reads instead of the HTML"""
+
+
+def load_extraction_config(config_path: str) -> ExtractionConfig:
+    """Loads the configuration of an extraction from a YAML configuration file.
+    The optional `default_retry_policy` applies to the actions without their own
+    `retry_policy`.
+
+    Args:
+        config_path (str): path to the YAML configuration file defining action
+          sequences per prospect profile
+
+    Returns:
+        ExtractionConfig: the configuration of the extraction
+    """
+    if not os.path.exists(config_path):
+        logger.error("Config file not found at %s", config_path)
+        raise FileNotFoundError(f"Config file not found at {config_path}")
+    with open(config_path, mode="r", encoding="utf-8") as config_file:
+        config = yaml.load(config_file, Loader=yaml.SafeLoader)
+    default_retry_policy = config.get("default_retry_policy") or {}
+    actions = [
+        Action(**{"retry_policy": default_retry_policy, **action_config})
+        for action_config in config["action_sequence"]
+    ]
+    return ExtractionConfig(
+        actions=actions,
+        max_consecutive_failures=config.get("max_consecutive_failures"),
+        profile=config.get("profile"),
+        results_validation=ResultsValidation(**config.get("results_validation", {})),
+        offer_harvesting=(
+            OfferHarvesting(**config["offer_harvesting"])
+            if config.get("offer_harvesting") is not None
+            else None
+        ),
+        extract_offer_fields=config.get("extract_offer_fields", False),
+    )
+
+
+def load_action_sequence(config_path: str) -> List[Action]:
+    """Loads the sequence of actions to execute from a YAML configuration file
+
+    Args:
+        config_path (str): path to the YAML configuration file defining action
+          sequences per prospect profile
+
+    Returns:
+        List[Action]: the sequence of actions to execute
+    """
+    return load_extraction_config(config_path).actions
+
+
+@dataclass
+class ExtractionCheckpoint:
+    """Progress of an extraction, persisted after each action to resume a failed
+    extraction instead of starting it over"""
+
+    action_count: int
+    """Number of actions of the sequence"""
+    next_action_index: int = 0
+    """Index of the first action not completed yet"""
+    failed_action_index: int | None = None
+    """Index of the first failed action, if any"""
+    form_state: Dict[str, str | None] = field(default_factory=dict)
+    """Value applied by each completed action, by action label"""
+    action_timings: Dict[str, float] = field(default_factory=dict)
+    """Duration in seconds of each executed action, by action label"""
+    action_retries: Dict[str, int] = field(default_factory=dict)
+    """Number of retries of each executed action, by action label"""
+    aborted: bool = False
+    """Whether the extraction was aborted by its circuit breaker"""
+    completed: bool = False
+    """Whether the results page was validated and saved, failed actions (e.g. a
+    popup which did not show up) being tolerated if the page is valid"""
+    updated_at: str | None = None
+    """When the checkpoint was last saved"""
+
+    @property
+    def resume_action_index(self) -> int:
+        """Index of the action from which to resume the extraction"""
+        if self.failed_action_index is not None:
+            return self.failed_action_index
+        return self.next_action_index
+
+    def to_json(self) -> str:
+        self.updated_at = datetime.now().isoformat()
+        return json.dumps(asdict(self), indent=4, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, checkpoint_json: str) -> "ExtractionCheckpoint":
+        return cls(**json.loads(checkpoint_json))
 
 
 class DynamicSearchBrowser:
@@ -46,21 +308,119 @@ class DynamicSearchBrowser:
         form_actions: List[Action],
         data_loader: BaseHtmlLoader,
         base_url: str,
+        driver: webdriver.Chrome | None = None,
+        resume: bool = True,
+        max_consecutive_failures: int | None = None,
+        results_validation: ResultsValidation | None = None,
+        offer_harvesting: OfferHarvesting | None = None,
+        extract_offer_fields: bool = False,
+        throttle: DomainThrottle | None = None,
     ) -> None:
+        """
+        Args:
+            form_actions (List[Action]): the actions to fill the search form
+            data_loader (BaseHtmlLoader): loader saving the results page
+            base_url (str): URL of the search form
+            driver (webdriver.Chrome | None): web driver borrowed from a pool, left
+              open at the end of `run`. A new one is initialized and quit at the
+              end of `run` if not provided.
+            resume (bool): whether to resume from the checkpoint of a previous
+              extraction of the same day, skipping it if it was completed
+            max_consecutive_failures (int | None): number of consecutive failed
+              actions after which the extraction is aborted, None to never abort
+            results_validation (ResultsValidation | None): validation of the
+              results page at the end of the extraction, default one if None
+            offer_harvesting (OfferHarvesting | None): harvesting of the lazily
+              loaded offer cards after the validation, disabled if None
+            extract_offer_fields (bool): whether to collect the fields of the offer
+              cards in the browser and save them as JSON
+            throttle (DomainThrottle | None): rate limiter of the requests to the
+              domain of `base_url`, shared with the other extractions crawling
+              it, no rate limit if None
+        """
         self.base_url = base_url
         self.base_domain = urlparse(self.base_url).netloc
-        self.driver = init_chrome_driver()
+        self.owns_driver = driver is None
+        self._driver = driver
         self.actions = form_actions
         self.data_loader = data_loader
+        self.resume = resume
+        self.max_consecutive_failures = max_consecutive_failures
+        self.results_validation = results_validation or ResultsValidation()
+        self.offer_harvesting = offer_harvesting
+        self.extract_offer_fields = extract_offer_fields
+        self.throttle = throttle
+
+    @property
+    def driver(self) -> webdriver.Chrome:
+        """The web driver, initialized on first use so that skipped extractions
+        don't start a browser"""
+        if self._driver is None:
+            self._driver = init_chrome_driver()
+        return self._driver
+
+    def wait_for_request(self) -> None:
+        """Waits until the rate limit of the domain allows a new request, if any"""
+        if self.throttle is not None:
+            self.throttle.wait_for_request()
+
+    def check_responses(self, navigated: bool = False) -> None:
+        """Reports the HTTP statuses of the responses of the domain since the
+        previous check, and whether the page shows a captcha, to the throttle of
+        the domain, if any
+
+        Args:
+            navigated (bool): whether a new page was loaded since the previous
+              check, whose navigation response is reported as well
+        """
+        if self.throttle is None:
+            return
+        try:
+            responses = self.driver.execute_script(
+                RESPONSES_SCRIPT,
+                self.base_domain,
+                navigated,
+                RESOURCE_TIMING_BUFFER_SIZE,
+            )
+        except Exception as ex:
+            logger.debug(
+                "Could not check the responses of %s: %s", self.base_domain, ex
+            )
+            return
+        self.throttle.record_responses(responses["statuses"], responses["captcha"])
 
-    def execute_action(self, action: Action):
+    def load_checkpoint(self) -> ExtractionCheckpoint | None:
+        """Loads the checkpoint of a previous extraction of the same sequence of
+        actions, if any"""
+        try:
+            checkpoint_json = self.data_loader.load_checkpoint()
+            if checkpoint_json is None:
+                return None
+            checkpoint = ExtractionCheckpoint.from_json(checkpoint_json)
+        except Exception as ex:
+            logger.exception("Ignoring unreadable extraction checkpoint: %s", ex)
+            return None
+        if checkpoint.action_count != len(self.actions):
+            logger.warning(
+                "Ignoring checkpoint of a sequence of %d actions instead of %d",
+                checkpoint.action_count,
+                len(self.actions),
+            )
+            return None
+        return checkpoint
+
+    def execute_action(self, action: Action, skip_delay: bool = False):
         """execute a given action
 
         Args:
             action (Action): the action to execute
+            skip_delay (bool): whether to act without waiting for the delay of the
+              action, e.g. when replaying actions completed in a previous run
         """
-        time.sleep(action.delay)
-        WebDriverWait(self.driver, 10).until(
+        if not skip_delay:
+            time.sleep(action.delay)
+        self.wait_for_request()
+        WebDriverWait(self.driver, action.retry_policy.wait_timeout).until(
             EC.presence_of_element_located((action.locator_name, action.locator_value))
         )
         web_elt = self.driver.find_element(action.locator_name, action.locator_value)
@@ -70,7 +430,9 @@ class DynamicSearchBrowser:
         elif action.tag == "select":
             logger.debug("Select an option...")
             select = Select(web_elt)
-            logger.debug("Select options: %s", select.all_selected_options)
+            logger.debug(
+                "Select options: %s", LazyLogArg(lambda: select.all_selected_options)
+            )
             select.select_by_value(action.value)
         elif action.tag == "input" and action.type == "range":
             logger.debug("Set range input...")
@@ -78,7 +440,8 @@ class DynamicSearchBrowser:
             try:
                 logger.debug("Setting range input via JS to %s", action.value)
                 logger.debug(
-                    "Range input value before: %s", web_elt.get_attribute("value")
+                    "Range input value before: %s",
+                    LazyLogArg(lambda: web_elt.get_attribute("value")),
                 )
                 self.driver.execute_script(
                     f"arguments[0].value = {action.value};", web_elt
@@ -88,39 +451,296 @@ class DynamicSearchBrowser:
                     "arguments[0].dispatchEvent(new Event('input'));", web_elt
                 )
                 logger.debug(
-                    "Range input value after: %s", web_elt.get_attribute("value")
+                    "Range input value after: %s",
+                    LazyLogArg(lambda: web_elt.get_attribute("value")),
                 )
             except Exception as ex:
                 logger.exception(
                     "JS range set failed, falling back to send_keys: %s", ex
                 )
                 logger.debug(
-                    "Range input value before: %s", web_elt.get_attribute("value")
+                    "Range input value before: %s",
+                    LazyLogArg(lambda: web_elt.get_attribute("value")),
                 )
                 web_elt.send_keys(action.value)
                 logger.debug(
-                    "Range input value after: %s", web_elt.get_attribute("value")
+                    "Range input value after: %s",
+                    LazyLogArg(lambda: web_elt.get_attribute("value")),
                 )
         else:
             # self.driver.execute_script("arguments[0].scrollIntoView();", web_elt)
-            logger.debug("Click %s...", web_elt.tag_name)
+            logger.debug("Click %s...", LazyLogArg(lambda: web_elt.tag_name))
             web_elt.click()
+        self.check_responses()
+
+    def execute_action_with_retries(
+        self, action: Action, skip_delay: bool = False
+    ) -> int:
+        """execute a given action, retrying it according to its retry policy
+
+        Args:
+            action (Action): the action to execute
+            skip_delay (bool): whether to act without waiting for the delay of the
+              action
+
+        Returns:
+            int: the number of retries
+
+        Raises:
+            Exception: the error of the last attempt if all of them failed
+        """
+        policy = action.retry_policy
+        for attempt in range(1, policy.max_attempts + 1):
+            try:
+                # only the first attempt waits for the delay of the action
+                self.execute_action(action, skip_delay=skip_delay or attempt > 1)
+                return attempt - 1
+            except Exception as ex:
+                if attempt == policy.max_attempts:
+                    raise ex
+                backoff = policy.get_backoff(attempt)
+                logger.warning(
+                    "Attempt %d/%d of action %s failed (%s), retrying in %.1fs",
+                    attempt,
+                    policy.max_attempts,
+                    action.label,
+                    ex,
+                    backoff,
+                )
+                metrics.increment("action_retries")
+                time.sleep(backoff)
+
+    def count_offers(self) -> int:
+        """Counts the offer cards of the current page in the browser, which is
+        cheaper than parsing its source
+
+        Returns:
+            int: the number of offer cards, -1 if the products container is missing
+        """
+        return self.driver.execute_script(OFFER_COUNT_SCRIPT)
+
+    def validate_results(self) -> int | None:
+        """Waits for the results page to have the expected offer cards
+
+        Returns:
+            int | None: the number of offer cards, None if the page is incomplete
+        """
+        offer_counts = []
+
+        def has_expected_offers(_) -> bool:
+            offer_counts.append(self.count_offers())
+            return offer_counts[-1] >= self.results_validation.min_offer_count
+
+        try:
+            WebDriverWait(self.driver, self.results_validation.wait_timeout).until(
+                has_expected_offers
+            )
+        except TimeoutException:
+            logger.error(
+                "Incomplete results page: %s offer cards, expected at least %d",
+                offer_counts[-1] if offer_counts else "no",
+                self.results_validation.min_offer_count,
+            )
+            return None
+        return offer_counts[-1]
+
+    def load_more_offers(self) -> None:
+        """Clicks the "load more" button if displayed, scrolls to the bottom of the
+        page otherwise"""
+        harvesting = self.offer_harvesting
+        if harvesting.load_more_locator_name is not None:
+            buttons = self.driver.find_elements(
+                harvesting.load_more_locator_name, harvesting.load_more_locator_value
+            )
+            if buttons and buttons[0].is_displayed():
+                self.driver.execute_script("arguments[0].click();", buttons[0])
+                return
+        self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+
+    def harvest_offers(self) -> int:
+        """Loads more offers until their count stabilizes, saving only the newly
+        appended offer cards at each round instead of the whole page
+
+        Returns:
+            int: the number of harvested offer cards
+        """
+        harvesting = self.offer_harvesting
+        self.data_loader.delete_offer_fragments()
+        offer_count = 0
+        part_index = 0
+        rounds_without_new_offers = 0
+        for _ in range(harvesting.max_rounds):
+            fragments = self.driver.execute_script(NEW_OFFER_CARDS_SCRIPT)
+            metrics.increment("harvest_rounds")
+            if fragments:
+                self.data_loader.save_offer_fragments(part_index, fragments)
+                part_index += 1
+                offer_count += len(fragments)
+                rounds_without_new_offers = 0
+                logger.info("Harvested %d offer cards", offer_count)
+            else:
+                rounds_without_new_offers += 1
+                if rounds_without_new_offers >= harvesting.stable_rounds:
+                    break
+            self.wait_for_request()
+            self.load_more_offers()
+            time.sleep(harvesting.round_delay)
+            self.check_responses()
+        else:
+            logger.warning(
+                "Stopped harvesting after %d rounds, offers may be missing",
+                harvesting.max_rounds,
+            )
+        return offer_count
+
+    def quit_driver(self) -> None:
+        """Quits the browser started by the extraction, if any"""
+        if self.owns_driver and self._driver is not None:
+            self._driver.quit()  # ends the WebDriver application
+            self._driver = None
 
     def run(self):
         """runs the browser from filling the dynamic search form to getting the HTML
-        of results"""
-        self.driver.get(self.base_url)
-        action_count = 0
-        for action in self.actions:
-            logger.info("Executes %s", action)
+        of results.
+
+        The progress is checkpointed after each action. When resuming, the actions
+        completed by the previous run are replayed without their delays to restore
+        the form state, and the results page is only saved from the action that
+        failed in the previous run. The browser started by the extraction is quit
+        whether it succeeds or fails."""
+        try:
+            self._run()
+        finally:
+            # a failed extraction must not leave Chrome running, e.g. in a worker
+            self.quit_driver()
+
+    def _run(self):
+        """Runs the extraction, see `run`"""
+        previous_checkpoint = self.load_checkpoint() if self.resume else None
+        if previous_checkpoint is not None and previous_checkpoint.completed:
+            logger.info(
+                "Extraction already completed at %s, skipping it",
+                previous_checkpoint.updated_at,
+            )
+            metrics.increment("extractions_skipped")
+            return
+        resume_action_index = (
+            0
+            if previous_checkpoint is None
+            else previous_checkpoint.resume_action_index
+        )
+        if resume_action_index > 0:
+            logger.info(
+                "Resuming extraction at action %d/%d",
+                resume_action_index + 1,
+                len(self.actions),
+            )
+            metrics.increment("extractions_resumed")
+        checkpoint = ExtractionCheckpoint(action_count=len(self.actions))
+        consecutive_failures = 0
+        offer_count = None
+        # lists the run in the manifest so that a failed run can be resumed
+        self.data_loader.record_run()
+
+        self.wait_for_request()
+        with metrics.span("extract.load_base_url", log=True):
+            self.driver.get(self.base_url)
+        self.check_responses(navigated=True)
+        for action_index, action in enumerate(self.actions):
+            replayed = action_index < resume_action_index
+            logger.info("%s %s", "Replays" if replayed else "Executes", action)
+            start = time.perf_counter()
             try:
-                self.execute_action(action)
+                with metrics.span("extract.action", log=True):
+                    checkpoint.action_retries[action.label] = (
+                        self.execute_action_with_retries(action, skip_delay=replayed)
+                    )
+                metrics.increment("actions_succeeded")
+                consecutive_failures = 0
+                checkpoint.form_state[action.label] = action.value
+                if checkpoint.failed_action_index is None:
+                    checkpoint.next_action_index = action_index + 1
             except Exception as ex:
+                metrics.increment("actions_failed")
+                consecutive_failures += 1
+                checkpoint.action_retries[action.label] = (
+                    action.retry_policy.max_attempts - 1
+                )
                 logger.exception("Error when executing action %s: %s", action, ex)
+                if checkpoint.failed_action_index is None:
+                    checkpoint.failed_action_index = action_index
+                if (
+                    self.max_consecutive_failures is not None
+                    and consecutive_failures >= self.max_consecutive_failures
+                ):
+                    checkpoint.aborted = True
             finally:
-                # Save after each action for debugging
-                html_content = self.driver.page_source
-                self.data_loader.save_results(html_content)
-                action_count += 1
-        self.driver.close()  # terminates the loaded browser window
-        self.driver.quit()  # ends the WebDriver application
+                checkpoint.action_timings[action.label] = time.perf_counter() - start
+                if not replayed:
+                    # Save after each action for debugging
+                    with metrics.span("extract.page_source"):
+                        html_content = self.driver.page_source
+                    with metrics.span("extract.save_results"):
+                        self.data_loader.save_results(html_content)
+                self.data_loader.save_checkpoint(checkpoint.to_json())
+            if checkpoint.aborted:
+                break
+        if checkpoint.aborted:
+            self.data_loader.flush()
+            metrics.increment("extractions_aborted")
+            raise ExtractionAbortedError(
+                f"Extraction aborted after {consecutive_failures} consecutive failed"
+                f" actions, the last one being {action.label}"
+            )
+        if checkpoint.failed_action_index is not None:
+            # e.g. a popup which did not show up: the results page decides
+            logger.warning(
+                "Action %s failed, checking the results page anyway",
+                self.actions[checkpoint.failed_action_index].label,
+            )
+        with metrics.span("extract.validate_results", log=True):
+            offer_count = self.validate_results()
+        if offer_count is None:
+            if checkpoint.failed_action_index is None:
+                # resuming replays the form and runs the last action again
+                checkpoint.failed_action_index = len(self.actions) - 1
+            self.data_loader.save_checkpoint(checkpoint.to_json())
+            self.data_loader.flush()
+            metrics.increment("extractions_incomplete")
+            raise IncompleteResultsError(
+                "The results page does not have the expected offer cards, resume"
+                " at action"
+                f" {self.actions[checkpoint.failed_action_index].label}"
+            )
+        if self.offer_harvesting is not None:
+            with metrics.span("extract.harvest_offers", log=True):
+                offer_count = self.harvest_offers()
+        if self.extract_offer_fields:
+            with metrics.span("extract.offer_fields", log=True):
+                offer_fields = self.driver.execute_script(OFFER_FIELDS_SCRIPT)
+                self.data_loader.save_offer_fields(json.dumps(offer_fields))
+            offer_count = len(offer_fields)
+        metrics.increment("offers_extracted", offer_count)
+        if self.offer_harvesting is None:
+            # the page may have rendered more offers since the last action
+            self.data_loader.save_results(self.driver.page_source)
+        # else the harvested parts hold the offer cards, read by the transform step
+        # instead of results.html, and serializing the whole page is avoided
+        self.data_loader.save_results_metadata(
+            json.dumps(
+                {
+                    "offer_count": offer_count,
+                    "validated_at": datetime.now().isoformat(),
+                }
+            )
+        )
+        # the validated results page completes the run, even if actions failed
+        checkpoint.completed = True
+        self.data_loader.save_checkpoint(checkpoint.to_json())
+        # wait for the background uploads of the results page
+        self.data_loader.flush()
+        self.data_loader.record_run(
+            offer_count=offer_count,
+            timings=checkpoint.action_timings,
+            completed=checkpoint.completed,
+        )
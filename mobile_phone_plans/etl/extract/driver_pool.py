@@ -0,0 +1,82 @@
+"""This module provides a pool of Chrome web drivers shared by the extractions
+running concurrently, to bound the number of browsers and reuse warm ones."""
+
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from etl.extract.selenium_setup import DEFAULT_REMOTE_DEBUGGING_PORT, init_chrome_driver
+from etl.logging_setup import logger
+from selenium import webdriver
+
+
+class ChromeDriverPool:
+    """Bounded pool of Chrome web drivers, initialized lazily"""
+
+    def __init__(self, max_size: int) -> None:
+        """
+        Args:
+            max_size (int): max number of browsers running at the same time
+        """
+        if max_size < 1:
+            raise ValueError(f"Driver pool size must be positive, got {max_size}")
+        self.max_size = max_size
+        self._idle_drivers: queue.LifoQueue = queue.LifoQueue()
+        self._all_drivers: List[webdriver.Chrome] = []
+        self._started_count = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _get_or_create_driver(self) -> webdriver.Chrome:
+        try:
+            return self._idle_drivers.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                # distinct ports, even when replacing a discarded driver
+                port = DEFAULT_REMOTE_DEBUGGING_PORT + self._started_count
+                self._started_count += 1
+            driver = init_chrome_driver(remote_debugging_port=port)
+            with self._lock:
+                self._all_drivers.append(driver)
+            logger.info(
+                "Driver pool: %d/%d browser(s) started",
+                len(self._all_drivers),
+                self.max_size,
+            )
+            return driver
+
+    @contextmanager
+    def acquire(self) -> Iterator[webdriver.Chrome]:
+        """Borrows a driver from the pool, waiting for one to be released if all
+        of them are busy. The cookies of the driver are cleared when it is given
+        back so that each extraction starts from a fresh session."""
+        self._slots.acquire()
+        driver = None
+        try:
+            driver = self._get_or_create_driver()
+            yield driver
+        finally:
+            if driver is not None:
+                try:
+                    driver.delete_all_cookies()
+                    self._idle_drivers.put(driver)
+                except Exception as ex:
+                    logger.exception("Discarding broken driver: %s", ex)
+                    self._quit_driver(driver)
+            self._slots.release()
+
+    def _quit_driver(self, driver: webdriver.Chrome) -> None:
+        with self._lock:
+            if driver in self._all_drivers:
+                self._all_drivers.remove(driver)
+        try:
+            driver.quit()
+        except Exception as ex:
+            logger.exception("Error when quitting driver: %s", ex)
+
+    def close(self) -> None:
+        """Quits all the drivers of the pool"""
+        for driver in list(self._all_drivers):
+            self._quit_driver(driver)
+        logger.info("Driver pool closed")
@@ -7,10 +7,18 @@ from etl.logging_setup import logger
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 
+DEFAULT_REMOTE_DEBUGGING_PORT = 9222
 
-def init_chrome_driver() -> webdriver.Chrome:
+
+def init_chrome_driver(
+    remote_debugging_port: int = DEFAULT_REMOTE_DEBUGGING_PORT,
+) -> webdriver.Chrome:
     """Init Chrome web driver
 
+    Args:
+        remote_debugging_port (int): remote debugging port of Chrome, which must
+          be distinct for browsers running concurrently
+
     Returns:
         webdriver.Chrome: the initialized web driver
     """
@@ -30,7 +38,7 @@ def init_chrome_driver() -> webdriver.Chrome:
     logger.debug("Using temporary Chrome user data dir at %s", tmp_user_dir)
     chrome_options.add_argument(f"--user-data-dir={tmp_user_dir}")
     # Optional, but sometimes helps
-    chrome_options.add_argument("--remote-debugging-port=9222")
+    chrome_options.add_argument(f"--remote-debugging-port={remote_debugging_port}")
     try:
         driver = webdriver.Chrome(options=chrome_options)
         logger.info("Chrome Web driver initialized")
@@ -0,0 +1,243 @@
+"""This module provides a lightweight instrumentation surface for the ETL
+pipeline: timing spans, counters and histograms collected per run and emitted as
+a JSON metrics file next to the artifacts and as structured log fields.
+
+The metrics are recorded through `metrics`, which records them in the registry of
+the enclosing `scoped_metrics` block, e.g. of one of the concurrent jobs of a
+worker, and in the registry of the process otherwise."""
+
+import functools
+import json
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List
+
+from etl.logging_setup import logger
+
+DURATION_SUFFIX = ".duration_seconds"
+HISTOGRAM_RESERVOIR_SIZE = 1024
+"""Max number of observations kept per histogram to compute its percentiles"""
+
+
+def _percentile(sorted_values: List[float], percentile: float) -> float:
+    """Returns the percentile of already sorted values (nearest-rank method)"""
+    rank = max(math.ceil(percentile / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+@dataclass
+class Histogram:
+    """Exact count, sum, min and max of the observations of a histogram, and a
+    uniform sample of them of bounded size to estimate its percentiles, so that
+    the memory used does not grow with the number of observations"""
+
+    count: int = 0
+    """Number of observations"""
+    sum: float = 0.0
+    """Sum of the observations"""
+    min: float = math.inf
+    """Smallest observation"""
+    max: float = -math.inf
+    """Largest observation"""
+    reservoir: List[float] = field(default_factory=list)
+    """Uniform sample of the observations (reservoir sampling)"""
+
+    def add(self, value: float) -> None:
+        """Records an observation"""
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self.reservoir) < HISTOGRAM_RESERVOIR_SIZE:
+            self.reservoir.append(value)
+            return
+        index = random.randrange(self.count)
+        if index < HISTOGRAM_RESERVOIR_SIZE:
+            self.reservoir[index] = value
+
+    def summary(self) -> Dict[str, float]:
+        """Returns the statistics of the histogram, its percentiles being exact
+        up to `HISTOGRAM_RESERVOIR_SIZE` observations and estimated beyond"""
+        sorted_values = sorted(self.reservoir)
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.sum / self.count,
+            "p50": _percentile(sorted_values, 50),
+            "p95": _percentile(sorted_values, 95),
+        }
+
+
+@dataclass
+class MetricsRegistry:
+    """Collects the counters and histograms of an ETL run"""
+
+    counters: Dict[str, float] = field(default_factory=dict)
+    """Monotonic counters, e.g. number of plans parsed or bytes uploaded"""
+    histograms: Dict[str, Histogram] = field(default_factory=dict)
+    """Observed values per histogram name, e.g. span durations"""
+    started_at: datetime = field(default_factory=datetime.now)
+    """When the metrics collection started"""
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    def reset(self) -> None:
+        """Clears all the collected metrics"""
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started_at = datetime.now()
+
+    def increment(self, name: str, value: float = 1) -> None:
+        """Increments the counter `name` by `value`"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        """Records the observation `value` in the histogram `name`"""
+        with self._lock:
+            self.histograms.setdefault(name, Histogram()).add(value)
+
+    @contextmanager
+    def span(self, name: str, log: bool = False) -> Iterator[None]:
+        """Times the enclosed block and records its duration in the histogram
+        `<name>.duration_seconds`
+
+        Args:
+            name (str): name of the span, e.g. "transform.parse_html"
+            log (bool): whether to log the duration as a structured log entry
+              (keep it False for spans in tight loops)
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.observe(f"{name}{DURATION_SUFFIX}", duration)
+            if log:
+                logger.info(
+                    "Span %s took %.3f seconds",
+                    name,
+                    duration,
+                    extra={"json_fields": {"span": name, "duration": duration}},
+                )
+
+    def timed(self, name: str, log: bool = False) -> Callable:
+        """Decorator timing each call of the decorated function as a span
+
+        Args:
+            name (str): name of the span
+            log (bool): whether to log the duration as a structured log entry
+        """
+
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name, log=log):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def summary(self) -> Dict[str, Any]:
+        """Returns a JSON serializable summary of the collected metrics"""
+        with self._lock:
+            histograms = {
+                name: histogram.summary() for name, histogram in self.histograms.items()
+            }
+            return {
+                "started_at": self.started_at.isoformat(),
+                "ended_at": datetime.now().isoformat(),
+                "counters": dict(self.counters),
+                "histograms": histograms,
+            }
+
+    def to_json(self) -> str:
+        """Returns the summary of the collected metrics as a JSON string"""
+        return json.dumps(self.summary(), indent=4, ensure_ascii=False)
+
+    def log_summary(self, etl_step: str) -> None:
+        """Logs the summary of the collected metrics as structured log fields
+
+        Args:
+            etl_step (str): the ETL step the metrics were collected for
+        """
+        summary = self.summary()
+        logger.info(
+            "Metrics of ETL step %s: %s",
+            etl_step,
+            json.dumps(summary["counters"]),
+            extra={"json_fields": {"etl_step": etl_step, "metrics": summary}},
+        )
+
+
+process_metrics = MetricsRegistry()
+"""Metrics registry of the process, recording the metrics outside of any
+`scoped_metrics` block"""
+_scoped_metrics: ContextVar[MetricsRegistry | None] = ContextVar(
+    "scoped_metrics", default=None
+)
+
+
+def current_metrics() -> MetricsRegistry:
+    """Returns the registry of the enclosing `scoped_metrics` block, the registry
+    of the process if there is none"""
+    registry = _scoped_metrics.get()
+    return process_metrics if registry is None else registry
+
+
+@contextmanager
+def scoped_metrics(registry: MetricsRegistry) -> Iterator[MetricsRegistry]:
+    """Records the metrics of the enclosed block in `registry` instead of the
+    registry of the process. The scope follows the context of the block: the
+    threads it starts only record in `registry` when run in a copy of its context,
+    see `contextvars.copy_context`
+
+    Args:
+        registry (MetricsRegistry): registry recording the metrics of the block
+    """
+    token = _scoped_metrics.set(registry)
+    try:
+        yield registry
+    finally:
+        _scoped_metrics.reset(token)
+
+
+class CurrentMetricsRegistry:
+    """Proxy of the registry returned by `current_metrics`, resolved at each call"""
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(current_metrics(), name)
+
+    def timed(self, name: str, log: bool = False) -> Callable:
+        """Decorator timing each call of the decorated function as a span of the
+        registry current at the time of the call
+
+        Args:
+            name (str): name of the span
+            log (bool): whether to log the duration as a structured log entry
+        """
+
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with current_metrics().span(name, log=log):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+
+metrics = CurrentMetricsRegistry()
+"""Metrics registry of the current ETL run or job"""
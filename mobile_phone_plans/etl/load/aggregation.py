@@ -0,0 +1,139 @@
+"""This module aggregates the plans of a scraping date into the daily summary
+tables read by the dashboards, per operator and internet level, so that their
+queries read a few rows per day instead of scanning the history of the plans."""
+
+import math
+import re
+import statistics
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Tuple
+
+PRICE_PATTERN = re.compile(r"\d+(?:[.,]\d+)?")
+DATA_VOLUME_PATTERN = re.compile(r"(\d+(?:[.,]\d+)?)\s*([kKMGT]o)\b")
+UNLIMITED_PATTERN = re.compile(r"illimit", re.IGNORECASE)
+DATA_VOLUME_UNITS_IN_GB = {"ko": 1e-6, "Ko": 1e-6, "Mo": 1e-3, "Go": 1.0, "To": 1e3}
+DATA_VOLUME_BUCKETS: List[Tuple[str, float]] = [
+    ("<1Go", 1),
+    ("1-10Go", 10),
+    ("10-50Go", 50),
+    ("50-100Go", 100),
+    ("100Go+", math.inf),
+]
+"""Data volume buckets with their exclusive upper bound in GB"""
+UNLIMITED_DATA_VOLUME_BUCKET = "unlimited"
+UNKNOWN_DATA_VOLUME_BUCKET = "unknown"
+
+
+def parse_price(price: str | None) -> float | None:
+    """Parses a monthly price as displayed on the offer cards, e.g. "2,99 € /mois",
+    None if it has no number"""
+    match = PRICE_PATTERN.search(price or "")
+    if match is None:
+        return None
+    return float(match.group().replace(",", "."))
+
+
+def parse_data_volume(internet_data: str | None) -> float | None:
+    """Parses an internet data volume in GB, e.g. 0.1 for "100 Mo", infinity for
+    unlimited data, None if it has no volume"""
+    if internet_data is None:
+        return None
+    match = DATA_VOLUME_PATTERN.search(internet_data)
+    if match is not None:
+        value, unit = match.groups()
+        return float(value.replace(",", ".")) * DATA_VOLUME_UNITS_IN_GB[unit]
+    if UNLIMITED_PATTERN.search(internet_data):
+        return math.inf
+    return None
+
+
+def get_data_volume_bucket(internet_data: str | None) -> str:
+    """Returns the bucket of an internet data volume"""
+    data_volume = parse_data_volume(internet_data)
+    if data_volume is None:
+        return UNKNOWN_DATA_VOLUME_BUCKET
+    if data_volume == math.inf:
+        return UNLIMITED_DATA_VOLUME_BUCKET
+    for bucket, upper_bound in DATA_VOLUME_BUCKETS:
+        if data_volume < upper_bound:
+            return bucket
+    return UNKNOWN_DATA_VOLUME_BUCKET
+
+
+def summarize_prices(prices: List[float]) -> Dict[str, float | None]:
+    """Returns the min, average, median and max of the known prices"""
+    if not prices:
+        return {
+            "min_price": None,
+            "avg_price": None,
+            "median_price": None,
+            "max_price": None,
+        }
+    return {
+        "min_price": min(prices),
+        "avg_price": round(statistics.fmean(prices), 2),
+        "median_price": statistics.median(prices),
+        "max_price": max(prices),
+    }
+
+
+def aggregate_daily_summaries(
+    table_rows: Iterable[Dict[str, Any]],
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Aggregates the plans of a scraping date into the rows of the daily summary
+    tables
+
+    Args:
+        table_rows (Iterable[Dict[str, Any]]): rows of the plans table, with
+          the `scraping_date`, `operator_name`, `internet_level`, `price` and
+          `internet_data_included` columns
+
+    Returns:
+        Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]: the rows per scraping
+          date, operator and internet level, and the rows per scraping date,
+          operator, internet level and data volume bucket
+    """
+    offer_counts: Dict[Tuple, int] = defaultdict(int)
+    prices: Dict[Tuple, List[float]] = defaultdict(list)
+    bucket_offer_counts: Dict[Tuple, int] = defaultdict(int)
+    bucket_prices: Dict[Tuple, List[float]] = defaultdict(list)
+    for row in table_rows:
+        key = (row["scraping_date"], row["operator_name"], row["internet_level"])
+        bucket_key = (*key, get_data_volume_bucket(row["internet_data_included"]))
+        offer_counts[key] += 1
+        bucket_offer_counts[bucket_key] += 1
+        price = parse_price(row["price"])
+        if price is not None:
+            prices[key].append(price)
+            bucket_prices[bucket_key].append(price)
+
+    updated_at = datetime.now()
+    summary_rows = []
+    for key, offer_count in offer_counts.items():
+        scraping_date, operator_name, internet_level = key
+        summary_rows.append(
+            {
+                "scraping_date": scraping_date,
+                "operator_name": operator_name,
+                "internet_level": internet_level,
+                "offer_count": offer_count,
+                **summarize_prices(prices[key]),
+                "updated_at": updated_at,
+            }
+        )
+    bucket_rows = []
+    for key, offer_count in bucket_offer_counts.items():
+        scraping_date, operator_name, internet_level, data_volume_bucket = key
+        bucket_rows.append(
+            {
+                "scraping_date": scraping_date,
+                "operator_name": operator_name,
+                "internet_level": internet_level,
+                "data_volume_bucket": data_volume_bucket,
+                "offer_count": offer_count,
+                "min_price": min(bucket_prices[key], default=None),
+                "updated_at": updated_at,
+            }
+        )
+    return summary_rows, bucket_rows
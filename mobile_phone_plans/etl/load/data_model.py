@@ -2,7 +2,7 @@
 
 import uuid
 
-from sqlalchemy import Column, DateTime, String
+from sqlalchemy import Column, DateTime, Float, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 
 # --- Step 1: Define ORM Model ---
@@ -23,3 +23,34 @@ class MobilePhonePlanDatabaseTable(Base):
     sms_included = Column(String, nullable=False)
     mms_included = Column(String, nullable=True)
     internet_data_included = Column(String, nullable=True)
+
+
+class MobilePhonePlanDailySummaryTable(Base):
+    """Plans of a scraping date per operator and internet level"""
+
+    __tablename__ = "tbl_mobile_phone_plans_daily_summary"
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    scraping_date = Column(DateTime, nullable=False)
+    operator_name = Column(String, nullable=False)
+    internet_level = Column(String, nullable=True)
+    offer_count = Column(Integer, nullable=False)
+    min_price = Column(Float, nullable=True)
+    avg_price = Column(Float, nullable=True)
+    median_price = Column(Float, nullable=True)
+    max_price = Column(Float, nullable=True)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class MobilePhonePlanDailyDataVolumeTable(Base):
+    """Plans of a scraping date per operator, internet level and data volume
+    bucket"""
+
+    __tablename__ = "tbl_mobile_phone_plans_daily_data_volume"
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    scraping_date = Column(DateTime, nullable=False)
+    operator_name = Column(String, nullable=False)
+    internet_level = Column(String, nullable=True)
+    data_volume_bucket = Column(String, nullable=False)
+    offer_count = Column(Integer, nullable=False)
+    min_price = Column(Float, nullable=True)
+    updated_at = Column(DateTime, nullable=False)
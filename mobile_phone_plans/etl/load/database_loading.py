@@ -0,0 +1,359 @@
+"""This module defines the abstract class for loading transformed daily mobile
+phone plans data into a SQL database with SQLAlchemy."""
+
+import abc
+import os
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Set, Tuple, Type
+
+from etl.data.transformed_data_loading import BaseJsonLoader
+from etl.instrumentation import metrics
+from etl.load.aggregation import aggregate_daily_summaries
+from etl.load.data_model import (
+    Base,
+    MobilePhonePlanDailyDataVolumeTable,
+    MobilePhonePlanDailySummaryTable,
+    MobilePhonePlanDatabaseTable,
+)
+from etl.load.schema import check_schema, migrate_schema
+from etl.logging_setup import logger
+from google.api_core.exceptions import NotFound
+from sqlalchemy import DateTime, Table, delete, insert
+from sqlalchemy.engine import Connection, Engine
+from tqdm import tqdm
+
+DEFAULT_INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", "500"))
+"""Default number of rows sent per INSERT statement"""
+GENERATED_COLUMN_NAMES = {"id", "inserted_at"}
+"""Names of the table columns not read from the transformed plans"""
+
+_engines: Dict[Tuple, Engine] = {}
+"""Engines of the process, by target database and credentials"""
+_checked_schemas: Set[Tuple] = set()
+"""Target databases and tables whose schema was checked by the process"""
+_engines_lock = threading.Lock()
+
+
+def parse_datetime(value: Any) -> datetime | None:
+    """Parses an ISO formatted datetime as written in the JSON-line files"""
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+def dispose_engines() -> None:
+    """Closes the connections of the engines of the process and forgets them"""
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+        _checked_schemas.clear()
+
+
+@dataclass
+class BaseDatabaseLoader(abc.ABC):
+    """Abstract base class to load plans into a SQL database. It uses SQLAlchemy to
+    interact with the database."""
+
+    transformed_data_loader: BaseJsonLoader
+    """Loader of the transformed plans to insert"""
+    insert_batch_size: int = field(default=DEFAULT_INSERT_BATCH_SIZE, kw_only=True)
+    """Number of rows sent per INSERT statement"""
+    table_model: Type[Base] = field(default=MobilePhonePlanDatabaseTable, kw_only=True)
+    """ORM model of the target table, with `scraping_date` and `inserted_at`
+    columns and the other columns named as the fields of the transformed plans"""
+    aggregate_daily_summaries: bool = field(default=True, kw_only=True)
+    """Whether to refresh the daily summary tables after the insertion, for
+    target tables with the columns of `MobilePhonePlanDatabaseTable`"""
+
+    use_multi_values_insert = False
+    """Whether to send each batch as one multi-values INSERT statement, for
+    databases whose DB-API `executemany` runs one statement per row"""
+
+    @property
+    @abc.abstractmethod
+    def database_name(self) -> str:
+        """Human readable name of the target database, used in logs"""
+
+    @property
+    def table(self) -> Table:
+        """Core table of the plans, to insert rows without ORM objects"""
+        return self.table_model.__table__
+
+    @property
+    @abc.abstractmethod
+    def engine_key(self) -> Tuple:
+        """Identifies the target database and its credentials, the engines being
+        shared by the loaders of the process with the same key"""
+
+    @property
+    def tables(self) -> List[Table]:
+        """Core tables written by the loader"""
+        if not self.aggregate_daily_summaries:
+            return [self.table]
+        return [
+            self.table,
+            MobilePhonePlanDailySummaryTable.__table__,
+            MobilePhonePlanDailyDataVolumeTable.__table__,
+        ]
+
+    @abc.abstractmethod
+    def create_engine(self) -> Engine:
+        """Creates the SQLAlchemy engine connected to the target database
+
+        Returns:
+            Engine: the SQLAlchemy engine
+        """
+
+    def get_engine(self) -> Engine:
+        """Returns the engine of the process connected to the target database,
+        created on first use, so that e.g. the days of a backfill reuse its
+        connections instead of creating a new client per day
+
+        Returns:
+            Engine: the SQLAlchemy engine
+        """
+        with _engines_lock:
+            if self.engine_key not in _engines:
+                _engines[self.engine_key] = self.create_engine()
+            return _engines[self.engine_key]
+
+    def ensure_schema(self, engine: Engine) -> None:
+        """Checks the schema of the tables once per process, instead of querying
+        the metadata of the database at each load. The missing tables are
+        created, while the missing columns are added by `etl migrate`.
+
+        Args:
+            engine (Engine): engine connected to the target database
+
+        Raises:
+            SchemaMismatchError: if existing tables lack columns
+        """
+        schema_key = (self.engine_key, *(table.name for table in self.tables))
+        with _engines_lock:
+            if schema_key in _checked_schemas:
+                return
+            with metrics.span("load.check_schema", log=True):
+                check_schema(engine, self.tables)
+            _checked_schemas.add(schema_key)
+
+    def migrate(self, dry_run: bool = False) -> List[str]:
+        """Creates the missing tables and adds the missing nullable columns of the
+        existing ones, see `etl migrate`
+
+        Args:
+            dry_run (bool): whether to only return the statements without running
+              them
+
+        Returns:
+            List[str]: the DDL statements of the migration
+        """
+        return migrate_schema(self.get_engine(), self.tables, dry_run=dry_run)
+
+    def flatten_plans_to_table_dicts(
+        self,
+        plans: List[Dict[str, Any]],
+    ) -> List[Dict[str, Any]]:
+        """Flatten and format plans data to match the table structure as plain
+        dicts, ready for a Core `insert()` without ORM objects"""
+        inserted_at = datetime.now()
+        columns = [
+            column
+            for column in self.table.columns
+            if column.name not in GENERATED_COLUMN_NAMES
+        ]
+        datetime_column_names = [
+            column.name for column in columns if isinstance(column.type, DateTime)
+        ]
+        other_column_names = [
+            column.name for column in columns if not isinstance(column.type, DateTime)
+        ]
+        return [
+            {
+                "inserted_at": inserted_at,
+                **{
+                    name: parse_datetime(plan.get(name))
+                    for name in datetime_column_names
+                },
+                **{name: plan.get(name) for name in other_column_names},
+            }
+            for plan in plans
+        ]
+
+    def flatten_plans_to_table_rows(
+        self,
+        plans: List[Dict[str, Any]],
+    ) -> List[Base]:
+        """Flatten and format plans data to match the table structure as ORM
+        objects of `table_model`. Slower than `flatten_plans_to_table_dicts`, kept
+        for ORM based use cases and benchmarks."""
+        table_rows = []
+        inserted_at = datetime.now()
+        columns = [
+            column
+            for column in self.table.columns
+            if column.name not in GENERATED_COLUMN_NAMES
+        ]
+        for plan in tqdm(
+            plans, desc=f"Flattening plans for {self.database_name} insertion..."
+        ):
+            # instantiate model and assign flattened attributes explicitly
+            plan_table_row = self.table_model()
+            plan_table_row.inserted_at = inserted_at
+            for column in columns:
+                value = plan.get(column.name)
+                if isinstance(column.type, DateTime):
+                    value = parse_datetime(value)
+                setattr(plan_table_row, column.name, value)
+
+            table_rows.append(plan_table_row)
+        return table_rows
+
+    def insert_plans(self) -> None:
+        """Format and load plans scraped on the same date (scraping_date)
+        to the database"""
+        with metrics.span("load.load_plans", log=True):
+            transformed_plans = self.transformed_data_loader.load_daily_plans()
+        with metrics.span("load.flatten_plans", log=True):
+            plans_table_rows = self.flatten_plans_to_table_dicts(transformed_plans)
+        self.replace_table_rows(plans_table_rows)
+
+    def insert_plans_range(
+        self, transformed_data_loaders: List[BaseJsonLoader]
+    ) -> None:
+        """Format and load the plans of several scraping dates, e.g. of a backfill,
+        replacing the rows of these dates in a single transaction (on SQLite, see
+        `replace_table_rows`). The dates without transformed plans are skipped.
+
+        Args:
+            transformed_data_loaders (List[BaseJsonLoader]): loaders of the
+              transformed plans of the scraping dates
+        """
+        transformed_plans = []
+        with metrics.span("load.load_plans", log=True):
+            for transformed_data_loader in transformed_data_loaders:
+                try:
+                    transformed_plans.extend(transformed_data_loader.load_daily_plans())
+                except (FileNotFoundError, NotFound):
+                    logger.warning(
+                        "No transformed plans for %s, skipping it",
+                        transformed_data_loader.scraping_date.date(),
+                    )
+        with metrics.span("load.flatten_plans", log=True):
+            plans_table_rows = self.flatten_plans_to_table_dicts(transformed_plans)
+        self.replace_table_rows(plans_table_rows)
+
+    def replace_table_rows(self, plans_table_rows: List[Dict[str, Any]]) -> None:
+        """Replaces the rows of the scraping dates of the given rows, and their
+        daily summaries, in a single transaction on SQLite. BigQuery runs each
+        statement in its own transaction through this engine: a failure after the
+        plans are replaced leaves the summaries of their dates stale, until the
+        dates are loaded again, which rebuilds them
+
+        Args:
+            plans_table_rows (List[Dict[str, Any]]): rows to insert as dicts
+        """
+        if not plans_table_rows:
+            logger.warning("No plans to insert.")
+            return
+        engine = self.get_engine()
+        self.ensure_schema(engine)
+        scraping_dates = sorted({row["scraping_date"] for row in plans_table_rows})
+        try:
+            with engine.begin() as connection:
+                logger.info(
+                    "Deleting existing rows of %d scraping date(s) from %s to %s"
+                    " before insertion...",
+                    len(scraping_dates),
+                    scraping_dates[0],
+                    scraping_dates[-1],
+                )
+                deleted_count = connection.execute(
+                    delete(self.table).where(
+                        self.table.c.scraping_date.in_(scraping_dates)
+                    )
+                ).rowcount
+                logger.info("Deleted %d existing rows.", deleted_count)
+
+                logger.info(
+                    "Inserting %d rows into %s by batches of %d...",
+                    len(plans_table_rows),
+                    self.database_name,
+                    self.insert_batch_size,
+                )
+                with metrics.span("load.database_insert", log=True):
+                    self.insert_table_rows(connection, plans_table_rows)
+                if self.aggregate_daily_summaries:
+                    with metrics.span("load.aggregate_daily_summaries", log=True):
+                        self.refresh_daily_summaries(connection, plans_table_rows)
+            metrics.increment("rows_inserted", len(plans_table_rows))
+            logger.info(
+                "Inserted %d rows into %s table %s",
+                len(plans_table_rows),
+                self.database_name,
+                self.table.name,
+            )
+        except Exception as ex:
+            logger.exception(
+                "Error when loading to %s, reload the scraping dates from %s to %s"
+                " if their plans or summaries were partially replaced: %s",
+                self.database_name,
+                scraping_dates[0],
+                scraping_dates[-1],
+                ex,
+            )
+            raise ex
+
+    def insert_table_rows(
+        self, connection: Connection, table_rows: List[Dict[str, Any]]
+    ) -> None:
+        """Inserts table rows by batches of `insert_batch_size`, with one
+        multi-values INSERT statement per batch if `use_multi_values_insert`, or
+        with one `executemany` per batch otherwise
+
+        Args:
+            connection (Connection): connection to the database, within a
+              transaction
+            table_rows (List[Dict[str, Any]]): rows to insert as dicts
+        """
+        for start in range(0, len(table_rows), self.insert_batch_size):
+            end = start + self.insert_batch_size
+            batch = table_rows[start:end]
+            if self.use_multi_values_insert:
+                connection.execute(insert(self.table).values(batch))
+            else:
+                connection.execute(insert(self.table), batch)
+            metrics.increment("insert_batches")
+
+    def refresh_daily_summaries(
+        self, connection: Connection, table_rows: List[Dict[str, Any]]
+    ) -> None:
+        """Replaces the rows of the daily summary tables for the scraping dates of
+        the inserted rows, in the transaction of the insertion, so that on SQLite
+        the summaries never disagree with the plans. On BigQuery, they are rebuilt
+        by each load of the dates but not atomically with the plans
+
+        Args:
+            connection (Connection): connection to the database, within a
+              transaction
+            table_rows (List[Dict[str, Any]]): inserted rows as dicts
+        """
+        summary_rows, data_volume_rows = aggregate_daily_summaries(table_rows)
+        scraping_dates = {row["scraping_date"] for row in table_rows}
+        for summary_table, rows in [
+            (MobilePhonePlanDailySummaryTable.__table__, summary_rows),
+            (MobilePhonePlanDailyDataVolumeTable.__table__, data_volume_rows),
+        ]:
+            connection.execute(
+                delete(summary_table).where(
+                    summary_table.c.scraping_date.in_(scraping_dates)
+                )
+            )
+            if rows:
+                connection.execute(insert(summary_table).values(rows))
+            logger.info("Refreshed %d rows of %s", len(rows), summary_table.name)
+        metrics.increment(
+            "summary_rows_refreshed", len(summary_rows) + len(data_volume_rows)
+        )
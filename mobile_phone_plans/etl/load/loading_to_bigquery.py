@@ -2,121 +2,347 @@
 daily mobile phone plans data."""
 
 import os
+import uuid
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Any, Dict, List
+from datetime import datetime, time, timedelta
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
 
 from dotenv import load_dotenv
-from etl.data.transformed_data_loading import BaseJsonLoader
-from etl.load.data_model import Base, MobilePhonePlanDatabaseTable
+from etl.data.transformed_data_loading import (
+    BaseJsonLoader,
+    GoogleCloudStorageJsonLoader,
+)
+from etl.instrumentation import metrics
+from etl.load.database_loading import GENERATED_COLUMN_NAMES, BaseDatabaseLoader
 from etl.logging_setup import logger
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from tqdm import tqdm
+from sqlalchemy import DateTime, Float, Integer, Table, create_engine, inspect, text
+from sqlalchemy.engine import Engine
+
+if TYPE_CHECKING:
+    from google.cloud import bigquery
 
 load_dotenv()
 
 PROJECT_ID = os.getenv("PROJECT_ID")
 DATASET = os.getenv("DATASET")
+BIGQUERY_FIELD_TYPES = {DateTime: "DATETIME", Float: "FLOAT", Integer: "INTEGER"}
+"""BigQuery types of the loaded columns by SQLAlchemy type, STRING otherwise"""
+PARTITIONING_COLUMN_NAME = "scraping_date"
+"""Column whose day partitions the tables, so that the rows of the loaded dates
+are replaced without scanning the whole table"""
 
 
 @dataclass
-class BigQueryDataLoader:
+class BigQueryDataLoader(BaseDatabaseLoader):
     """Class to load data into BigQuery. It uses SQLAlchemy to interact with
     BigQuery."""
 
-    transformed_data_loader: BaseJsonLoader
     project_id: str
     dataset: str
     service_account_key_json_path: str
 
-    def flatten_plans_to_table_rows(
-        self,
-        plans: List[Dict[str, Any]],
-    ) -> List[MobilePhonePlanDatabaseTable]:
-        """Flatten and format plans data to match the table structure"""
-        table_rows = []
-        inserted_at = datetime.now()
-        for plan in tqdm(plans, desc="Flattening plans for BigQuery insertion..."):
-            # instantiate model and assign flattened attributes explicitly
-            plan_table_row = MobilePhonePlanDatabaseTable()
-            plan_table_row.scraping_date = plan.get("scraping_date")
-            plan_table_row.inserted_at = inserted_at
-            plan_table_row.name = plan.get("name")
-            plan_table_row.description = plan.get("description")
-            plan_table_row.operator_name = plan.get("operator_name")
-            plan_table_row.price = plan.get("price")
-            plan_table_row.internet_level = plan.get("internet_level")
-            plan_table_row.call_included = plan.get("call_included")
-            plan_table_row.sms_included = plan.get("sms_included")
-            plan_table_row.mms_included = plan.get("mms_included")
-            plan_table_row.internet_data_included = plan.get("internet_data_included")
-
-            table_rows.append(plan_table_row)
-        return table_rows
-
-    def insert_plans(self) -> None:
-        """Format and load plans scraped on the same date (scraping_date)
-        to BigQuery"""
-        transformed_plans = self.transformed_data_loader.load_plans()
-        plans_table_rows = self.flatten_plans_to_table_rows(transformed_plans)
-        if plans_table_rows:
-            logger.info(
-                "Create BigQuery engine with project ID %s and dataset %s",
-                self.project_id,
-                self.dataset,
+    # the BigQuery DB-API runs one query job per row on `executemany`
+    use_multi_values_insert = True
+
+    @property
+    def database_name(self) -> str:
+        return "BigQuery"
+
+    @property
+    def engine_key(self) -> Tuple:
+        return (
+            "bigquery",
+            self.project_id,
+            self.dataset,
+            self.service_account_key_json_path,
+        )
+
+    @property
+    def tables(self) -> List[Table]:
+        """Core tables written by the loader, partitioned by day of scraping date
+        when created"""
+        from google.cloud import bigquery
+
+        tables = super().tables
+        for table in tables:
+            if PARTITIONING_COLUMN_NAME in table.columns:
+                # dialect option of the BigQuery DDL, ignored by the other dialects
+                table.dialect_options["bigquery"]["time_partitioning"] = (
+                    bigquery.TimePartitioning(field=PARTITIONING_COLUMN_NAME)
+                )
+        return tables
+
+    def create_engine(self) -> Engine:
+        logger.info(
+            "Create BigQuery engine with project ID %s and dataset %s",
+            self.project_id,
+            self.dataset,
+        )
+        if not self.project_id or not self.dataset:
+            raise ValueError("Project ID or dataset not found")
+        if not self.service_account_key_json_path:
+            logger.warning(
+                "No service account key path provided." " Using default credentials"
+            )
+            return create_engine(f"bigquery://{self.project_id}/{self.dataset}")
+        logger.info(
+            "Using service account credentials at %s",
+            self.service_account_key_json_path,
+        )
+        return create_engine(
+            f"bigquery://{self.project_id}/{self.dataset}",
+            credentials_path=self.service_account_key_json_path,
+        )
+
+    def create_bigquery_client(self) -> "bigquery.Client":
+        """Creates a BigQuery client with the credentials of the engine, to submit
+        load jobs which the SQLAlchemy dialect does not support"""
+        # imported here as the load extra is not installed in the other images
+        from google.cloud import bigquery
+
+        if not self.service_account_key_json_path:
+            return bigquery.Client(project=self.project_id)
+        return bigquery.Client.from_service_account_json(
+            self.service_account_key_json_path, project=self.project_id
+        )
+
+    def get_staging_schema(self) -> List["bigquery.SchemaField"]:
+        """Returns the schema of the staging table: the columns of the plans table
+        read from the transformed plans"""
+        from google.cloud import bigquery
+
+        return [
+            bigquery.SchemaField(
+                column.name, BIGQUERY_FIELD_TYPES.get(type(column.type), "STRING")
+            )
+            for column in self.table.columns
+            if column.name not in GENERATED_COLUMN_NAMES
+        ]
+
+    def get_partitioning_statements(self, engine: Engine) -> List[str]:
+        """Returns the statements recreating the existing tables which are not
+        partitioned yet, partitioned by day of scraping date, as BigQuery cannot
+        partition an existing table
+
+        Args:
+            engine (Engine): engine connected to the target dataset
+
+        Returns:
+            List[str]: the DDL statements, copying each table to a partitioned one
+              which replaces it
+        """
+        existing_table_names = set(inspect(engine).get_table_names())
+        with engine.connect() as connection:
+            partitioned_table_names = set(
+                connection.execute(
+                    text(
+                        f"SELECT table_name FROM `{self.project_id}.{self.dataset}`"
+                        ".INFORMATION_SCHEMA.COLUMNS"
+                        " WHERE is_partitioning_column = 'YES'"
+                    )
+                ).scalars()
             )
-            if not self.project_id or not self.dataset:
-                raise ValueError("Project ID or dataset not found")
-            if not self.service_account_key_json_path:
+        statements = []
+        for table in self.tables:
+            if (
+                PARTITIONING_COLUMN_NAME not in table.columns
+                or table.name not in existing_table_names
+                or table.name in partitioned_table_names
+            ):
+                continue
+            table_id = f"{self.project_id}.{self.dataset}.{table.name}"
+            statements.extend(
+                [
+                    f"CREATE TABLE `{table_id}_partitioned`"
+                    f" PARTITION BY DATETIME_TRUNC({PARTITIONING_COLUMN_NAME}, DAY)"
+                    f" AS SELECT * FROM `{table_id}`",
+                    f"DROP TABLE `{table_id}`",
+                    f"ALTER TABLE `{table_id}_partitioned` RENAME TO {table.name}",
+                ]
+            )
+        return statements
+
+    def migrate(self, dry_run: bool = False) -> List[str]:
+        """Migrates the schema of the tables, then partitions the existing tables
+        created before their partitioning"""
+        statements = super().migrate(dry_run=dry_run)
+        engine = self.get_engine()
+        partitioning_statements = self.get_partitioning_statements(engine)
+        if not dry_run:
+            with engine.begin() as connection:
+                for statement in partitioning_statements:
+                    connection.execute(text(statement))
+                    logger.info("Migrated: %s", statement)
+        return statements + partitioning_statements
+
+    def get_merge_statement(self, staging_table_id: str) -> str:
+        """Returns the MERGE statement replacing the rows of the `@scraping_dates`
+        with the rows of the staging table, generating their id and insertion
+        time, the rows of the other dates being left untouched. The target rows
+        are filtered by the `@from_scraping_date` to `@to_scraping_date` range so
+        that only the partitions of the loaded dates are scanned"""
+        column_names = [
+            column.name
+            for column in self.table.columns
+            if column.name not in GENERATED_COLUMN_NAMES
+        ]
+        return (
+            f"MERGE `{self.project_id}.{self.dataset}.{self.table.name}` AS target"
+            f" USING `{staging_table_id}` AS source ON FALSE"
+            " WHEN NOT MATCHED BY SOURCE"
+            " AND target.scraping_date >= @from_scraping_date"
+            " AND target.scraping_date < @to_scraping_date"
+            " AND target.scraping_date IN UNNEST(@scraping_dates) THEN DELETE"
+            f" WHEN NOT MATCHED BY TARGET THEN INSERT (id, inserted_at,"
+            f" {', '.join(column_names)}) VALUES (GENERATE_UUID(), CURRENT_DATETIME(),"
+            f" {', '.join(f'source.{name}' for name in column_names)})"
+        )
+
+    def record_job(self, job: "bigquery.LoadJob | bigquery.QueryJob") -> None:
+        """Counts a completed BigQuery job and the bytes it loaded or processed"""
+        metrics.increment("load.bigquery_jobs")
+        processed_bytes = getattr(job, "total_bytes_processed", None)
+        if processed_bytes is None:
+            processed_bytes = getattr(job, "output_bytes", None)
+        metrics.increment("load.bigquery_bytes_processed", processed_bytes or 0)
+        logger.info(
+            "BigQuery %s job %s processed %s bytes",
+            job.job_type,
+            job.job_id,
+            processed_bytes,
+        )
+
+    def insert_plans_range(
+        self, transformed_data_loaders: List[BaseJsonLoader]
+    ) -> None:
+        """Loads the plans files of all the scraping dates from GCS with a single
+        load job into a staging table, then replaces the rows of these dates with
+        a single MERGE, instead of deleting and inserting the rows of each date.
+        Falls back to inserting the rows for plans which are not stored on GCS.
+
+        Args:
+            transformed_data_loaders (List[BaseJsonLoader]): loaders of the
+              transformed plans of the scraping dates
+        """
+        if not all(
+            isinstance(transformed_data_loader, GoogleCloudStorageJsonLoader)
+            for transformed_data_loader in transformed_data_loaders
+        ):
+            super().insert_plans_range(transformed_data_loaders)
+            return
+        from google.cloud import bigquery
+
+        source_uris: List[str] = []
+        scraping_dates: List[datetime] = []
+        for transformed_data_loader in transformed_data_loaders:
+            uris = transformed_data_loader.get_daily_plans_uris()
+            if not uris:
                 logger.warning(
-                    "No service account key path provided." " Using default credentials"
+                    "No transformed plans for %s, skipping it",
+                    transformed_data_loader.scraping_date.date(),
                 )
-                engine = create_engine(f"bigquery://{self.project_id}/{self.dataset}")
-            else:
-                logger.info(
-                    "Using service account credentials at %s",
-                    self.service_account_key_json_path,
+                continue
+            source_uris.extend(uris)
+            scraping_dates.append(transformed_data_loader.scraping_date)
+        if not source_uris:
+            logger.warning("No plans to insert.")
+            return
+
+        engine = self.get_engine()
+        self.ensure_schema(engine)
+        client = self.create_bigquery_client()
+        staging_table_id = (
+            f"{self.project_id}.{self.dataset}.{self.table.name}"
+            f"_staging_{uuid.uuid4().hex[:8]}"
+        )
+        try:
+            logger.info(
+                "Loading %d file(s) of %d scraping date(s) into %s...",
+                len(source_uris),
+                len(scraping_dates),
+                staging_table_id,
+            )
+            with metrics.span("load.bigquery_load_job", log=True):
+                load_job = client.load_table_from_uri(
+                    source_uris,
+                    staging_table_id,
+                    job_config=bigquery.LoadJobConfig(
+                        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+                        schema=self.get_staging_schema(),
+                        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+                        # the transformed plans have fields not stored in the table
+                        ignore_unknown_values=True,
+                    ),
                 )
-                engine = create_engine(
-                    f"bigquery://{self.project_id}/{self.dataset}",
-                    credentials_path=self.service_account_key_json_path,
+                load_job.result()
+            self.record_job(load_job)
+
+            with metrics.span("load.bigquery_merge", log=True):
+                merge_job = client.query(
+                    self.get_merge_statement(staging_table_id),
+                    job_config=bigquery.QueryJobConfig(
+                        query_parameters=[
+                            bigquery.ArrayQueryParameter(
+                                "scraping_dates", "DATETIME", scraping_dates
+                            ),
+                            # day bounds of the range, to prune the partitions
+                            bigquery.ScalarQueryParameter(
+                                "from_scraping_date",
+                                "DATETIME",
+                                datetime.combine(min(scraping_dates).date(), time()),
+                            ),
+                            bigquery.ScalarQueryParameter(
+                                "to_scraping_date",
+                                "DATETIME",
+                                datetime.combine(
+                                    max(scraping_dates).date() + timedelta(days=1),
+                                    time(),
+                                ),
+                            ),
+                        ]
+                    ),
                 )
-            logger.info("Create table(s) (if not exists)")
-            Base.metadata.create_all(engine)
-            Session = sessionmaker(bind=engine)
-            session = Session()
-            try:
-                # Get the scraping_date from the first row to use for deletion
-                # All rows processed in one run are expected to have the same
-                # scraping_date
-                scraping_date_to_delete = plans_table_rows[0].scraping_date
-                if scraping_date_to_delete:
-                    logger.info(
-                        "Deleting existing rows with scraping_date = %s before"
-                        " insertion...",
-                        scraping_date_to_delete,
-                    )
-                    deleted_count = (
-                        session.query(MobilePhonePlanDatabaseTable)
-                        .filter_by(scraping_date=scraping_date_to_delete)
-                        .delete()
+                merge_job.result()
+            self.record_job(merge_job)
+            # the affected rows of the MERGE also count the deleted rows
+            inserted_row_count = (
+                merge_job.dml_stats.inserted_row_count
+                if merge_job.dml_stats is not None
+                else load_job.output_rows
+            )
+            metrics.increment("rows_inserted", inserted_row_count or 0)
+
+            if self.aggregate_daily_summaries:
+                with metrics.span("load.aggregate_daily_summaries", log=True):
+                    summary_job = client.query(
+                        "SELECT scraping_date, operator_name, internet_level, price,"
+                        f" internet_data_included FROM `{staging_table_id}`"
                     )
-                    logger.info("Deleted %d existing rows.", deleted_count)
-
-                logger.info("Inserting %d rows into BigQuery...", len(plans_table_rows))
-                session.add_all(plans_table_rows)
-                session.commit()
-                logger.info(
-                    "Inserted %d rows into BigQuery table %s",
-                    len(plans_table_rows),
-                    MobilePhonePlanDatabaseTable.__tablename__,
-                )
-            except Exception as ex:
-                logger.exception("Error when loading to BigQuery: %s", ex)
-                session.rollback()
-                raise ex
-            finally:
-                session.close()
-        else:
-            logger.warning("No plans to insert.")
+                    table_rows: List[Dict[str, Any]] = [
+                        dict(row.items()) for row in summary_job.result()
+                    ]
+                    self.record_job(summary_job)
+                    with engine.begin() as connection:
+                        self.refresh_daily_summaries(connection, table_rows)
+        except Exception as ex:
+            # the MERGE and the summaries are not one transaction
+            logger.exception(
+                "Error when loading to %s, reload the scraping dates from %s to %s"
+                " if their plans or summaries were partially replaced: %s",
+                self.database_name,
+                scraping_dates[0].date(),
+                scraping_dates[-1].date(),
+                ex,
+            )
+            raise ex
+        finally:
+            client.delete_table(staging_table_id, not_found_ok=True)
+            client.close()
+        logger.info(
+            "Loaded %d scraping date(s) into BigQuery table %s with %d job(s),"
+            " %d bytes processed",
+            len(scraping_dates),
+            self.table.name,
+            metrics.counters.get("load.bigquery_jobs", 0),
+            metrics.counters.get("load.bigquery_bytes_processed", 0),
+        )
@@ -0,0 +1,35 @@
+"""This module contains functions to load data into a local SQLite database, a
+stand-in for BigQuery to run and load-test the pipeline offline."""
+
+import os
+from dataclasses import dataclass
+from typing import Tuple
+
+from etl.load.database_loading import BaseDatabaseLoader
+from etl.logging_setup import logger
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+
+
+@dataclass
+class SQLiteDataLoader(BaseDatabaseLoader):
+    """Class to load data into a local SQLite database with the same table
+    structure as in BigQuery."""
+
+    database_path: str
+    """Path to the SQLite database file"""
+
+    @property
+    def database_name(self) -> str:
+        return "SQLite"
+
+    @property
+    def engine_key(self) -> Tuple:
+        return ("sqlite", os.path.abspath(self.database_path))
+
+    def create_engine(self) -> Engine:
+        logger.info("Create SQLite engine with database %s", self.database_path)
+        database_dir = os.path.dirname(self.database_path)
+        if database_dir:
+            os.makedirs(database_dir, exist_ok=True)
+        return create_engine(f"sqlite:///{self.database_path}")
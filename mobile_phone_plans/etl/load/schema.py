@@ -0,0 +1,125 @@
+"""This module checks and migrates the schema of the tables of the load step.
+
+Loads only check the schema, once per process and target database, and create the
+missing tables. Adding columns to existing tables, e.g. new numeric columns of
+the summary tables, is an explicit migration run with `etl migrate`, so that no
+load alters a table implicitly."""
+
+from typing import List, Tuple
+
+from etl.logging_setup import logger
+from sqlalchemy import Column, Table, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateTable
+
+
+class SchemaMismatchError(Exception):
+    """The tables of the target database lack columns of their model"""
+
+
+def get_schema_changes(
+    engine: Engine, tables: List[Table]
+) -> Tuple[List[Table], List[Tuple[Table, Column]]]:
+    """Compares the tables of the target database with their model
+
+    Args:
+        engine (Engine): engine connected to the target database
+        tables (List[Table]): Core tables of the models
+
+    Returns:
+        Tuple[List[Table], List[Tuple[Table, Column]]]: the tables missing from the
+          database, and the columns missing from its existing tables
+    """
+    inspector = inspect(engine)
+    existing_table_names = set(inspector.get_table_names())
+    missing_tables = [
+        table for table in tables if table.name not in existing_table_names
+    ]
+    missing_columns = []
+    for table in tables:
+        if table.name not in existing_table_names:
+            continue
+        column_names = {column["name"] for column in inspector.get_columns(table.name)}
+        missing_columns.extend(
+            (table, column)
+            for column in table.columns
+            if column.name not in column_names
+        )
+    return missing_tables, missing_columns
+
+
+def get_add_column_statement(engine: Engine, table: Table, column: Column) -> str:
+    """Returns the ALTER TABLE statement adding a column to an existing table,
+    supported by both SQLite and BigQuery"""
+    if not column.nullable:
+        raise SchemaMismatchError(
+            f"Cannot add the non-nullable column {column.name} to the existing"
+            f" table {table.name}"
+        )
+    preparer = engine.dialect.identifier_preparer
+    return (
+        f"ALTER TABLE {preparer.format_table(table)}"
+        f" ADD COLUMN {preparer.format_column(column)}"
+        f" {column.type.compile(dialect=engine.dialect)}"
+    )
+
+
+def check_schema(engine: Engine, tables: List[Table]) -> None:
+    """Creates the missing tables, and checks that the existing ones have the
+    columns of their model
+
+    Args:
+        engine (Engine): engine connected to the target database
+        tables (List[Table]): Core tables of the models
+
+    Raises:
+        SchemaMismatchError: if existing tables lack columns, to add with
+          `etl migrate`
+    """
+    missing_tables, missing_columns = get_schema_changes(engine, tables)
+    for table in missing_tables:
+        logger.info("Creating the missing table %s", table.name)
+        table.create(engine)
+    if missing_columns:
+        raise SchemaMismatchError(
+            "Columns missing from the database, run `etl migrate` to add them: "
+            + ", ".join(
+                f"{table.name}.{column.name}" for table, column in missing_columns
+            )
+        )
+
+
+def migrate_schema(
+    engine: Engine, tables: List[Table], dry_run: bool = False
+) -> List[str]:
+    """Creates the missing tables and adds the missing nullable columns of the
+    existing ones
+
+    Args:
+        engine (Engine): engine connected to the target database
+        tables (List[Table]): Core tables of the models
+        dry_run (bool): whether to only return the statements without running them
+
+    Returns:
+        List[str]: the DDL statements of the migration
+    """
+    missing_tables, missing_columns = get_schema_changes(engine, tables)
+    statements = [
+        str(CreateTable(table).compile(dialect=engine.dialect)).strip()
+        for table in missing_tables
+    ]
+    add_column_statements = [
+        get_add_column_statement(engine, table, column)
+        for table, column in missing_columns
+    ]
+    statements.extend(add_column_statements)
+    if dry_run:
+        return statements
+    for table in missing_tables:
+        table.create(engine)
+    with engine.begin() as connection:
+        for statement in add_column_statements:
+            connection.execute(text(statement))
+    for statement in statements:
+        logger.info("Migrated: %s", statement)
+    return statements
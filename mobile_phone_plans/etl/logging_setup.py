@@ -1,13 +1,20 @@
 """This sets up the logging for the whole package"""
 
+import atexit
+import functools
 import logging
 import os
+import queue
+import sys
+import threading
 from datetime import datetime
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Callable
 
 import google.cloud.logging
 import pytz
 from google.cloud.logging_v2.handlers import CloudLoggingHandler
+from google.cloud.logging_v2.handlers.transports import BackgroundThreadTransport
 from google.oauth2 import service_account
 
 PROJECT_NAME = "quechoisir-mobile-phone-plans-etl"
@@ -25,16 +32,129 @@ ETL_STEP_MSG_FORMAT = (
 DATE_FORMAT = "%H:%M:%S"
 LOG_DIR = "./.logs"
 os.makedirs(LOG_DIR, exist_ok=True)
+LOG_QUEUE_MAX_SIZE = 10000
+"""Max number of records waiting to be handled; extra records are dropped"""
+CLOUD_LOGGING_BATCH_SIZE = 50
+"""Number of entries sent per Cloud Logging API call"""
+CLOUD_LOGGING_MAX_LATENCY = 2.0
+"""Max seconds a Cloud Logging entry waits for its batch to fill up"""
+LOG_SHUTDOWN_TIMEOUT = 10.0
+"""Max seconds to wait for pending logs to be flushed when shutting down"""
 
 cloud_logging_client = None
+queue_listener = None
+queue_handler = None
+
+
+class BoundedQueueHandler(QueueHandler):
+    """Queue handler which drops records instead of blocking the pipeline when
+    the queue is full"""
+
+    def __init__(self, log_queue: queue.Queue, dropped_records: int = 0) -> None:
+        """
+        Args:
+            log_queue (queue.Queue): bounded queue of the records to handle
+            dropped_records (int): records dropped and not reported yet, e.g. by
+              the handler replaced by this one
+        """
+        super().__init__(log_queue)
+        self.dropped_records = dropped_records
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_records += 1
+
+
+def take_dropped_records() -> int:
+    """Returns the number of log records dropped because the queue was full since
+    the previous call, to report them"""
+    if queue_handler is None:
+        return 0
+    dropped_records = queue_handler.dropped_records
+    queue_handler.dropped_records -= dropped_records
+    return dropped_records
+
+
+class LazyLogArg:
+    """Defers the computation of an expensive log argument until the record is
+    actually formatted, i.e. only when its level is enabled.
+
+    Example:
+        logger.debug("Value: %s", LazyLogArg(lambda: web_elt.get_attribute("value")))
+    """
+
+    def __init__(self, func: Callable[[], Any]) -> None:
+        self.func = func
+
+    def __str__(self) -> str:
+        return str(self.func())
+
+    def __repr__(self) -> str:
+        return repr(self.func())
+
+
+def close_handlers() -> None:
+    """Stops the listener, flushing the queued records, closes its handlers, which
+    flushes the Cloud Logging transport, and closes the cloud logging client"""
+    global queue_listener, cloud_logging_client
+    if queue_listener:
+        queue_listener.stop()
+        for handler in queue_listener.handlers:
+            handler.close()
+        queue_listener = None
+    if cloud_logging_client:
+        cloud_logging_client.close()
+        cloud_logging_client = None
+
+
+def shutdown_logger(timeout: float = LOG_SHUTDOWN_TIMEOUT) -> None:
+    """Flushes queued records and closes the cloud logging client, giving up
+    after `timeout` seconds so that a slow Cloud Logging API never blocks the
+    pipeline exit.
+
+    Args:
+        timeout (float): max seconds to wait for the flush
+    """
+    global queue_listener, cloud_logging_client, queue_handler
+
+    # the records logged after the shutdown, e.g. by atexit hooks, go to stderr
+    # through the last resort handler instead of a queue nobody handles
+    if queue_handler:
+        logger.removeHandler(queue_handler)
+    flushing_thread = threading.Thread(target=close_handlers, daemon=True)
+    flushing_thread.start()
+    flushing_thread.join(timeout)
+    if flushing_thread.is_alive():
+        # the listener may be stopped, so write directly to stderr
+        sys.stderr.write(
+            f"Logs flush did not complete within {timeout} seconds,"
+            " pending records may be lost\n"
+        )
+    dropped_records = take_dropped_records()
+    if dropped_records:
+        sys.stderr.write(
+            f"{dropped_records} log record(s) dropped because the log queue was"
+            " full\n"
+        )
+    queue_listener = None
+    queue_handler = None
+    cloud_logging_client = None
 
 
 def setup_logger(
     level=logging.DEBUG, etl_step=None, service_account_key_json_path=None
 ):
-    global cloud_logging_client
-    """Set up the logger with file and console handlers."""
+    global cloud_logging_client, queue_listener, queue_handler
+    """Set up the logger with file, console and cloud handlers.
+
+    Records are pushed to a bounded queue and handled by a background listener
+    thread, so that file, console and Cloud Logging I/O never block the pipeline.
+    """
     logger.setLevel(level)
+    # --- stop the previous listener and close its handlers, flushing them ---
+    close_handlers()
     # --- clear handlers ---
     while logger.hasHandlers():
         logger.removeHandler(logger.handlers[0])
@@ -48,6 +168,7 @@ def setup_logger(
             ),
             datefmt=DATE_FORMAT,
         )
+        handlers = []
 
         # --- add file handler ---
         file_handler = RotatingFileHandler(
@@ -59,25 +180,19 @@ def setup_logger(
         )
         file_handler.setLevel(logging.DEBUG)
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
 
         # --- set up logging to console ---
         console_handler = logging.StreamHandler()
         console_handler.setLevel(logging.INFO)
         # set a format which is simpler for console use
         console_handler.setFormatter(formatter)
-        # add the handler to the root logger
-        logger.addHandler(console_handler)
+        handlers.append(console_handler)
 
         # --- add cloud logging handler ---
-        try:
-            if service_account_key_json_path is None:
-                logger.warning(
-                    "No service account key path provided,"
-                    " skipping cloud logging handler"
-                )
-                pass
-            else:
+        cloud_handler_error = None
+        if service_account_key_json_path is not None:
+            try:
                 # 1. Load credentials from the service account key file
                 credentials = service_account.Credentials.from_service_account_file(
                     service_account_key_json_path
@@ -86,23 +201,50 @@ def setup_logger(
                 cloud_logging_client = google.cloud.logging.Client(
                     credentials=credentials
                 )
-                logger.info("Cloud Logging client created successfully!")
 
-                # 3. Set up a handler to send logs to Cloud Logging
+                # 3. Set up a handler to send logs to Cloud Logging in batches
                 cloud_handler = CloudLoggingHandler(
-                    cloud_logging_client, logger_name=PROJECT_NAME
+                    cloud_logging_client,
+                    name=PROJECT_NAME,
+                    transport=functools.partial(
+                        BackgroundThreadTransport,
+                        batch_size=CLOUD_LOGGING_BATCH_SIZE,
+                        max_latency=CLOUD_LOGGING_MAX_LATENCY,
+                        grace_period=LOG_SHUTDOWN_TIMEOUT,
+                    ),
                 )
                 cloud_handler.setLevel(logging.INFO)
                 cloud_handler.setFormatter(formatter)
-                logger.addHandler(cloud_handler)
-        except Exception as ex:
-            logger.exception(
+                handlers.append(cloud_handler)
+            except Exception as ex:
+                cloud_handler_error = ex
+
+        # --- route records through a bounded queue handled in background ---
+        # The queue handler has no formatter: the message is interpolated once
+        # and each handler only adds its prefix
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX_SIZE)
+        queue_handler = BoundedQueueHandler(log_queue, take_dropped_records())
+        logger.addHandler(queue_handler)
+        queue_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        queue_listener.start()
+
+        if service_account_key_json_path is None:
+            logger.warning(
+                "No service account key path provided,"
+                " skipping cloud logging handler"
+            )
+        elif cloud_handler_error is not None:
+            logger.error(
                 "Error when adding cloud logging handler with %s: %s",
                 service_account_key_json_path,
-                ex,
+                cloud_handler_error,
+                exc_info=cloud_handler_error,
             )
+        else:
+            logger.info("Cloud Logging client created successfully!")
 
 
 setup_logger()
+atexit.register(shutdown_logger)
 TODAY_DATE = datetime.now(pytz.timezone("Europe/Paris")).strftime("%d-%m-%Y %H:%M:%S")
 logger.info("Logger set up successfully on %s!", TODAY_DATE)
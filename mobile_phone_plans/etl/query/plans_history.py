@@ -0,0 +1,208 @@
+"""This module defines a local cache of the history of the transformed plans, for
+exploratory queries without querying BigQuery. The daily `plans.jsonl` files are
+copied from the transformed data storage into a SQLite file, only for the days
+not cached yet, with the prices and data volumes parsed into numbers and indexed
+for the price history and operator comparison queries."""
+
+import os
+import sqlite3
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from etl.data.transformed_data_loading import BaseJsonLoader
+from etl.instrumentation import metrics
+from etl.load.aggregation import parse_data_volume, parse_price
+from etl.logging_setup import logger
+from google.api_core.exceptions import NotFound
+
+PLAN_COLUMN_NAMES = (
+    "name",
+    "description",
+    "operator_name",
+    "price",
+    "internet_level",
+    "call_included",
+    "sms_included",
+    "mms_included",
+    "internet_data_included",
+)
+"""Columns of the cached plans read as is from the transformed plans"""
+PLANS_COLUMN_COUNT = len(PLAN_COLUMN_NAMES) + 3
+"""Number of columns of the `plans` table, with the scraping date and the parsed
+price and data volume"""
+SCHEMA_STATEMENTS = (
+    "CREATE TABLE IF NOT EXISTS plans ("
+    "scraping_date TEXT NOT NULL, "
+    + ", ".join(f"{name} TEXT" for name in PLAN_COLUMN_NAMES)
+    + ", price_eur REAL, data_volume_gb REAL)",
+    "CREATE INDEX IF NOT EXISTS plans_scraping_date ON plans (scraping_date)",
+    "CREATE INDEX IF NOT EXISTS plans_operator_name_scraping_date"
+    " ON plans (operator_name, scraping_date)",
+    "CREATE TABLE IF NOT EXISTS synced_days ("
+    "scraping_date TEXT PRIMARY KEY, plan_count INTEGER NOT NULL,"
+    " synced_at TEXT NOT NULL)",
+)
+
+
+def iter_days(start_date: date, end_date: date) -> Iterator[date]:
+    """Yields the days from `start_date` to `end_date` included"""
+    for day_offset in range((end_date - start_date).days + 1):
+        yield start_date + timedelta(days=day_offset)
+
+
+@dataclass
+class PlansHistoryCache:
+    """Local SQLite copy of the transformed plans of past scraping dates"""
+
+    database_path: str
+    """Path of the SQLite file of the cache, created if it does not exist"""
+    build_transformed_data_loader: Callable[[datetime], BaseJsonLoader]
+    """Builds the transformed data loader of a scraping date"""
+    _connection: sqlite3.Connection = field(init=False, repr=False)
+
+    def __post_init__(self):
+        if os.path.dirname(self.database_path):
+            os.makedirs(os.path.dirname(self.database_path), exist_ok=True)
+        self._connection = sqlite3.connect(self.database_path)
+        self._connection.row_factory = sqlite3.Row
+        for statement in SCHEMA_STATEMENTS:
+            self._connection.execute(statement)
+        self._connection.commit()
+
+    def get_synced_days(self) -> Dict[str, int]:
+        """Returns the number of plans of each cached day, by ISO date"""
+        return {
+            row["scraping_date"]: row["plan_count"]
+            for row in self._connection.execute(
+                "SELECT scraping_date, plan_count FROM synced_days"
+            )
+        }
+
+    def sync(self, start_date: date, end_date: date, refresh: bool = False) -> int:
+        """Copies the plans of the days of a period that are not cached yet. The
+        current day is always copied again, as later runs may add profiles to it.
+
+        Args:
+            start_date (date): first day of the period
+            end_date (date): last day of the period, included
+            refresh (bool): whether to copy again the days already cached
+
+        Returns:
+            int: the number of days copied
+        """
+        synced_days = self.get_synced_days()
+        today = date.today()
+        synced_day_count = 0
+        for day in iter_days(start_date, end_date):
+            if day.isoformat() in synced_days and not refresh and day != today:
+                continue
+            transformed_data_loader = self.build_transformed_data_loader(
+                datetime.combine(day, datetime.min.time())
+            )
+            try:
+                with metrics.span("query.download_plans"):
+                    plans = transformed_data_loader.load_daily_plans()
+            except (FileNotFoundError, NotFound):
+                logger.debug("No transformed plans for %s", day)
+                continue
+            self.save_day(day, plans)
+            synced_day_count += 1
+        logger.info(
+            "Synced %d day(s) of plans from %s to %s into %s",
+            synced_day_count,
+            start_date,
+            end_date,
+            self.database_path,
+        )
+        return synced_day_count
+
+    def save_day(self, day: date, plans: List[Dict[str, Any]]) -> None:
+        """Replaces the cached plans of a day"""
+        scraping_date = day.isoformat()
+        rows = [
+            (
+                scraping_date,
+                *(plan.get(name) for name in PLAN_COLUMN_NAMES),
+                parse_price(plan.get("price")),
+                parse_data_volume(plan.get("internet_data_included")),
+            )
+            for plan in plans
+        ]
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM plans WHERE scraping_date = ?", (scraping_date,)
+            )
+            self._connection.executemany(
+                f"INSERT INTO plans VALUES ({', '.join('?' * PLANS_COLUMN_COUNT)})",
+                rows,
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO synced_days VALUES (?, ?, ?)",
+                (scraping_date, len(rows), datetime.now().isoformat()),
+            )
+        metrics.increment("query.plans_cached", len(rows))
+
+    def query(
+        self, sql: str, parameters: Tuple[Any, ...] | Dict[str, Any] = ()
+    ) -> List[Dict[str, Any]]:
+        """Runs a SQL query on the cache, whose `plans` table has the columns of
+        the transformed plans with an ISO `scraping_date`, and the `price_eur`
+        and `data_volume_gb` numbers (infinity for unlimited data)
+
+        Args:
+            sql (str): the SQLite query
+            parameters (Tuple[Any, ...] | Dict[str, Any]): parameters of the query
+
+        Returns:
+            List[Dict[str, Any]]: the rows of the result
+        """
+        with metrics.span("query.execute"):
+            return [dict(row) for row in self._connection.execute(sql, parameters)]
+
+    def get_price_history(
+        self,
+        operator_name: str | None = None,
+        internet_level: str | None = None,
+        start_date: date | None = None,
+        end_date: date | None = None,
+    ) -> List[Dict[str, Any]]:
+        """Returns the offer count and min/avg/max price per day and operator,
+        optionally filtered by operator, internet level and period"""
+        return self.query(
+            "SELECT scraping_date, operator_name, COUNT(*) AS offer_count,"
+            " MIN(price_eur) AS min_price, ROUND(AVG(price_eur), 2) AS avg_price,"
+            " MAX(price_eur) AS max_price"
+            " FROM plans"
+            " WHERE (:operator_name IS NULL OR operator_name = :operator_name)"
+            " AND (:internet_level IS NULL OR internet_level = :internet_level)"
+            " AND (:start_date IS NULL OR scraping_date >= :start_date)"
+            " AND (:end_date IS NULL OR scraping_date <= :end_date)"
+            " GROUP BY scraping_date, operator_name"
+            " ORDER BY scraping_date, operator_name",
+            {
+                "operator_name": operator_name,
+                "internet_level": internet_level,
+                "start_date": start_date and start_date.isoformat(),
+                "end_date": end_date and end_date.isoformat(),
+            },
+        )
+
+    def compare_operators(self, day: date | None = None) -> List[Dict[str, Any]]:
+        """Returns the offer count, min/avg price and max data volume of each
+        operator and internet level on the latest cached day with plans, up to
+        `day` if given"""
+        return self.query(
+            "SELECT operator_name, internet_level, COUNT(*) AS offer_count,"
+            " MIN(price_eur) AS min_price, ROUND(AVG(price_eur), 2) AS avg_price,"
+            " MAX(data_volume_gb) AS max_data_volume_gb"
+            " FROM plans"
+            " WHERE scraping_date = (SELECT MAX(scraping_date) FROM synced_days"
+            " WHERE plan_count > 0 AND (:day IS NULL OR scraping_date <= :day))"
+            " GROUP BY operator_name, internet_level"
+            " ORDER BY min_price",
+            {"day": day and day.isoformat()},
+        )
+
+    def close(self) -> None:
+        self._connection.close()
@@ -0,0 +1,121 @@
+"""This module runs the ETL pipeline of several comparators in one job, with a
+bounded parallelism and resources (web drivers, storage clients) shared between
+the comparators."""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, List
+
+from etl.comparators import ComparatorPlugin
+from etl.data.raw_data_loading import BaseHtmlLoader
+from etl.data.transformed_data_loading import BaseJsonLoader
+from etl.extract.crawl_scheduling import CrawlScheduler
+from etl.extract.downloading import DynamicSearchBrowser, load_extraction_config
+from etl.extract.driver_pool import ChromeDriverPool
+from etl.instrumentation import metrics
+from etl.load.database_loading import BaseDatabaseLoader
+from etl.logging_setup import logger
+
+
+@dataclass
+class ComparatorScheduler:
+    """Runs the extract, transform and load steps of each comparator, running up to
+    `max_workers` comparators concurrently"""
+
+    plugins: List[ComparatorPlugin]
+    """Comparators to run"""
+    driver_pool: ChromeDriverPool
+    """Pool of web drivers shared by the extractions"""
+    build_raw_data_loader: Callable[[ComparatorPlugin, datetime], BaseHtmlLoader]
+    """Builds the raw data loader of a comparator for a scraping date"""
+    build_transformed_data_loader: Callable[
+        [ComparatorPlugin, datetime], BaseJsonLoader
+    ]
+    """Builds the transformed data loader of a comparator for a scraping date"""
+    build_database_loader: Callable[
+        [ComparatorPlugin, BaseJsonLoader], BaseDatabaseLoader
+    ]
+    """Builds the database loader of a comparator"""
+    max_workers: int = 2
+    """Max number of comparators processed concurrently"""
+    crawl_scheduler: CrawlScheduler = field(default_factory=CrawlScheduler)
+    """Rate limits and concurrency caps of the extractions per domain"""
+
+    def run_comparator(self, plugin: ComparatorPlugin, scraping_date: datetime):
+        """Runs the extract, transform and load steps of a comparator
+
+        Args:
+            plugin (ComparatorPlugin): the comparator to run
+            scraping_date (datetime): date of the scraping session
+        """
+        logger.info("Comparator %s - step extract", plugin.name)
+        extraction_config = load_extraction_config(plugin.action_config_path)
+        raw_data_loader = self.build_raw_data_loader(plugin, scraping_date).start_run(
+            extraction_config.profile
+        )
+        with (
+            metrics.span(f"{plugin.name}.extract", log=True),
+            self.crawl_scheduler.crawl(plugin.base_url) as throttle,
+            self.driver_pool.acquire() as driver,
+        ):
+            DynamicSearchBrowser(
+                extraction_config.actions,
+                data_loader=raw_data_loader,
+                base_url=plugin.base_url,
+                driver=driver,
+                max_consecutive_failures=extraction_config.max_consecutive_failures,
+                results_validation=extraction_config.results_validation,
+                offer_harvesting=extraction_config.offer_harvesting,
+                extract_offer_fields=extraction_config.extract_offer_fields,
+                throttle=throttle,
+            ).run()
+
+        logger.info("Comparator %s - step transform", plugin.name)
+        transformed_data_loader = self.build_transformed_data_loader(
+            plugin, scraping_date
+        )
+        with metrics.span(f"{plugin.name}.transform", log=True):
+            plugin.transformer_cls(
+                scraping_date=scraping_date,
+                raw_data_loader=raw_data_loader,
+                transformed_data_loader=transformed_data_loader.for_run(
+                    raw_data_loader.profile, raw_data_loader.run_id
+                ),
+            ).transform()
+
+        logger.info("Comparator %s - step load", plugin.name)
+        with metrics.span(f"{plugin.name}.load", log=True):
+            self.build_database_loader(plugin, transformed_data_loader).insert_plans()
+
+    def run(self, scraping_date: datetime) -> Dict[str, Exception | None]:
+        """Runs all the comparators, the failure of one of them not stopping the
+        others
+
+        Args:
+            scraping_date (datetime): date of the scraping session
+
+        Returns:
+            Dict[str, Exception | None]: the error of each comparator, None if it
+              succeeded
+        """
+        errors = {}
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="comparator"
+        ) as executor:
+            futures = {
+                executor.submit(self.run_comparator, plugin, scraping_date): plugin
+                for plugin in self.plugins
+            }
+            for future in as_completed(futures):
+                plugin = futures[future]
+                try:
+                    future.result()
+                    errors[plugin.name] = None
+                    logger.info("Comparator %s succeeded", plugin.name)
+                except Exception as ex:
+                    errors[plugin.name] = ex
+                    metrics.increment("comparators_failed")
+                    logger.exception("Comparator %s failed: %s", plugin.name, ex)
+        self.crawl_scheduler.log_report()
+        return errors
@@ -2,14 +2,71 @@
 Daily plans transformation.
 """
 
-from dataclasses import dataclass
+import json
+from collections import Counter
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Any, Callable, Iterable, Iterator, List
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
 from etl.data.raw_data_loading import BaseHtmlLoader, LocalHtmlLoader
 from etl.data.transformed_data_loading import BaseJsonLoader, LocalJsonLoader
+from etl.instrumentation import metrics
 from etl.logging_setup import logger
 from etl.transform.data_model import MobilePhonePlan
+from etl.transform.drift_detection import (
+    DEFAULT_DRIFT_SAMPLE_SIZE,
+    SelectorDriftDetector,
+)
+from etl.transform.parse_cache import ParseCache
+from etl.transform.selectors import OFFER_CARD, PRODUCTS_CONTAINER
+from lxml import etree
+
+MAX_LOGGED_PARSE_FAILURES = 5
+"""Max number of plan parsing failures logged with their traceback, the other
+ones being only counted in the summary of the failures"""
+MAX_LOGGED_ELEMENT_LENGTH = 300
+"""Max number of characters of a plan element logged with its parsing failure"""
+
+
+def iter_plan_elements(html_chunks: Iterable[str]) -> Iterator[etree._Element]:
+    """Parses a results page incrementally and yields its plan elements one at a
+    time, each being discarded once the next one is requested, so that the memory
+    used does not grow with the number of offers.
+
+    Args:
+        html_chunks (Iterable[str]): successive chunks of the results page
+
+    Yields:
+        etree._Element: the next plan element, i.e. the parent div of an offer
+          card article
+
+    Raises:
+        ValueError: if the results page has no offers container
+    """
+    parser = etree.HTMLPullParser(events=("start", "end"), tag="div")
+    products_div_found = False
+    for html_chunk in html_chunks:
+        parser.feed(html_chunk)
+        for event, element in parser.read_events():
+            if event == "start":
+                products_div_found |= PRODUCTS_CONTAINER.matches(element.get("class"))
+                continue
+            is_plan_element = any(
+                child.tag == OFFER_CARD.tag and OFFER_CARD.matches(child.get("class"))
+                for child in element
+            ) and any(
+                PRODUCTS_CONTAINER.matches(ancestor.get("class"))
+                for ancestor in element.iterancestors(PRODUCTS_CONTAINER.tag)
+            )
+            if is_plan_element:
+                yield element
+                # free the parsed plan, the tree only keeps the elements around
+                element.clear()
+                element.getparent().remove(element)
+    parser.close()
+    if not products_div_found:
+        raise ValueError("No offers container in the results page")
 
 
 @dataclass
@@ -23,25 +80,239 @@ class DailyPlansTransformer:
     """Loader for the raw data"""
     transformed_data_loader: BaseJsonLoader
     """Loader for the transformed data"""
+    streaming: bool = False
+    """Whether to parse the results page incrementally, saving each plan as soon
+    as it is parsed, instead of parsing the whole page at once"""
+    parse_cache: ParseCache | None = None
+    """Cache of the parsed offer cards, used when parsing HTML, None to parse all
+    the cards"""
+    drift_sample_size: int = DEFAULT_DRIFT_SAMPLE_SIZE
+    """Number of plan elements whose selectors are checked before parsing the
+    others, 0 not to check them"""
+    plan_count: int = field(default=0, init=False)
+    """Number of plans built by the last transform"""
 
-    def transform(self) -> None:
-        """Transform the raw data into a list of MobilePhonePlan objects."""
-        soup = BeautifulSoup(self.raw_data_loader.load_results(), "html.parser")
-        plans = []
-        plan_articles = soup.find(
-            "div", class_="qc-comparateur_products qc-gap-9"
-        ).find_all("article", class_="qc-offer-card qc-shadow-2 qc-round-2 qc-grid")
-        for plan_article in plan_articles:
-            plan_div_element = plan_article.find_parent("div")
+    def load_expected_offer_count(self) -> int | None:
+        """Returns the number of offer cards counted during the extraction, None
+        if the results page has no metadata"""
+        metadata_json = self.raw_data_loader.load_results_metadata()
+        if metadata_json is None:
+            return None
+        return json.loads(metadata_json).get("offer_count")
+
+    def find_plan_articles(self) -> List[Tag]:
+        """Returns the offer card articles, from the harvested offer cards if any,
+        from the results page otherwise"""
+        with metrics.span("transform.load_html", log=True):
+            offer_fragments = self.raw_data_loader.load_offer_fragments()
+            if not offer_fragments:
+                html_content = self.raw_data_loader.load_results()
+        with metrics.span("transform.parse_html", log=True):
+            if offer_fragments:
+                return [
+                    article
+                    for fragment in offer_fragments
+                    for article in OFFER_CARD.find_all(
+                        BeautifulSoup(fragment, "html.parser")
+                    )
+                ]
+            soup = BeautifulSoup(html_content, "html.parser")
+        products_div = PRODUCTS_CONTAINER.find(soup)
+        if products_div is None:
+            raise ValueError(
+                "No offers container in the results page "
+                f"{self.raw_data_loader.get_results_file_path()}"
+            )
+        return OFFER_CARD.find_all(products_div)
+
+    def iter_html_chunks(self) -> Iterator[str]:
+        """Yields the chunks of the harvested offer cards if any, wrapped in an
+        offers container, of the results page otherwise"""
+        offer_fragments = self.raw_data_loader.load_offer_fragments()
+        if not offer_fragments:
+            yield from self.raw_data_loader.iter_results_chunks()
+            return
+        yield f'<div class="{" ".join(PRODUCTS_CONTAINER.class_tokens)}">'
+        yield from offer_fragments
+        yield "</div>"
+
+    def check_offer_count(self, offer_count: int) -> None:
+        """Warns if the number of transformed offer cards differs from the one
+        counted during the extraction"""
+        expected_offer_count = self.load_expected_offer_count()
+        if expected_offer_count is not None and offer_count != expected_offer_count:
+            logger.warning(
+                "Found %d offer cards, %d were counted during the extraction",
+                offer_count,
+                expected_offer_count,
+            )
+
+    def with_parse_cache(
+        self,
+        build_plan: Callable[[Any], MobilePhonePlan],
+        get_key: Callable[[Any], str],
+    ) -> Callable[[Any], MobilePhonePlan]:
+        """Wraps a function building a plan from a plan element to only run it for
+        the cards missing from the parse cache, if any
+
+        Args:
+            build_plan (Callable[[Any], MobilePhonePlan]): builds a plan from a plan
+              element
+            get_key (Callable[[Any], str]): returns the cache key of a plan element
+
+        Returns:
+            Callable[[Any], MobilePhonePlan]: builds a plan from a plan element,
+              without the cache once it failed
+        """
+        if self.parse_cache is None:
+            return build_plan
+        parse_cache = self.parse_cache
+        cache_failed = False
+
+        def disable_cache(ex: Exception) -> None:
+            nonlocal cache_failed
+            cache_failed = True
+            metrics.increment("parse_cache_failures")
+            logger.warning(
+                "Parse cache failed, parsing the remaining cards without it: %s",
+                ex,
+                exc_info=ex,
+            )
+
+        def build_cached_plan(plan_element: Any) -> MobilePhonePlan:
+            if cache_failed:
+                return build_plan(plan_element)
+            # a cache failure must not be counted as a parsing failure of the card
+            try:
+                key = get_key(plan_element)
+                plan_fields = parse_cache.get(key)
+                if plan_fields is not None:
+                    return MobilePhonePlan(**plan_fields)
+            except Exception as ex:
+                disable_cache(ex)
+                return build_plan(plan_element)
+            plan = build_plan(plan_element)
+            try:
+                parse_cache.put(key, dict(zip(plan.ROW_FIELDS, plan.to_row())))
+            except Exception as ex:
+                disable_cache(ex)
+            return plan
+
+        return build_cached_plan
+
+    def check_selectors(
+        self,
+        plan_elements: Iterable[Any],
+        build_detector: Callable[..., SelectorDriftDetector],
+    ) -> Iterable[Any]:
+        """Wraps the plan elements to check their selectors on the first
+        `drift_sample_size` ones, aborting the transform if they drifted
+
+        Args:
+            plan_elements (Iterable[Any]): the plan elements
+            build_detector (Callable[..., SelectorDriftDetector]): builds the
+              detector of the parser of the plan elements
+
+        Returns:
+            Iterable[Any]: the plan elements
+        """
+        if self.drift_sample_size <= 0:
+            return plan_elements
+        return build_detector(sample_size=self.drift_sample_size).check(plan_elements)
+
+    def iter_plans(
+        self,
+        plan_sources: Iterable[Any],
+        build_plan: Callable[[Any], MobilePhonePlan],
+    ) -> Iterator[MobilePhonePlan]:
+        """Builds the plans one at a time, skipping the ones that fail. Only the
+        first failures are logged with their traceback, followed by a summary of
+        all of them.
+
+        Args:
+            plan_sources (Iterable[Any]): the plan elements or offer fields
+            build_plan (Callable[[Any], MobilePhonePlan]): builds a plan from one
+              of the plan sources
+
+        Yields:
+            MobilePhonePlan: the next plan
+        """
+        offer_count = 0
+        self.plan_count = 0
+        failures: Counter = Counter()
+        for plan_source in plan_sources:
+            offer_count += 1
             try:
-                plan = MobilePhonePlan.from_plan_element(plan_div_element)
+                with metrics.span("transform.plan_extraction"):
+                    plan = build_plan(plan_source)
                 plan.scraping_date = self.scraping_date
-                plans.append(plan)
+                metrics.increment("plans_parsed")
             except Exception as ex:
-                logger.exception(
-                    "Failed to transform plan element %s: %s", plan_div_element, ex
-                )
-        self.transformed_data_loader.save_plans(plans)
+                metrics.increment("plan_parse_failures")
+                failures[type(ex).__name__] += 1
+                if sum(failures.values()) <= MAX_LOGGED_PARSE_FAILURES:
+                    logger.exception(
+                        "Failed to transform plan element %s: %s",
+                        str(plan_source)[:MAX_LOGGED_ELEMENT_LENGTH],
+                        ex,
+                    )
+                continue
+            self.plan_count += 1
+            yield plan
+        if failures:
+            logger.warning(
+                "Failed to transform %d of %d plan elements (%s), the first %d"
+                " being logged above",
+                sum(failures.values()),
+                offer_count,
+                ", ".join(f"{name}: {count}" for name, count in failures.items()),
+                min(sum(failures.values()), MAX_LOGGED_PARSE_FAILURES),
+            )
+        self.check_offer_count(offer_count)
+
+    def transform(self) -> None:
+        """Transform the raw data into a list of MobilePhonePlan objects. The offer
+        fields collected in the browser are used if any, which skips the HTML
+        parsing. The plans are saved as they are built."""
+        with metrics.span("transform.load_offer_fields", log=True):
+            offer_fields_json = self.raw_data_loader.load_offer_fields()
+        if offer_fields_json is not None:
+            plan_sources = json.loads(offer_fields_json)
+            build_plan = MobilePhonePlan.from_offer_fields
+        elif self.streaming:
+            plan_sources = self.check_selectors(
+                iter_plan_elements(self.iter_html_chunks()),
+                SelectorDriftDetector.for_lxml,
+            )
+            build_plan = self.with_parse_cache(
+                MobilePhonePlan.from_lxml_element,
+                lambda plan_element: ParseCache.make_key(
+                    dict(plan_element.attrib), plan_element.itertext()
+                ),
+            )
+        else:
+            plan_sources = self.check_selectors(
+                (
+                    plan_article.find_parent("div")
+                    for plan_article in self.find_plan_articles()
+                ),
+                SelectorDriftDetector.for_soup,
+            )
+            build_plan = self.with_parse_cache(
+                MobilePhonePlan.from_plan_element,
+                lambda plan_element: ParseCache.make_key(
+                    plan_element.attrs, plan_element.strings
+                ),
+            )
+        with metrics.span("transform.plans_extraction", log=True):
+            self.transformed_data_loader.save_plans(
+                self.iter_plans(plan_sources, build_plan)
+            )
+        with metrics.span("transform.save_plans", log=True):
+            self.transformed_data_loader.flush()
+        self.transformed_data_loader.record_run(
+            offer_count=self.plan_count, completed=True
+        )
 
 
 if __name__ == "__main__":
@@ -3,15 +3,50 @@ Data model for mobile phone plans.
 """
 
 import re
-from dataclasses import dataclass
+import sys
+from dataclasses import dataclass, fields
+from operator import attrgetter
+from typing import Any, ClassVar, Dict, Tuple
 
 import bs4.element
 from bs4 import BeautifulSoup
 from etl.data.utils import serialize_to_json_file
+from etl.transform.selectors import (
+    OFFER_BENEFITS,
+    OFFER_CARD,
+    OFFER_NAME,
+    OFFER_PRICE,
+)
+from lxml import etree
 
+PARSER_VERSION = 2
+"""Version of the parsing of the plan elements, part of the keys of the parse
+cache: bump it whenever `from_plan_element`, `from_lxml_element` or the fields of
+the plans change, so that the cards cached by a previous parser are parsed again"""
+# compiled once rather than at each call of `from_lxml_element`
+OFFER_NAME_XPATH = etree.XPath(OFFER_CARD.xpath + OFFER_NAME.xpath[1:])
+OFFER_DETAILS_XPATH = etree.XPath(".//div[contains(@id, 'details')]")
+OFFER_PRICE_XPATH = etree.XPath(OFFER_PRICE.xpath)
+OFFER_BENEFIT_XPATH = etree.XPath(f"({OFFER_BENEFITS.xpath})[1]//li")
+TEXT_XPATH = etree.XPath("string()")
 
-@dataclass
+
+@dataclass(slots=True)
 class MobilePhonePlan:
+    ROW_FIELDS: ClassVar[Tuple[str, ...]]
+    """Names of the fields, in the order of the values of `to_row`"""
+    INTERNED_FIELDS: ClassVar[Tuple[str, ...]] = (
+        "operator_name",
+        "price",
+        "internet_level",
+        "call_included",
+        "sms_included",
+        "mms_included",
+        "internet_data_included",
+    )
+    """Fields whose texts repeat across plans, interned so that the plans share
+    one copy of them"""
+
     scraping_date: str
     name: str
     description: str
@@ -23,40 +58,77 @@ class MobilePhonePlan:
     mms_included: str
     internet_data_included: str
 
+    def __post_init__(self):
+        for field_name in self.INTERNED_FIELDS:
+            text = getattr(self, field_name)
+            if text is not None:
+                setattr(self, field_name, sys.intern(text))
+
     @classmethod
     def from_plan_element(cls, plan_element: bs4.element.Tag):
         """Create a MobilePhonePlan from a plan element."""
-        benefit_elements = plan_element.find(
-            "div",
-            class_="qc-offer-card_content qc-fs-s qc-color-neutral-700 qc-list-styled",
-        ).find_all("li")
-        sms_mms_included = (
-            None if len(benefit_elements) < 2 else benefit_elements[1].text.strip()
+        benefit_elements = OFFER_BENEFITS.find(plan_element).find_all("li")
+        return cls.from_offer_fields(
+            {
+                "name": OFFER_NAME.find(OFFER_CARD.find(plan_element)).text,
+                "details": plan_element.find(
+                    "div", id=lambda x: x and "details" in x
+                ).text,
+                "operator_name": plan_element.attrs["data-operateur"],
+                "price": OFFER_PRICE.find(plan_element).text,
+                "internet_level": plan_element.attrs["data-internet"],
+                "benefits": [element.text for element in benefit_elements],
+            }
+        )
+
+    @classmethod
+    def from_lxml_element(cls, plan_element: etree._Element):
+        """Create a MobilePhonePlan from a plan element parsed by lxml, e.g. by the
+        streaming transform."""
+
+        def text(xpath: etree.XPath) -> str | None:
+            elements = xpath(plan_element)
+            return TEXT_XPATH(elements[0]) if elements else None
+
+        return cls.from_offer_fields(
+            {
+                "name": text(OFFER_NAME_XPATH),
+                "details": text(OFFER_DETAILS_XPATH),
+                "operator_name": plan_element.get("data-operateur"),
+                "price": text(OFFER_PRICE_XPATH),
+                "internet_level": plan_element.get("data-internet"),
+                "benefits": [
+                    TEXT_XPATH(element) for element in OFFER_BENEFIT_XPATH(plan_element)
+                ],
+            }
         )
+
+    @classmethod
+    def from_offer_fields(cls, offer_fields: Dict[str, Any]):
+        """Create a MobilePhonePlan from the raw text fields of a plan element, as
+        collected in the browser by the JSON extraction mode.
+
+        Args:
+            offer_fields (Dict[str, Any]): text content of the name, details, price
+              and benefit (list) elements, and the operator name and internet
+              level attributes of the plan element
+        """
+        benefits = [benefit.strip() for benefit in offer_fields["benefits"]]
+        sms_mms_included = None if len(benefits) < 2 else benefits[1]
         description = "\n".join(
             re.sub(r"\s+", " ", text.strip())
-            for text in plan_element.find("div", id=lambda x: x and "details" in x)
-            .text.strip()
-            .split("\n")
+            for text in offer_fields["details"].strip().split("\n")
             if text.strip() != ""
         )
         internet_data_from_description = description.split("Volume données")[-1].strip()
         return cls(
             scraping_date=None,
-            name=plan_element.find(
-                "article", class_="qc-offer-card qc-shadow-2 qc-round-2 qc-grid"
-            )
-            .find("h2", class_="qc-heading-xs qc-ff-base qc-fw-black qc-gap-1")
-            .text.strip(),
+            name=offer_fields["name"].strip(),
             description=description,
-            operator_name=plan_element.attrs["data-operateur"].strip(),
-            price=re.sub(
-                r"\s+",
-                " ",
-                plan_element.find("b", class_="qc-offer-card_price").text.strip(),
-            ),
-            internet_level=plan_element.attrs["data-internet"].strip(),
-            call_included=re.sub(r"\s+", " ", benefit_elements[0].text.strip()),
+            operator_name=offer_fields["operator_name"].strip(),
+            price=re.sub(r"\s+", " ", offer_fields["price"].strip()),
+            internet_level=offer_fields["internet_level"].strip(),
+            call_included=re.sub(r"\s+", " ", benefits[0]),
             sms_included=(
                 None
                 if sms_mms_included is None
@@ -69,11 +141,20 @@ class MobilePhonePlan:
             ),
             internet_data_included=(
                 internet_data_from_description
-                if len(benefit_elements) < 3
-                else re.sub(r"\s+", " ", benefit_elements[2].text.strip())
+                if len(benefits) < 3
+                else re.sub(r"\s+", " ", benefits[2])
             ),
         )
 
+    def to_row(self) -> Tuple[Any, ...]:
+        """Returns the values of the fields as a tuple, in the order of
+        `ROW_FIELDS`, without the copies made by `dataclasses.asdict`"""
+        return _get_plan_row(self)
+
+
+MobilePhonePlan.ROW_FIELDS = tuple(field.name for field in fields(MobilePhonePlan))
+_get_plan_row = attrgetter(*MobilePhonePlan.ROW_FIELDS)
+
 
 if __name__ == "__main__":
     plan_element_html_content = """
@@ -0,0 +1,177 @@
+"""This module detects the drift of the markup of the results page, e.g. a renamed
+class, by checking the selectors of the transform step on the first plan elements,
+so that a broken run aborts after a few cards with a report of the missing
+selectors instead of failing on every card."""
+
+import json
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from bs4 import Tag
+from etl.instrumentation import metrics
+from etl.logging_setup import logger
+from etl.transform.selectors import OFFER_CARD, PLAN_SELECTORS, ClassSelector
+from lxml import etree
+
+DEFAULT_DRIFT_SAMPLE_SIZE = 20
+"""Default number of plan elements whose selectors are checked"""
+DEFAULT_MAX_MISS_RATIO = 0.5
+"""Default max ratio of the sampled plan elements missing a selector"""
+MAX_SEEN_CLASSES = 5
+"""Max number of classes of the elements of a missed selector in a report"""
+
+
+@dataclass
+class DriftReport:
+    """Selectors missing from the sampled plan elements"""
+
+    max_miss_ratio: float
+    """Ratio of the sampled plan elements above which a missing selector drifted"""
+    sample_size: int = 0
+    """Number of plan elements checked"""
+    misses: Dict[str, int] = field(default_factory=dict)
+    """Number of sampled plan elements missing each selector, by name"""
+    seen_classes: Dict[str, List[str]] = field(default_factory=dict)
+    """Classes of the elements with the tag of each missed selector, in the first
+    plan element missing it, to update the selector"""
+
+    @property
+    def drifted_selectors(self) -> List[str]:
+        """Names of the selectors missing from too many sampled plan elements, the
+        offer card one if no plan element was found"""
+        if self.sample_size == 0:
+            return [OFFER_CARD.name]
+        return [
+            name
+            for name, miss_count in self.misses.items()
+            if miss_count > self.max_miss_ratio * self.sample_size
+        ]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "sample_size": self.sample_size,
+            "drifted_selectors": self.drifted_selectors,
+            "misses": self.misses,
+            "seen_classes": self.seen_classes,
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+    def __str__(self) -> str:
+        if self.sample_size == 0:
+            return (
+                "No plan element found in the results page, the"
+                f" {OFFER_CARD.css} selector may have drifted"
+            )
+        details = "; ".join(
+            f"{name} missing from {self.misses[name]}"
+            f" (classes seen: {self.seen_classes.get(name, [])})"
+            for name in self.drifted_selectors
+        )
+        return f"Selectors missing from {self.sample_size} sampled plan(s): {details}"
+
+
+class SelectorDriftError(ValueError):
+    """The selectors of the transform step no longer match the results page"""
+
+    def __init__(self, report: DriftReport) -> None:
+        super().__init__(str(report))
+        self.report = report
+
+
+@dataclass
+class SelectorDriftDetector:
+    """Checks the selectors of the transform step on the first plan elements"""
+
+    find: Callable[[ClassSelector, Any], Any]
+    """Returns the first element of a plan element matched by a selector"""
+    get_tag_classes: Callable[[str, Any], List[str]]
+    """Returns the classes of the elements of a tag in a plan element"""
+    sample_size: int = DEFAULT_DRIFT_SAMPLE_SIZE
+    """Number of plan elements to check"""
+    max_miss_ratio: float = DEFAULT_MAX_MISS_RATIO
+    """Ratio of the sampled plan elements above which a missing selector drifted"""
+    selectors: Tuple[ClassSelector, ...] = PLAN_SELECTORS
+    """Selectors to check in each plan element"""
+
+    @classmethod
+    def for_soup(cls, **kwargs) -> "SelectorDriftDetector":
+        """Returns a detector of plan elements parsed by BeautifulSoup"""
+
+        def get_tag_classes(tag: str, plan_element: Tag) -> List[str]:
+            return [
+                " ".join(element.get("class", []))
+                for element in plan_element.find_all(tag, limit=MAX_SEEN_CLASSES)
+            ]
+
+        return cls(
+            find=lambda selector, plan_element: selector.find(plan_element),
+            get_tag_classes=get_tag_classes,
+            **kwargs,
+        )
+
+    @classmethod
+    def for_lxml(cls, **kwargs) -> "SelectorDriftDetector":
+        """Returns a detector of plan elements parsed by lxml"""
+
+        def get_tag_classes(tag: str, plan_element: etree._Element) -> List[str]:
+            return [
+                element.get("class", "")
+                for element in plan_element.iterdescendants(tag)
+            ][:MAX_SEEN_CLASSES]
+
+        return cls(
+            find=lambda selector, plan_element: selector.find_in_lxml(plan_element),
+            get_tag_classes=get_tag_classes,
+            **kwargs,
+        )
+
+    def record(self, report: DriftReport, plan_element: Any) -> None:
+        """Records the selectors missing from a plan element"""
+        report.sample_size += 1
+        for selector in self.selectors:
+            if self.find(selector, plan_element) is not None:
+                continue
+            report.misses[selector.name] = report.misses.get(selector.name, 0) + 1
+            if selector.name not in report.seen_classes:
+                report.seen_classes[selector.name] = self.get_tag_classes(
+                    selector.tag, plan_element
+                )
+
+    def raise_if_drifted(self, report: DriftReport) -> None:
+        """Raises a drift error with the report if selectors drifted"""
+        if not report.drifted_selectors:
+            logger.debug("No selector drift in %d plan elements", report.sample_size)
+            return
+        metrics.increment("transform.selector_drifts")
+        logger.error(
+            "Selector drift: %s",
+            report,
+            extra={"json_fields": {"drift_report": report.to_dict()}},
+        )
+        raise SelectorDriftError(report)
+
+    def check(self, plan_elements: Iterable[Any]) -> Iterator[Any]:
+        """Yields the plan elements, checking the selectors of the first ones
+        before they are parsed, and raises once they are checked if the
+        selectors drifted
+
+        Args:
+            plan_elements (Iterable[Any]): the plan elements
+
+        Yields:
+            Any: the next plan element
+
+        Raises:
+            SelectorDriftError: if the selectors drifted
+        """
+        report = DriftReport(max_miss_ratio=self.max_miss_ratio)
+        for plan_element in plan_elements:
+            if report.sample_size < self.sample_size:
+                self.record(report, plan_element)
+                if report.sample_size == self.sample_size:
+                    self.raise_if_drifted(report)
+            yield plan_element
+        if report.sample_size < self.sample_size:
+            self.raise_if_drifted(report)
@@ -0,0 +1,158 @@
+"""This module defines a persistent cache of the parsed offer cards. Most cards are
+identical from one day to the next, so their parsed fields are looked up by a hash
+of their normalized HTML instead of being parsed again. A card is normalized to
+its attributes and texts, which determine its parsed fields and are much cheaper
+to read than its serialized HTML, salted with the version of the parser."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, Set
+
+from etl.instrumentation import metrics
+from etl.logging_setup import logger
+from etl.transform.data_model import PARSER_VERSION
+
+DEFAULT_PARSE_CACHE_MAX_ENTRIES = 100_000
+"""Max number of cached cards, the least recently used ones being evicted"""
+PARSE_CACHE_WRITE_BATCH_SIZE = 200
+"""Number of parsed cards written per transaction, short enough for transforms
+sharing the cache file not to wait for each other"""
+
+
+class ParseCache:
+    """Cache of the parsed fields of offer cards in a SQLite file, keyed by the
+    SHA-256 hash of their attributes and texts and of the parser version, with a
+    least recently used eviction"""
+
+    def __init__(
+        self,
+        database_path: str,
+        max_entries: int = DEFAULT_PARSE_CACHE_MAX_ENTRIES,
+    ) -> None:
+        """
+        Args:
+            database_path (str): path of the SQLite file of the cache, created if
+              it does not exist
+            max_entries (int): max number of cached cards
+        """
+        self.database_path = database_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._used_keys: Set[str] = set()
+        self._pending_fields: Dict[str, str] = {}
+        if os.path.dirname(database_path):
+            os.makedirs(os.path.dirname(database_path), exist_ok=True)
+        # autocommit, the writes being batched in short explicit transactions
+        self._connection = sqlite3.connect(
+            database_path, isolation_level=None, timeout=30
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS parsed_cards ("
+            "key TEXT PRIMARY KEY, fields TEXT NOT NULL, last_used_at REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS parsed_cards_last_used_at"
+            " ON parsed_cards (last_used_at)"
+        )
+
+    @staticmethod
+    def make_key(attributes: Dict[str, Any], texts: Iterable[str]) -> str:
+        """Returns the cache key of an offer card
+
+        Args:
+            attributes (Dict[str, Any]): attributes of the plan element
+            texts (Iterable[str]): texts of the plan element, in document order
+        """
+        normalized_card = "\x1f".join(
+            [f"v{PARSER_VERSION}", repr(sorted(attributes.items())), *texts]
+        ).encode("utf-8")
+        return hashlib.sha256(normalized_card).hexdigest()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Runs the enclosed writes in one transaction"""
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._connection
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def get(self, key: str) -> Dict[str, Any] | None:
+        """Returns the cached fields of a card, None if it is not cached"""
+        fields_json = self._pending_fields.get(key)
+        if fields_json is None:
+            row = self._connection.execute(
+                "SELECT fields FROM parsed_cards WHERE key = ?", (key,)
+            ).fetchone()
+            fields_json = None if row is None else row[0]
+        if fields_json is None:
+            self.misses += 1
+            metrics.increment("parse_cache_misses")
+            return None
+        self.hits += 1
+        metrics.increment("parse_cache_hits")
+        self._used_keys.add(key)
+        return json.loads(fields_json)
+
+    def put(self, key: str, fields: Dict[str, Any]) -> None:
+        """Caches the fields of a card, written with the next batch"""
+        self._pending_fields[key] = json.dumps(fields, ensure_ascii=False)
+        if len(self._pending_fields) >= PARSE_CACHE_WRITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the pending cards in one transaction"""
+        if not self._pending_fields:
+            return
+        now = time.time()
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO parsed_cards (key, fields, last_used_at)"
+                " VALUES (?, ?, ?)",
+                (
+                    (key, fields_json, now)
+                    for key, fields_json in self._pending_fields.items()
+                ),
+            )
+        self._pending_fields.clear()
+
+    @property
+    def hit_rate(self) -> float | None:
+        """Share of the lookups found in the cache, None without lookups"""
+        lookups = self.hits + self.misses
+        return None if lookups == 0 else self.hits / lookups
+
+    def close(self) -> None:
+        """Marks the used cards as recently used, evicts the least recently used
+        ones beyond `max_entries` and saves the pending cards"""
+        try:
+            self.flush()
+            now = time.time()
+            with self._transaction() as connection:
+                connection.executemany(
+                    "UPDATE parsed_cards SET last_used_at = ? WHERE key = ?",
+                    ((now, key) for key in self._used_keys),
+                )
+                evicted_count = connection.execute(
+                    "DELETE FROM parsed_cards WHERE key NOT IN ("
+                    "SELECT key FROM parsed_cards ORDER BY last_used_at DESC LIMIT ?)",
+                    (self.max_entries,),
+                ).rowcount
+        finally:
+            self._connection.close()
+        metrics.increment("parse_cache_evictions", evicted_count)
+        logger.info(
+            "Parse cache: %d hits, %d misses (hit rate %s), %d evicted",
+            self.hits,
+            self.misses,
+            "n/a" if self.hit_rate is None else f"{self.hit_rate:.1%}",
+            evicted_count,
+        )
@@ -0,0 +1,82 @@
+"""This module defines the selectors of the elements of the results page parsed by
+the transform step. They match the elements having some class tokens, whatever
+their order and the other tokens, as the CSS selectors of the extract step do,
+so that a change of the utility classes of the page (spacing, shadows, fonts...)
+does not break the parsing."""
+
+from dataclasses import dataclass
+from typing import Iterable, List, Tuple
+
+from bs4 import Tag
+from lxml import etree
+
+
+@dataclass(frozen=True)
+class ClassSelector:
+    """Selects the elements of a tag having all the given class tokens"""
+
+    name: str
+    """Name of the selected element, used in the drift reports"""
+    tag: str
+    """Tag of the selected element"""
+    class_tokens: Tuple[str, ...]
+    """Class tokens the selected element must have"""
+
+    def matches(self, class_attribute: str | Iterable[str] | None) -> bool:
+        """Returns whether a class attribute, as a string (lxml) or a list of
+        tokens (BeautifulSoup), has the class tokens of the selector"""
+        if class_attribute is None:
+            return False
+        if isinstance(class_attribute, str):
+            class_attribute = class_attribute.split()
+        return set(self.class_tokens).issubset(class_attribute)
+
+    @property
+    def css(self) -> str:
+        """CSS selector of the elements, as used by the extract step"""
+        return self.tag + "".join(f".{token}" for token in self.class_tokens)
+
+    @property
+    def xpath(self) -> str:
+        """XPath of the descendant elements matched by the selector"""
+        conditions = " and ".join(
+            f"contains(concat(' ', normalize-space(@class), ' '), ' {token} ')"
+            for token in self.class_tokens
+        )
+        return f".//{self.tag}[{conditions}]"
+
+    def find(self, element: Tag) -> Tag | None:
+        """Returns the first descendant of a BeautifulSoup element matched by the
+        selector, None if there is none"""
+        if len(self.class_tokens) == 1:
+            # BeautifulSoup matches a single class against each token
+            return element.find(self.tag, class_=self.class_tokens[0])
+        return element.find(
+            lambda tag: tag.name == self.tag and self.matches(tag.get("class"))
+        )
+
+    def find_all(self, element: Tag) -> List[Tag]:
+        """Returns the descendants of a BeautifulSoup element matched by the
+        selector"""
+        return [
+            tag
+            for tag in element.find_all(self.tag, class_=self.class_tokens[0])
+            if self.matches(tag.get("class"))
+        ]
+
+    def find_in_lxml(self, element: etree._Element) -> etree._Element | None:
+        """Returns the first descendant of an lxml element matched by the
+        selector, None if there is none"""
+        elements = element.xpath(self.xpath)
+        return elements[0] if elements else None
+
+
+PRODUCTS_CONTAINER = ClassSelector(
+    "products container", "div", ("qc-comparateur_products",)
+)
+OFFER_CARD = ClassSelector("offer card", "article", ("qc-offer-card",))
+OFFER_NAME = ClassSelector("offer name", "h2", ("qc-heading-xs",))
+OFFER_PRICE = ClassSelector("offer price", "b", ("qc-offer-card_price",))
+OFFER_BENEFITS = ClassSelector("offer benefits", "div", ("qc-offer-card_content",))
+PLAN_SELECTORS = (OFFER_CARD, OFFER_NAME, OFFER_PRICE, OFFER_BENEFITS)
+"""Selectors of the elements read in each plan element"""
@@ -0,0 +1,535 @@
+"""This module runs the ETL steps as jobs pulled from a local queue by a long-lived
+worker, which keeps its browsers, storage client and database engine warm across
+jobs instead of paying their startup in a new container for each step.
+
+The queue is a SQLite file, so that jobs can be enqueued by other processes, e.g.
+`etl enqueue` run by a scheduler, and survive a restart of the worker. Several
+workers can share a queue: a claimed job is leased to its worker, which renews the
+lease while the job runs, and is only requeued once its lease expired."""
+
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import TYPE_CHECKING, Callable
+
+from etl.data.manifest import NoCompletedRunError
+from etl.data.raw_data_loading import BaseHtmlLoader
+from etl.data.transformed_data_loading import BaseJsonLoader
+from etl.extract.crawl_scheduling import CrawlScheduler
+from etl.instrumentation import MetricsRegistry, metrics, scoped_metrics
+from etl.load.database_loading import BaseDatabaseLoader
+from etl.logging_setup import logger
+from etl.transform.daily_plans_transformation import DailyPlansTransformer
+from etl.transform.parse_cache import ParseCache
+
+if TYPE_CHECKING:
+    from etl.extract.driver_pool import ChromeDriverPool
+
+STEP_EXTRACT = "extract"
+STEP_TRANSFORM = "transform"
+STEP_LOAD = "load"
+STEPS = (STEP_EXTRACT, STEP_TRANSFORM, STEP_LOAD)
+NEXT_STEPS = {STEP_EXTRACT: STEP_TRANSFORM, STEP_TRANSFORM: STEP_LOAD}
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+DEFAULT_POLL_INTERVAL = 5.0
+"""Seconds between two polls of an empty queue"""
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+"""Seconds a running job stays leased to its worker without a renewal, after
+which it is requeued, its worker being considered dead"""
+LEASE_RENEWALS_PER_LEASE = 4
+"""Number of lease renewals per lease duration, so that a few missed renewals
+do not requeue a running job"""
+
+SCHEMA_STATEMENTS = (
+    "CREATE TABLE IF NOT EXISTS jobs ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, step TEXT NOT NULL,"
+    " scraping_date TEXT NOT NULL, profile TEXT, config_path TEXT,"
+    " chain INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL, attempts INTEGER"
+    " NOT NULL DEFAULT 0, error TEXT, enqueued_at TEXT NOT NULL, started_at TEXT,"
+    " finished_at TEXT, worker_id TEXT, lease_expires_at REAL)",
+    "CREATE INDEX IF NOT EXISTS jobs_status_id ON jobs (status, id)",
+)
+ADDED_COLUMNS = {"worker_id": "TEXT", "lease_expires_at": "REAL"}
+"""Columns added since the first version of the queue, by name, added to the
+existing queue files"""
+
+
+def new_worker_id() -> str:
+    """Returns a unique id of a worker process, readable in the queue"""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+@dataclass
+class Job:
+    """An ETL step to run for a scraping date"""
+
+    step: str
+    """ETL step: extract, transform or load"""
+    scraping_date: str
+    """Scraping date in YYYY/MM/DD format"""
+    profile: str | None = None
+    """Prospect profile to transform, all the profiles of the day if None"""
+    config_path: str | None = None
+    """Path to the extraction config file, required by the extract step"""
+    chain: bool = False
+    """Whether to enqueue the next step once this one succeeded"""
+    id: int | None = None
+    """Id of the job in the queue"""
+    attempts: int = 0
+    """Number of times the job was started"""
+
+    def __post_init__(self):
+        if self.step not in STEPS:
+            raise ValueError(f"Unknown ETL step {self.step}, expected one of {STEPS}")
+        if self.step == STEP_EXTRACT and not self.config_path:
+            raise ValueError("An extract job requires an extraction config path")
+        datetime.strptime(self.scraping_date, "%Y/%m/%d")
+
+
+class JobQueue:
+    """Queue of ETL jobs in a SQLite file, shared by the threads of a worker and
+    the processes enqueuing jobs"""
+
+    def __init__(
+        self,
+        database_path: str,
+        worker_id: str | None = None,
+        lease_seconds: float = JOB_LEASE_SECONDS,
+    ) -> None:
+        """
+        Args:
+            database_path (str): path of the SQLite file of the queue, created if
+              it does not exist
+            worker_id (str | None): id of the worker leasing the claimed jobs, a
+              new unique one if None
+            lease_seconds (float): seconds a claimed job stays leased to the
+              worker without a renewal
+        """
+        self.database_path = database_path
+        self.worker_id = worker_id or new_worker_id()
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        # autocommit mode, the transactions being explicit
+        self._connection = sqlite3.connect(
+            database_path, isolation_level=None, check_same_thread=False, timeout=30
+        )
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        for statement in SCHEMA_STATEMENTS:
+            self._connection.execute(statement)
+        column_names = {
+            row["name"] for row in self._connection.execute("PRAGMA table_info(jobs)")
+        }
+        for column_name, column_type in ADDED_COLUMNS.items():
+            if column_name not in column_names:
+                self._connection.execute(
+                    f"ALTER TABLE jobs ADD COLUMN {column_name} {column_type}"
+                )
+
+    def enqueue(self, job: Job) -> int:
+        """Adds a job to the queue, unless the same job is already pending
+
+        Returns:
+            int: the id of the job, or of the identical pending one
+        """
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    "SELECT id FROM jobs WHERE status = ? AND step = ?"
+                    " AND scraping_date = ? AND profile IS ? AND config_path IS ?",
+                    (
+                        JOB_PENDING,
+                        job.step,
+                        job.scraping_date,
+                        job.profile,
+                        job.config_path,
+                    ),
+                ).fetchone()
+                if row is not None:
+                    job_id = row["id"]
+                else:
+                    job_id = self._connection.execute(
+                        "INSERT INTO jobs (step, scraping_date, profile, config_path,"
+                        " chain, status, enqueued_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            job.step,
+                            job.scraping_date,
+                            job.profile,
+                            job.config_path,
+                            int(job.chain),
+                            JOB_PENDING,
+                            datetime.now().isoformat(),
+                        ),
+                    ).lastrowid
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        job.id = job_id
+        return job_id
+
+    def claim(self) -> Job | None:
+        """Marks the oldest pending job as running, leased to the worker, and
+        returns it, None if no job is pending"""
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY id LIMIT 1",
+                    (JOB_PENDING,),
+                ).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        "UPDATE jobs SET status = ?, attempts = attempts + 1,"
+                        " started_at = ?, worker_id = ?, lease_expires_at = ?"
+                        " WHERE id = ?",
+                        (
+                            JOB_RUNNING,
+                            datetime.now().isoformat(),
+                            self.worker_id,
+                            time.time() + self.lease_seconds,
+                            row["id"],
+                        ),
+                    )
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return Job(
+            step=row["step"],
+            scraping_date=row["scraping_date"],
+            profile=row["profile"],
+            config_path=row["config_path"],
+            chain=bool(row["chain"]),
+            id=row["id"],
+            attempts=row["attempts"] + 1,
+        )
+
+    def finish(self, job: Job, error: Exception | None = None) -> bool:
+        """Marks a running job leased to the worker as done, or as failed with its
+        error
+
+        Returns:
+            bool: whether the job was still leased to the worker, False if its
+              lease expired and it was requeued
+        """
+        with self._lock:
+            return (
+                self._connection.execute(
+                    "UPDATE jobs SET status = ?, error = ?, finished_at = ?,"
+                    " lease_expires_at = NULL"
+                    " WHERE id = ? AND status = ? AND worker_id = ?",
+                    (
+                        JOB_DONE if error is None else JOB_FAILED,
+                        None if error is None else repr(error),
+                        datetime.now().isoformat(),
+                        job.id,
+                        JOB_RUNNING,
+                        self.worker_id,
+                    ),
+                ).rowcount
+                > 0
+            )
+
+    def renew_leases(self) -> int:
+        """Extends the leases of the running jobs of the worker
+
+        Returns:
+            int: the number of renewed leases
+        """
+        with self._lock:
+            return self._connection.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE status = ?"
+                " AND worker_id = ?",
+                (time.time() + self.lease_seconds, JOB_RUNNING, self.worker_id),
+            ).rowcount
+
+    def requeue_expired(self) -> int:
+        """Puts back in the queue the running jobs whose lease expired, left by a
+        dead worker, the jobs of the live workers being renewed
+
+        Returns:
+            int: the number of jobs put back in the queue
+        """
+        with self._lock:
+            # jobs claimed before the leases have none
+            return self._connection.execute(
+                "UPDATE jobs SET status = ?, worker_id = NULL, lease_expires_at = NULL"
+                " WHERE status = ? AND (lease_expires_at IS NULL"
+                " OR lease_expires_at < ?)",
+                (JOB_PENDING, JOB_RUNNING, time.time()),
+            ).rowcount
+
+    def count(self, status: str) -> int:
+        """Returns the number of jobs with a status"""
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)
+            ).fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+@dataclass
+class EtlWorker:
+    """Runs the jobs of a queue with up to `max_workers` jobs at the same time,
+    sharing the browsers and the clients built once for all the jobs"""
+
+    job_queue: JobQueue
+    """Queue of the jobs to run"""
+    build_raw_data_loader: Callable[[datetime], BaseHtmlLoader]
+    """Builds the raw data loader of a scraping date"""
+    build_transformed_data_loader: Callable[[datetime], BaseJsonLoader]
+    """Builds the transformed data loader of a scraping date"""
+    build_database_loader: Callable[[BaseJsonLoader], BaseDatabaseLoader]
+    """Builds the database loader of transformed plans"""
+    driver_pool: "ChromeDriverPool | None" = None
+    """Pool of web drivers shared by the extract jobs, required to run them"""
+    base_url: str | None = None
+    """URL of the search form of the comparator"""
+    parse_cache_path: str | None = None
+    """Path to the SQLite file caching the parsed offer cards, no cache if None"""
+    max_workers: int = 1
+    """Max number of jobs running at the same time"""
+    poll_interval: float = DEFAULT_POLL_INTERVAL
+    """Seconds between two polls of an empty queue"""
+    exit_when_empty: bool = False
+    """Whether to stop once the queue is empty, instead of waiting for new jobs"""
+    crawl_scheduler: CrawlScheduler = field(default_factory=CrawlScheduler)
+    """Rate limits and concurrency caps of the extract jobs per domain"""
+    save_job_metrics: Callable[[Job, BaseHtmlLoader | BaseJsonLoader], None] | None = (
+        None
+    )
+    """Saves the metrics of a job, current while it runs, with the artifacts of
+    its data loader, the metrics of the jobs not being saved if None"""
+    _draining: threading.Event = field(default_factory=threading.Event, init=False)
+
+    def drain(self) -> None:
+        """Stops claiming jobs, the running ones being completed"""
+        if not self._draining.is_set():
+            logger.info("Draining the worker: waiting for the running jobs")
+        self._draining.set()
+
+    def install_signal_handlers(self) -> None:
+        """Drains the worker on SIGTERM (e.g. `docker stop`) and SIGINT"""
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signal_number, lambda *_: self.drain())
+
+    def run_extract(self, job: Job, scraping_date: datetime) -> None:
+        # imported here so that the other steps run without Selenium installed
+        from etl.extract.downloading import (
+            DynamicSearchBrowser,
+            load_extraction_config,
+        )
+
+        if self.driver_pool is None:
+            raise ValueError("The worker has no driver pool to run extract jobs")
+        extraction_config = load_extraction_config(job.config_path)
+        raw_data_loader = self.build_raw_data_loader(scraping_date).start_run(
+            extraction_config.profile
+        )
+        try:
+            with (
+                self.crawl_scheduler.crawl(self.base_url) as throttle,
+                self.driver_pool.acquire() as driver,
+            ):
+                DynamicSearchBrowser(
+                    extraction_config.actions,
+                    data_loader=raw_data_loader,
+                    base_url=self.base_url,
+                    driver=driver,
+                    max_consecutive_failures=(
+                        extraction_config.max_consecutive_failures
+                    ),
+                    results_validation=extraction_config.results_validation,
+                    offer_harvesting=extraction_config.offer_harvesting,
+                    extract_offer_fields=extraction_config.extract_offer_fields,
+                    throttle=throttle,
+                ).run()
+        finally:
+            self._save_job_metrics(job, raw_data_loader)
+        # the next step transforms the profile of the extraction
+        job.profile = extraction_config.profile
+
+    def run_transform(self, job: Job, scraping_date: datetime) -> None:
+        raw_data_loader = self.build_raw_data_loader(scraping_date)
+        transformed_data_loader = self.build_transformed_data_loader(scraping_date)
+        # the cache is a SQLite connection, which cannot be shared between threads
+        parse_cache = (
+            ParseCache(self.parse_cache_path) if self.parse_cache_path else None
+        )
+        transformed_run_count = 0
+        try:
+            for run_raw_data_loader in raw_data_loader.iter_run_loaders():
+                if job.profile and run_raw_data_loader.profile != job.profile:
+                    continue
+                transformed_run_count += 1
+                DailyPlansTransformer(
+                    scraping_date=scraping_date,
+                    raw_data_loader=run_raw_data_loader,
+                    transformed_data_loader=transformed_data_loader.for_run(
+                        run_raw_data_loader.profile, run_raw_data_loader.run_id
+                    ),
+                    parse_cache=parse_cache,
+                ).transform()
+            if transformed_run_count == 0:
+                raise NoCompletedRunError(
+                    f"No completed extraction run to transform on {job.scraping_date}"
+                )
+        finally:
+            if parse_cache is not None:
+                parse_cache.close()
+            self._save_job_metrics(job, transformed_data_loader)
+
+    def run_load(self, job: Job, scraping_date: datetime) -> None:
+        transformed_data_loader = self.build_transformed_data_loader(scraping_date)
+        try:
+            self.build_database_loader(transformed_data_loader).insert_plans()
+        finally:
+            self._save_job_metrics(job, transformed_data_loader)
+
+    def _save_job_metrics(
+        self, job: Job, data_loader: BaseHtmlLoader | BaseJsonLoader
+    ) -> None:
+        """Saves the metrics of the current job with the artifacts of its data
+        loader, if the worker saves them"""
+        if self.save_job_metrics is not None:
+            self.save_job_metrics(job, data_loader)
+
+    def run_job(self, job: Job) -> None:
+        """Runs a job and records its outcome in the queue, enqueuing the next step
+        of a chained job once it succeeded"""
+        logger.info(
+            "Job %d: %s of %s (profile %s, attempt %d)",
+            job.id,
+            job.step,
+            job.scraping_date,
+            job.profile,
+            job.attempts,
+        )
+        scraping_date = datetime.strptime(job.scraping_date, "%Y/%m/%d")
+        run_step = {
+            STEP_EXTRACT: self.run_extract,
+            STEP_TRANSFORM: self.run_transform,
+            STEP_LOAD: self.run_load,
+        }[job.step]
+        try:
+            # the metrics of the job are recorded apart from the ones of the
+            # concurrent jobs, the worker only recording the outcomes of the jobs
+            with (
+                metrics.span(f"worker.{job.step}", log=True),
+                scoped_metrics(MetricsRegistry()),
+            ):
+                run_step(job, scraping_date)
+        except Exception as ex:
+            metrics.increment("worker.jobs_failed")
+            logger.exception("Job %d failed: %s", job.id, ex)
+            self.finish_job(job, error=ex)
+            return
+        metrics.increment("worker.jobs_done")
+        if not self.finish_job(job):
+            return
+        logger.info("Job %d succeeded", job.id)
+        if job.chain and job.step in NEXT_STEPS:
+            self.job_queue.enqueue(
+                Job(
+                    step=NEXT_STEPS[job.step],
+                    scraping_date=job.scraping_date,
+                    profile=job.profile if job.step == STEP_EXTRACT else None,
+                    chain=True,
+                )
+            )
+
+    def finish_job(self, job: Job, error: Exception | None = None) -> bool:
+        """Records the outcome of a job in the queue, unless its lease expired
+
+        Returns:
+            bool: whether the outcome was recorded
+        """
+        if self.job_queue.finish(job, error=error):
+            return True
+        metrics.increment("worker.leases_lost")
+        logger.warning(
+            "Job %d lost its lease and was requeued, its outcome is not recorded",
+            job.id,
+        )
+        return False
+
+    def requeue_expired_jobs(self) -> None:
+        """Requeues the jobs whose worker died, i.e. whose lease expired"""
+        requeued_count = self.job_queue.requeue_expired()
+        if requeued_count:
+            metrics.increment("worker.jobs_requeued", requeued_count)
+            logger.warning("Requeued %d job(s) of dead workers", requeued_count)
+
+    def _renew_leases(self, stopped: threading.Event) -> None:
+        """Loop of the heartbeat thread: renews the leases of the running jobs
+        until stopped"""
+        interval = self.job_queue.lease_seconds / LEASE_RENEWALS_PER_LEASE
+        while not stopped.wait(interval):
+            try:
+                self.job_queue.renew_leases()
+            except sqlite3.Error as ex:
+                logger.warning("Could not renew the leases of the jobs: %s", ex)
+
+    def _work(self) -> None:
+        """Loop of a worker thread: runs the pending jobs until draining"""
+        while not self._draining.is_set():
+            job = self.job_queue.claim()
+            if job is not None:
+                self.run_job(job)
+                continue
+            self.requeue_expired_jobs()
+            if self.exit_when_empty and self.job_queue.count(JOB_RUNNING) == 0:
+                # no job left, and none running which could enqueue a next step
+                self.drain()
+            else:
+                self._draining.wait(self.poll_interval)
+
+    def run(self) -> None:
+        """Runs the jobs of the queue until drained, by a signal or once the queue
+        is empty if `exit_when_empty`"""
+        self.requeue_expired_jobs()
+        logger.info(
+            "Worker %s started with %d thread(s), %d job(s) pending",
+            self.job_queue.worker_id,
+            self.max_workers,
+            self.job_queue.count(JOB_PENDING),
+        )
+        heartbeat_stopped = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._renew_leases,
+            args=(heartbeat_stopped,),
+            name="worker-heartbeat",
+            daemon=True,
+        )
+        heartbeat.start()
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="worker"
+            ) as executor:
+                futures = [executor.submit(self._work) for _ in range(self.max_workers)]
+        finally:
+            heartbeat_stopped.set()
+            heartbeat.join()
+        for future in futures:
+            future.result()
+        self.crawl_scheduler.log_report()
+        logger.info("Worker stopped")